@@ -0,0 +1,114 @@
+"""Analyses: one row per upload, linked to the patient's profile.
+
+Concerns and AI summaries used to be written next to the upload as
+uploads/<name>.concern.txt and .summary.txt, found again by probing the
+filesystem with a client-supplied file name, and tied to no profile. They
+now live in the analyses table (migration 3 in db.py) together with the
+image hash, where the original is stored, detection stats and timings:
+
+- analysis_id (unique): the id used in URLs, for /send-to-doctor and the
+  summary routes
+- profile_id: a patient's history, newest first, paged by seq (every index
+  ends with the rowid, so a page is one range scan)
+- image_hash: every analysis of the same image bytes (e.g. to find a
+  patient who uploads the same photo again)
+
+Writes go through db.py's writer, so they are committed together with
+concurrent ones.
+"""
+import json
+from collections import Counter
+from datetime import datetime
+
+import db
+from main import load_detections
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+COLUMNS = ('seq', 'analysis_id', 'profile_id', 'image_hash', 'storage_key', 'original_filename', 'concern',
+           'status', 'error', 'cached', 'detection_count', 'detection_classes', 'mean_confidence', 'summary',
+           'detection_ms', 'total_ms', 'summary_ms', 'created_at', 'finished_at', 'summarized_at')
+
+# A profile that no longer exists (or came from another database) leaves profile_id NULL
+_CREATE = """
+    INSERT INTO analyses (analysis_id, profile_id, image_hash, storage_key, original_filename, concern, status, created_at)
+    VALUES (?, (SELECT id FROM profiles WHERE id = ?), ?, ?, ?, ?, ?, ?)
+"""
+_FINISH = """
+    UPDATE analyses SET status = ?, error = ?, cached = ?, detection_count = ?, detection_classes = ?,
+        mean_confidence = ?, detection_ms = ?, total_ms = ?, finished_at = ?
+    WHERE analysis_id = ?
+"""
+_SUMMARY = "UPDATE analyses SET summary = ?, summary_ms = COALESCE(?, summary_ms), summarized_at = ? WHERE analysis_id = ?"
+
+_SELECT = f"SELECT {', '.join(COLUMNS)} FROM analyses"
+_GET = f"{_SELECT} WHERE analysis_id = ?"
+_HISTORY = f"{_SELECT} WHERE profile_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?"
+
+
+def _now():
+    return datetime.utcnow().isoformat()
+
+
+def _row(values) -> dict:
+    row = dict(zip(COLUMNS, values))
+    row['cached'] = bool(row['cached'])
+    if row['detection_classes']:
+        row['detection_classes'] = json.loads(row['detection_classes'])
+    return row
+
+
+def detection_stats(detections_path) -> dict:
+    """Detection count, count per class and mean confidence from a detections file."""
+    try:
+        data = load_detections(detections_path)
+    except (OSError, ValueError):
+        data = None
+    predictions = (data or {}).get('predictions') or []
+    confidences = [p['confidence'] for p in predictions if isinstance(p.get('confidence'), (int, float))]
+    return {
+        'detection_count': len(predictions),
+        'detection_classes': dict(Counter(str(p.get('class', 'unknown')) for p in predictions)),
+        'mean_confidence': round(sum(confidences) / len(confidences), 4) if confidences else None,
+    }
+
+
+def create(analysis_id, image_hash, storage_key, original_filename, concern, status, profile_id=None,
+           created_at=None, database=None):
+    """Record a new upload (storage_key: its file name under uploads/)."""
+    (database or db.get_db()).write(_CREATE, (
+        analysis_id, profile_id, image_hash, storage_key, original_filename, concern or None, status,
+        created_at or _now()))
+
+
+def finish(analysis_id, status, detections_path=None, cached=False, detection_ms=None, total_ms=None,
+           error=None, database=None):
+    """Record the outcome of an analysis, with stats from its detections file if it succeeded."""
+    stats = detection_stats(detections_path) if detections_path is not None else {}
+    classes = stats.get('detection_classes')
+    (database or db.get_db()).write(_FINISH, (
+        status, error, int(cached), stats.get('detection_count'), json.dumps(classes) if classes is not None else None,
+        stats.get('mean_confidence'), detection_ms, total_ms, _now(), analysis_id))
+
+
+def set_summary(analysis_id, summary, summary_ms=None, database=None):
+    (database or db.get_db()).write(_SUMMARY, (summary, summary_ms, _now(), analysis_id))
+
+
+def get(analysis_id, database=None) -> dict | None:
+    values = (database or db.get_db()).query_one(_GET, (analysis_id,))
+    return _row(values) if values else None
+
+
+def history(profile_id, before=None, limit=PAGE_SIZE, database=None):
+    """A profile's analyses, newest first: (rows, `before` for the next page or None)."""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    rows = (database or db.get_db()).query(_HISTORY, (profile_id, before or 2 ** 63 - 1, limit + 1))
+    page = [_row(r) for r in rows[:limit]]
+    return page, (page[-1]['seq'] if len(rows) > limit else None)
+
+
+def latest_for_profile(profile_id, database=None) -> dict | None:
+    rows, _ = history(profile_id, limit=1, database=database)
+    return rows[0] if rows else None
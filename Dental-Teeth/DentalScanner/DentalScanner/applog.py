@@ -0,0 +1,192 @@
+"""Structured, non-blocking logging for the web server.
+
+Routes used to print() headers, form data, session contents and JSON
+bodies straight to stdout on every request: a synchronous write in the
+request path, and patient data (emails, names, date of birth, concerns) in
+the logs. setup() installs one pipeline for every logger instead:
+
+- callers only put records on a bounded in-memory queue (QueueHandler); a
+  background QueueListener thread formats and writes them, so a slow
+  stdout or log shipper never blocks a request. If the queue is full,
+  records are dropped and counted rather than waited for;
+- every record carries the current context (request_id for web requests,
+  plus job_id inside background jobs; see bind() / set_context()), and any
+  `extra=` fields, as JSON (LOG_FORMAT=json, the default) or key=value text;
+- DEBUG records are sampled: each request decides once, with probability
+  LOG_DEBUG_SAMPLE_RATE, whether its debug records are kept, so a sampled
+  request is logged in full and the rest cost nothing;
+- before anything is written, fields whose names look like PHI or secrets
+  are replaced with "<redacted>", and email addresses, bearer tokens and API
+  keys are masked in messages.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import time
+from contextlib import contextmanager
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# "json" (one object per line) or "text"
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').strip().lower()
+# Fraction of requests whose DEBUG records are kept (when LOG_LEVEL=DEBUG)
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', '0.01'))
+# Records waiting for the writer thread; beyond this they are dropped
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+
+REDACTED = '<redacted>'
+# Field names whose values are never logged
+_SENSITIVE_KEY = re.compile(
+    r'(e-?mail|password|passwd|secret|token|api_?key|authorization|cookie|session|'
+    r'first_?name|last_?name|dob|birth|concern|phone|address)', re.I)
+_TEXT_PATTERNS = (
+    (re.compile(r'[\w.+-]+@[\w-]+(\.[\w-]+)+'), '<email>'),
+    (re.compile(r'(?i)bearer\s+[\w.~+/=-]+'), 'Bearer <redacted>'),
+    (re.compile(r'\bsk-[\w-]{8,}'), '<redacted_key>'),
+    (re.compile(r'(?i)(api_?key|password|token)(["\']?\s*[=:]\s*["\']?)[^\s"\'&,]+'), r'\1\2<redacted>'),
+)
+
+# Attributes every LogRecord has; anything else came from extra= or the context
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'context'}
+
+_context = contextvars.ContextVar('log_context', default={})
+
+
+def redact_text(text):
+    for pattern, repl in _TEXT_PATTERNS:
+        text = pattern.sub(repl, text)
+    return text
+
+
+def redact(value, key=None):
+    """Copy of value with sensitive fields and strings masked."""
+    if key is not None and _SENSITIVE_KEY.search(str(key)):
+        return REDACTED
+    if isinstance(value, str):
+        return redact_text(value)
+    if isinstance(value, dict):
+        return {k: redact(v, k) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [redact(v) for v in value]
+    return value
+
+
+def set_context(**fields):
+    """Add fields to the logging context of this thread/task. Returns a token for reset_context()."""
+    return _context.set({**_context.get(), **fields})
+
+
+def reset_context(token):
+    _context.reset(token)
+
+
+@contextmanager
+def bind(**fields):
+    """Context fields for every record logged inside the block."""
+    token = set_context(**fields)
+    try:
+        yield
+    finally:
+        reset_context(token)
+
+
+def sample_debug():
+    """Decide whether debug records of a new request/job are kept."""
+    return random.random() < LOG_DEBUG_SAMPLE_RATE
+
+
+class _ContextFilter(logging.Filter):
+    """Runs in the caller's thread: attach the context and apply debug sampling."""
+
+    def filter(self, record):
+        ctx = _context.get()
+        if record.levelno <= logging.DEBUG and not ctx.get('sampled', False):
+            return False
+        record.context = {k: v for k, v in ctx.items() if k != 'sampled'}
+        return True
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    dropped = 0
+
+    def prepare(self, record):
+        # Only resolve what can't cross threads (args, exception objects);
+        # formatting and redaction happen on the writer thread.
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped += 1
+
+
+class StructuredFormatter(logging.Formatter):
+    def __init__(self, fmt='json'):
+        super().__init__()
+        self.fmt = fmt
+
+    def format(self, record):
+        fields = dict(getattr(record, 'context', None) or {})
+        fields.update((k, v) for k, v in vars(record).items() if k not in _RECORD_ATTRS)
+        fields = redact(fields)
+        message = redact_text(record.getMessage())
+        ts = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z'
+        if self.fmt == 'json':
+            out = {'ts': ts, 'level': record.levelname, 'logger': record.name, 'msg': message, **fields}
+            if record.exc_text:
+                out['exc'] = redact_text(record.exc_text)
+            return json.dumps(out, ensure_ascii=False, default=str)
+        line = f'{ts} {record.levelname:<7} {record.name} {message}'
+        if fields:
+            line += ' ' + ' '.join(f'{k}={v}' for k, v in fields.items())
+        if record.exc_text:
+            line += '\n' + redact_text(record.exc_text)
+        return line
+
+
+_listener = None
+
+
+def setup(level=LOG_LEVEL, fmt=LOG_FORMAT, stream=None):
+    """Route all logging through the queue and the structured writer (idempotent)."""
+    global _listener
+    if _listener is not None:
+        return
+    writer = logging.StreamHandler(stream or sys.stdout)
+    writer.setFormatter(StructuredFormatter(fmt))
+    handler = _DroppingQueueHandler(queue.Queue(maxsize=max(1, LOG_QUEUE_SIZE)))
+    handler.addFilter(_ContextFilter())
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(handler)
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(handler.queue, writer, respect_handler_level=False)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Flush queued records and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def dropped():
+    """Records dropped because the queue was full."""
+    return _DroppingQueueHandler.dropped
@@ -0,0 +1,93 @@
+"""Per-analysis artifact store.
+
+Each analysis gets its own directory instead of the shared output.jpg /
+output_result.json in APP_ROOT, so concurrent uploads (threads, gunicorn
+workers, or several hosts sharing the directory) never overwrite each other:
+
+    artifacts/<analysis_id>/annotated.jpg    annotated image from the workflow
+    artifacts/<analysis_id>/normalized.jpg   oriented/downsized copy sent to the workflow
+    artifacts/<analysis_id>/detections.json  boxes, classes and confidences
+    artifacts/<analysis_id>/analysis.json    job status + upload response
+    artifacts/<analysis_id>/annotated.jpg.<size>.<ext>  smaller copies, made on request (derivatives.py)
+
+analysis.json doubles as the cross-process job record: any worker can answer
+/jobs/<id> for a job that was queued on another one.
+"""
+import json
+import os
+import re
+import tempfile
+import uuid
+from pathlib import Path
+
+APP_ROOT = Path(__file__).parent.resolve()
+ARTIFACT_DIR = Path(os.environ.get('ARTIFACT_DIR', APP_ROOT / 'artifacts'))
+
+ANNOTATED_NAME = 'annotated.jpg'
+NORMALIZED_NAME = 'normalized.jpg'
+DETECTIONS_NAME = 'detections.json'
+RECORD_NAME = 'analysis.json'
+
+# Analysis IDs are job IDs (uuid4 hex) or content hashes (sha256 hex)
+_ID_RE = re.compile(r'^[0-9a-f]{16,64}$')
+
+
+def new_id() -> str:
+    return uuid.uuid4().hex
+
+
+def is_valid_id(analysis_id) -> bool:
+    return bool(analysis_id) and bool(_ID_RE.match(str(analysis_id)))
+
+
+def artifact_dir(analysis_id: str, create: bool = False) -> Path:
+    """Directory for analysis_id. Raises ValueError for malformed IDs (path traversal)."""
+    if not is_valid_id(analysis_id):
+        raise ValueError(f'Invalid analysis id: {analysis_id!r}')
+    d = ARTIFACT_DIR / analysis_id
+    if create:
+        d.mkdir(parents=True, exist_ok=True)
+    return d
+
+
+def annotated_path(analysis_id: str) -> Path:
+    return artifact_dir(analysis_id) / ANNOTATED_NAME
+
+
+def normalized_path(analysis_id: str) -> Path:
+    return artifact_dir(analysis_id) / NORMALIZED_NAME
+
+
+def detections_path(analysis_id: str) -> Path:
+    return artifact_dir(analysis_id) / DETECTIONS_NAME
+
+
+def write_record(analysis_id: str, record: dict) -> None:
+    """Atomically replace analysis.json so readers never see a partial file."""
+    d = artifact_dir(analysis_id, create=True)
+    fd, tmp = tempfile.mkstemp(dir=str(d), prefix='.analysis-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+            json.dump(record, fh, ensure_ascii=False)
+        os.replace(tmp, d / RECORD_NAME)
+    except Exception:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def update_record(analysis_id: str, **fields) -> dict:
+    record = read_record(analysis_id) or {'analysis_id': analysis_id}
+    record.update(fields)
+    write_record(analysis_id, record)
+    return record
+
+
+def read_record(analysis_id: str) -> dict | None:
+    try:
+        with open(artifact_dir(analysis_id) / RECORD_NAME, 'r', encoding='utf-8') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
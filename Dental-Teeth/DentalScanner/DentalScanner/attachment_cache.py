@@ -0,0 +1,173 @@
+"""Email attachments encoded once per file content and reused by every email.
+
+compose() used to read each attachment, guess its type and base64-encode it
+into the message again for every email: the same analysis sent to several
+doctors, retried by the outbox, or included again in a digest (dispatch.py)
+repeated all of it, and phone photos went out at full size. part() instead:
+
+- identifies a file by the SHA-256 of its content, remembered per (path,
+  size, mtime) so an unchanged file is hashed once;
+- optionally downsizes images so the longest edge is at most
+  EMAIL_ATTACHMENT_MAX_EDGE pixels (an oriented JPEG at
+  EMAIL_ATTACHMENT_QUALITY, see preprocess.py), stored once as
+  cache/.attachments/<sha256>-<settings>.jpg; 0 (the default) attaches
+  the originals;
+- keeps the base64-encoded bodies of recently used attachments in memory
+  (EMAIL_ATTACHMENT_CACHE_MB, least recently used dropped first).
+
+An email then only wraps a cached body in its own part headers (the file
+name differs per email). Bodies are cached with CRLF line ends, as sent over
+SMTP, and to_bytes() writes them out as they are: flattening a message with
+the stock generator re-splits every base64 body line by line, which took
+longer than encoding it. Hits and misses are counted on /metrics as the
+"attachment" cache.
+"""
+import base64
+import mimetypes
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from email.generator import BytesGenerator
+from email.message import MIMEPart
+from io import BytesIO
+from pathlib import Path
+
+import metrics
+import preprocess
+from result_cache import RESULT_CACHE_DIR, sha256_file
+
+# Longest image edge in pixels for attachments; 0 attaches originals
+EMAIL_ATTACHMENT_MAX_EDGE = int(os.environ.get('EMAIL_ATTACHMENT_MAX_EDGE', '0'))
+EMAIL_ATTACHMENT_QUALITY = int(os.environ.get('EMAIL_ATTACHMENT_QUALITY', '85'))
+EMAIL_ATTACHMENT_CACHE_MB = float(os.environ.get('EMAIL_ATTACHMENT_CACHE_MB', '64'))
+# The leading dot keeps ResultCache from taking it for one of its entries
+ATTACHMENT_DIR = Path(os.environ.get('EMAIL_ATTACHMENT_CACHE_DIR', RESULT_CACHE_DIR / '.attachments'))
+
+
+def _resized_variant() -> str | None:
+    if EMAIL_ATTACHMENT_MAX_EDGE <= 0 or not preprocess.available():
+        return None
+    return f'edge{EMAIL_ATTACHMENT_MAX_EDGE}-q{EMAIL_ATTACHMENT_QUALITY}'
+
+
+class AttachmentCache:
+    def __init__(self, max_bytes=int(EMAIL_ATTACHMENT_CACHE_MB * 1024 * 1024), root=ATTACHMENT_DIR):
+        self.max_bytes = max_bytes
+        self.root = Path(root)
+        self._lock = threading.Lock()
+        # path -> (size, mtime_ns, sha256)
+        self._hashes = {}
+        # (sha256, variant) -> (content type, base64 body with CRLF line ends); least- to most-recently used
+        self._parts = OrderedDict()
+        self._bytes = 0
+
+    def content_hash(self, path: Path) -> str:
+        """SHA-256 of the file's content, hashed again only if its size or mtime changed."""
+        st = path.stat()
+        with self._lock:
+            known = self._hashes.get(str(path))
+        if known and known[:2] == (st.st_size, st.st_mtime_ns):
+            return known[2]
+        digest = sha256_file(path)
+        with self._lock:
+            self._hashes[str(path)] = (st.st_size, st.st_mtime_ns, digest)
+        return digest
+
+    def _resized(self, path: Path, digest: str, variant: str) -> Path:
+        """The downsized copy of an image (made on first use), or path itself if it is small already."""
+        target = self.root / f'{digest}-{variant}.jpg'
+        if target.exists():
+            return target
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.root / f'.{uuid.uuid4().hex}.tmp'
+        out = preprocess.normalize_image(path, tmp, max_edge=EMAIL_ATTACHMENT_MAX_EDGE,
+                                         quality=EMAIL_ATTACHMENT_QUALITY)
+        if out == path:
+            tmp.unlink(missing_ok=True)
+            return path
+        # Another worker may have just made the same one: either copy will do
+        os.replace(tmp, target)
+        return target
+
+    def _encode(self, path: Path, filename: str, digest: str):
+        ctype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        variant = _resized_variant() if ctype.startswith('image/') else None
+        key = (digest, variant or 'original')
+        with self._lock:
+            cached = self._parts.get(key)
+            if cached is not None:
+                self._parts.move_to_end(key)
+        metrics.cache('attachment', cached is not None)
+        if cached is not None:
+            return cached
+        source = path
+        if variant:
+            source = self._resized(path, digest, variant)
+            if source != path:
+                ctype = 'image/jpeg'
+        with metrics.timed('attachment_encode'):
+            cached = (ctype, base64.encodebytes(source.read_bytes()).replace(b'\n', b'\r\n'))
+        with self._lock:
+            if key not in self._parts:
+                self._parts[key] = cached
+                self._bytes += len(cached[1])
+                while self._bytes > self.max_bytes and len(self._parts) > 1:
+                    _, (_, body) = self._parts.popitem(last=False)
+                    self._bytes -= len(body)
+        return cached
+
+    def part(self, path, filename=None) -> MIMEPart:
+        """An attachment part for the file at path, named filename. Raises OSError if it can't be read."""
+        path = Path(path)
+        filename = filename or path.name
+        ctype, body = self._encode(path, filename, self.content_hash(path))
+        if ctype == 'image/jpeg' and not filename.lower().endswith(('.jpg', '.jpeg')):
+            # Downsized to JPEG from another format
+            filename = f'{Path(filename).stem}.jpg'
+        part = MIMEPart()
+        part['Content-Type'] = ctype
+        part['Content-Transfer-Encoding'] = 'base64'
+        part['Content-Disposition'] = 'attachment'
+        part.set_param('filename', filename, header='Content-Disposition')
+        part.set_payload(body.decode('ascii'))
+        # Written out as is by to_bytes()
+        part.wire_body = body
+        return part
+
+    def stats(self):
+        with self._lock:
+            return {'parts': len(self._parts), 'bytes': self._bytes, 'files_hashed': len(self._hashes)}
+
+
+class _WireGenerator(BytesGenerator):
+    def _handle_text(self, msg):
+        body = getattr(msg, 'wire_body', None)
+        if body is not None and self._NL == '\r\n':
+            self._fp.write(body)
+        else:
+            super()._handle_text(msg)
+
+    # Used for every non-text part
+    _writeBody = _handle_text
+
+
+def to_bytes(msg, utf8=False) -> bytes:
+    """msg as sent over SMTP (what smtplib's send_message() would send), cached bodies copied as they are."""
+    buf = BytesIO()
+    policy = msg.policy.clone(utf8=True) if utf8 else msg.policy
+    _WireGenerator(buf, policy=policy).flatten(msg, linesep='\r\n')
+    return buf.getvalue()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> AttachmentCache:
+    """The process-wide attachment cache (created on first use)."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = AttachmentCache()
+        return _cache
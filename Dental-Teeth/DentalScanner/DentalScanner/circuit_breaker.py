@@ -0,0 +1,130 @@
+"""Process-wide circuit breaker and retry budget for calls to flaky providers.
+
+Used around the OpenAI summary call. Before, every upload retried on its own
+(OPENAI_RETRIES x OPENAI_TIMEOUT plus backoff), so during a provider incident
+each job held a worker thread for the full retry sequence and the queue
+backed up behind them.
+
+- CircuitBreaker opens after `failure_threshold` consecutive failures and
+  rejects calls immediately (CircuitOpen) for `cooldown` seconds. After that,
+  a single probe call is let through (half-open): success closes the
+  breaker, failure re-opens it.
+- RetryBudget caps retries across all requests: every first attempt deposits
+  `ratio` tokens, every retry spends one, plus a small floor of retries per
+  second, so a degraded provider sees at most ~ratio extra load.
+- backoff_delay() is exponential backoff with full jitter, so retries from
+  concurrent jobs don't arrive in lockstep.
+"""
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger('dental.circuit_breaker')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling the provider while the breaker is open."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f'{name} circuit open; retry in {retry_after:.0f}s')
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, cooldown=30.0):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.rejected = 0
+
+    def before_call(self):
+        """Raise CircuitOpen unless a call may go ahead now."""
+        with self._lock:
+            if self._state == CLOSED:
+                return
+            remaining = self._opened_at + self.cooldown - time.monotonic()
+            if self._state == OPEN and remaining <= 0:
+                self._state = HALF_OPEN
+            if self._state == HALF_OPEN and not self._probe_in_flight:
+                # Let exactly one probe through
+                self._probe_in_flight = True
+                return
+            self.rejected += 1
+            raise CircuitOpen(self.name, max(remaining, 1.0))
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    log.warning('circuit breaker opened', extra={'breaker': self.name, 'failures': self._failures})
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def retry_after(self):
+        """Seconds until the breaker will allow a probe (0 when closed)."""
+        with self._lock:
+            if self._state == CLOSED:
+                return 0.0
+            return max(0.0, self._opened_at + self.cooldown - time.monotonic())
+
+    def stats(self):
+        with self._lock:
+            return {'state': self._state, 'consecutive_failures': self._failures, 'rejected': self.rejected}
+
+
+class RetryBudget:
+    def __init__(self, ratio=0.2, min_per_second=0.1, max_tokens=10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._lock = threading.Lock()
+        self._tokens = max_tokens
+        self._last = time.monotonic()
+
+    def _refill_locked(self):
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._last) * self.min_per_second)
+        self._last = now
+
+    def deposit(self):
+        """Call once per original (non-retry) request."""
+        with self._lock:
+            self._refill_locked()
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_spend(self):
+        """True if a retry may be made now."""
+        with self._lock:
+            self._refill_locked()
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return True
+            return False
+
+    def stats(self):
+        with self._lock:
+            self._refill_locked()
+            return {'tokens': round(self._tokens, 2)}
+
+
+def backoff_delay(attempt, base=1.5, cap=10.0):
+    """Full-jitter exponential backoff before retry number `attempt` (1-based)."""
+    return random.uniform(0, min(cap, base ** attempt))
@@ -0,0 +1,368 @@
+"""SQLite data layer: pooled WAL connections, group commit and schema migrations.
+
+save_profile() used to open a fresh connection per request on the default
+rollback journal, where a writer locks out readers and concurrent writers
+wait on each other until they fail with "database is locked". Instead:
+
+- The database runs in WAL mode (readers never block the writer or each
+  other) with synchronous=NORMAL (DB_SYNCHRONOUS): one fsync per checkpoint
+  instead of per commit, still safe against application crashes.
+- Connections are opened once with the pragmas applied, and pooled
+  (DB_POOL_SIZE idle connections). A thread keeps the same connection for
+  nested use; each connection caches its prepared statements, so the
+  constant parameterized SQL used here is parsed once.
+- All writes go through one writer thread that commits everything queued
+  since its last commit in a single transaction (group commit, at most
+  DB_BATCH_MAX statements, optionally lingering DB_BATCH_WAIT_MS for more).
+  Callers still block until their own statement is durable and get its
+  error if it failed; a failing statement doesn't affect the others in its
+  batch, unless SQLite rolled back the whole transaction (disk full, I/O
+  error), which fails them all. With a single writer per process there is
+  no lock contention between request threads, and busy_timeout
+  (DB_BUSY_TIMEOUT_MS) absorbs the remaining contention between gunicorn
+  workers.
+- The schema is versioned with PRAGMA user_version; migrate() applies the
+  pending entries of MIGRATIONS in order, each in its own transaction.
+"""
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from pathlib import Path
+
+import metrics
+
+APP_ROOT = Path(__file__).parent.resolve()
+DB_PATH = Path(os.environ.get('DB_PATH', APP_ROOT / 'data.db'))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', '5000'))
+# OFF, NORMAL or FULL. NORMAL in WAL mode may lose the last commits on power
+# loss, never on an application crash, and never corrupts the database.
+DB_SYNCHRONOUS = os.environ.get('DB_SYNCHRONOUS', 'NORMAL').strip().upper()
+# Idle connections kept for reuse
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '8'))
+# Most statements committed in one transaction by the writer
+DB_BATCH_MAX = int(os.environ.get('DB_BATCH_MAX', '256'))
+# How long the writer waits for more statements before committing (0: commit
+# whatever is queued right away; concurrent writes still share commits)
+DB_BATCH_WAIT_MS = float(os.environ.get('DB_BATCH_WAIT_MS', '0'))
+# Prepared statements cached per connection
+DB_STATEMENT_CACHE = 256
+
+if DB_SYNCHRONOUS not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+    raise ValueError(f'DB_SYNCHRONOUS must be OFF, NORMAL, FULL or EXTRA, not {DB_SYNCHRONOUS!r}')
+
+log = logging.getLogger('dental.db')
+
+# (schema version, description, statements). Append only: a database at
+# version N gets every entry above N, in order.
+MIGRATIONS = [
+    (1, 'profiles table', [
+        # IF NOT EXISTS: databases created before migrations already have it
+        """
+        CREATE TABLE IF NOT EXISTS profiles (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            first_name TEXT NOT NULL,
+            last_name TEXT NOT NULL,
+            provider TEXT NOT NULL,
+            dob TEXT NOT NULL,
+            patient_email TEXT NOT NULL,
+            doctor_email TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """,
+    ]),
+    (2, 'profile lookup indexes and upsert key', [
+        'ALTER TABLE profiles ADD COLUMN updated_at TEXT',
+        # Repeat visitors used to get a new row per visit: keep the latest one
+        """
+        DELETE FROM profiles WHERE id NOT IN (
+            SELECT MAX(id) FROM profiles
+            GROUP BY patient_email COLLATE NOCASE, last_name COLLATE NOCASE, first_name COLLATE NOCASE, dob
+        )
+        """,
+        # One profile per patient; also serves lookups by patient_email
+        """
+        CREATE UNIQUE INDEX profiles_identity ON profiles (
+            patient_email COLLATE NOCASE, last_name COLLATE NOCASE, first_name COLLATE NOCASE, dob
+        )
+        """,
+        'CREATE INDEX profiles_name_dob ON profiles (last_name COLLATE NOCASE, first_name COLLATE NOCASE, dob)',
+        # Every index ends with the rowid (id), so these also give keyset pages in id order
+        'CREATE INDEX profiles_doctor ON profiles (doctor_email COLLATE NOCASE)',
+        'CREATE INDEX profiles_provider ON profiles (provider COLLATE NOCASE)',
+    ]),
+    (3, 'analyses table', [
+        """
+        CREATE TABLE analyses (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            analysis_id TEXT NOT NULL UNIQUE,
+            profile_id INTEGER REFERENCES profiles (id) ON DELETE SET NULL,
+            image_hash TEXT NOT NULL,
+            storage_key TEXT NOT NULL,
+            original_filename TEXT,
+            concern TEXT,
+            status TEXT NOT NULL,
+            error TEXT,
+            cached INTEGER NOT NULL DEFAULT 0,
+            detection_count INTEGER,
+            detection_classes TEXT,
+            mean_confidence REAL,
+            summary TEXT,
+            detection_ms REAL,
+            total_ms REAL,
+            summary_ms REAL,
+            created_at TEXT NOT NULL,
+            finished_at TEXT,
+            summarized_at TEXT
+        )
+        """,
+        'CREATE INDEX analyses_profile ON analyses (profile_id)',
+        'CREATE INDEX analyses_image_hash ON analyses (image_hash)',
+    ]),
+    (4, 'email outbox', [
+        """
+        CREATE TABLE outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id TEXT NOT NULL UNIQUE,
+            analysis_id TEXT,
+            recipient TEXT NOT NULL,
+            sender TEXT,
+            reply_to TEXT,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            attachments TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            detail TEXT,
+            created_at TEXT NOT NULL,
+            sent_at TEXT
+        )
+        """,
+        # The worker's "what is due" scan: queued rows and expired claims, oldest first
+        'CREATE INDEX outbox_due ON outbox (status, next_attempt_at)',
+    ]),
+    (5, 'batch dispatch items', [
+        # One row per analysis in a dispatch batch; message_id is the digest it went out in
+        # (NULL if it was skipped, with the reason in error)
+        """
+        CREATE TABLE dispatch_items (
+            batch_id TEXT NOT NULL,
+            analysis_id TEXT NOT NULL,
+            recipient TEXT,
+            message_id TEXT,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (batch_id, analysis_id)
+        )
+        """,
+    ]),
+]
+
+
+def connect(path=None) -> sqlite3.Connection:
+    """A new connection with this module's pragmas, in autocommit mode (transactions are explicit)."""
+    conn = sqlite3.connect(str(path or DB_PATH), timeout=DB_BUSY_TIMEOUT_MS / 1000.0, isolation_level=None,
+                           check_same_thread=False, cached_statements=DB_STATEMENT_CACHE)
+    conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS:d}')
+    conn.execute(f'PRAGMA synchronous = {DB_SYNCHRONOUS}')
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+
+def schema_version(conn) -> int:
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(path=None, migrations=MIGRATIONS) -> int:
+    """Apply pending migrations (MIGRATIONS) and switch the database to WAL. Returns the schema version."""
+    conn = connect(path)
+    try:
+        # The journal mode is stored in the database file, so this sticks
+        conn.execute('PRAGMA journal_mode = WAL')
+        for version, description, statements in migrations:
+            if version <= schema_version(conn):
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Checked again under the write lock: another worker may have just done it
+                if version > schema_version(conn):
+                    for sql in statements:
+                        conn.execute(sql)
+                    conn.execute(f'PRAGMA user_version = {version:d}')
+                    log.info('migrated database', extra={'version': version, 'migration': description})
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        return schema_version(conn)
+    finally:
+        conn.close()
+
+
+class Database:
+    def __init__(self, path=None, pool_size=DB_POOL_SIZE, batch_max=DB_BATCH_MAX, batch_wait_ms=DB_BATCH_WAIT_MS):
+        self.path = Path(path or DB_PATH)
+        self.pool_size = pool_size
+        self.batch_max = max(1, batch_max)
+        self.batch_wait = batch_wait_ms / 1000.0
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._local = threading.local()
+        self._writes = queue.Queue()
+        self._writer = None
+
+    def _check_fork(self):
+        # Connections and the writer thread inherited from a parent process
+        # (gunicorn --preload) must not be used in the child
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+    @contextmanager
+    def connection(self):
+        """This thread's connection for reads, from the pool; nested uses share it."""
+        self._check_fork()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = connect(self.path)
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            if conn.in_transaction:
+                conn.rollback()
+            if self._idle.qsize() < self.pool_size:
+                self._idle.put(conn)
+            else:
+                conn.close()
+
+    def query(self, sql, params=()) -> list:
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def query_one(self, sql, params=()):
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def submit(self, sql, params=()) -> Future:
+        """Queue a write for the writer thread.
+
+        Once committed, the future resolves to the statement's lastrowid, or
+        to the first row of its RETURNING clause if it has one.
+        """
+        self._check_fork()
+        future = Future()
+        self._writes.put((sql, params, future))
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, args=(self._writes,),
+                                                name='db-writer', daemon=True)
+                self._writer.start()
+        return future
+
+    def write(self, sql, params=(), timeout=None):
+        """Run one INSERT/UPDATE/DELETE and wait until it is committed. Returns what submit()'s future does."""
+        return self.submit(sql, params).result(timeout)
+
+    def _write_loop(self, writes):
+        conn = connect(self.path)
+        while True:
+            batch = [writes.get()]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_max:
+                try:
+                    remaining = deadline - time.monotonic()
+                    batch.append(writes.get(timeout=remaining) if remaining > 0 else writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._commit(conn, batch)
+            except Exception as e:
+                # Keep the writer alive; everyone in the batch gets the error
+                log.exception('database write batch failed', extra={'statements': len(batch)})
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _commit(self, conn, batch):
+        started = time.perf_counter()
+        outcomes = []
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for i, (sql, params, future) in enumerate(batch):
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    # A failing statement is undone on its own; the transaction goes on
+                    cur = conn.execute(sql, params)
+                    if cur.description is not None:
+                        # RETURNING: rows must be read before the commit
+                        rows = cur.fetchall()
+                        outcomes.append((future, rows[0] if rows else None, None))
+                    else:
+                        outcomes.append((future, cur.lastrowid, None))
+                except sqlite3.Error as e:
+                    outcomes.append((future, None, e))
+                    if not conn.in_transaction:
+                        # SQLite rolled back the whole transaction (SQLITE_FULL, SQLITE_IOERR,
+                        # SQLITE_NOMEM, ...): nothing in the batch was written, and the rest
+                        # must not run in autocommit
+                        outcomes = [(f, None, e) for f, _, _ in outcomes]
+                        for _, _, rest in batch[i + 1:]:
+                            if rest.set_running_or_notify_cancel():
+                                outcomes.append((rest, None, e))
+                        break
+            if conn.in_transaction:
+                conn.execute('COMMIT')
+            else:
+                metrics.error('sqlite_commit')
+        except BaseException:
+            metrics.error('sqlite_commit')
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        metrics.observe('sqlite_commit', time.perf_counter() - started)
+        for future, rowid, error in outcomes:
+            if error is None:
+                future.set_result(rowid)
+            else:
+                future.set_exception(error)
+
+    def close(self):
+        """Close the idle pooled connections (the writer's connection lives as long as its thread)."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_db = None
+_db_lock = threading.Lock()
+
+
+def get_db() -> Database:
+    """The process-wide database (created on first use)."""
+    global _db
+    with _db_lock:
+        if _db is None:
+            _db = Database()
+        return _db
@@ -0,0 +1,137 @@
+"""Smaller copies of result and upload images, made on first request.
+
+/result/<analysis_id> and /uploads/<file> always sent the full-size image,
+although the upload page shows it in half of its width, or on a phone
+screen. With ?size=thumb or ?size=medium they send a copy whose longest
+edge is at most DERIVATIVE_THUMB_EDGE / DERIVATIVE_MEDIUM_EDGE pixels:
+
+- made by derivative() the first time it is asked for (once per process
+  when requests race) and kept next to its source, as
+  artifacts/<id>/annotated.jpg.<size>.<ext> and
+  uploads/.derivatives/<path>.<size>.<ext> (the upload's path, extension
+  included, so x.jpg, x.png and sub/x.jpg each get their own); made again
+  only if the source changed since;
+- AVIF or WebP when the client accepts it (its Accept header) and Pillow
+  can write it, preferred in DERIVATIVE_FORMATS order, else JPEG; the
+  responses carry Vary: Accept;
+- oriented by its EXIF tag like preprocess.py does, at DERIVATIVE_QUALITY.
+
+Without Pillow, or if an image can't be read, the original is sent.
+Making one is timed as "image_derivative" on /metrics, and requests are
+counted as the "derivative" cache.
+"""
+import logging
+import os
+import threading
+import uuid
+from functools import lru_cache
+from pathlib import Path
+
+import metrics
+
+try:
+    from PIL import Image, ImageOps
+except Exception:
+    Image = None
+    ImageOps = None
+
+DERIVATIVE_THUMB_EDGE = int(os.environ.get('DERIVATIVE_THUMB_EDGE', '320'))
+DERIVATIVE_MEDIUM_EDGE = int(os.environ.get('DERIVATIVE_MEDIUM_EDGE', '1024'))
+DERIVATIVE_QUALITY = int(os.environ.get('DERIVATIVE_QUALITY', '80'))
+# Preferred formats for clients that accept them; JPEG otherwise
+DERIVATIVE_FORMATS = [f.strip().lower() for f in os.environ.get('DERIVATIVE_FORMATS', 'avif,webp').split(',')
+                      if f.strip()]
+
+SIZES = {'thumb': DERIVATIVE_THUMB_EDGE, 'medium': DERIVATIVE_MEDIUM_EDGE}
+# name -> (Pillow format, content type, file extension)
+FORMATS = {
+    'avif': ('AVIF', 'image/avif', 'avif'),
+    'webp': ('WEBP', 'image/webp', 'webp'),
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg'),
+}
+
+log = logging.getLogger('dental.derivatives')
+
+# Striped by target, so concurrent first requests for one derivative make it once
+_locks = [threading.Lock() for _ in range(32)]
+
+
+def available() -> bool:
+    return Image is not None
+
+
+@lru_cache(maxsize=None)
+def can_write(fmt) -> bool:
+    """Whether this Pillow build can encode fmt (AVIF needs Pillow 11.3+ with libavif)."""
+    if Image is None or fmt not in FORMATS:
+        return False
+    Image.init()
+    return FORMATS[fmt][0] in Image.SAVE
+
+
+def negotiate(accept) -> str:
+    """The format to send a client with this Accept header: the first of DERIVATIVE_FORMATS it takes, else JPEG."""
+    accept = (accept or '').lower()
+    for fmt in DERIVATIVE_FORMATS:
+        if fmt in FORMATS and FORMATS[fmt][1] in accept and can_write(fmt):
+            return fmt
+    return 'jpeg'
+
+
+def content_type(path) -> str | None:
+    """The content type of a derivative, by its extension."""
+    suffix = Path(path).suffix.lstrip('.').lower()
+    return next((ctype for _, ctype, ext in FORMATS.values() if ext == suffix), None)
+
+
+def _fresh(target: Path, src: Path) -> bool:
+    try:
+        return target.stat().st_mtime_ns >= src.stat().st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def _render(src: Path, target: Path, edge: int, pil_format: str):
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f'.{uuid.uuid4().hex}.tmp')
+    try:
+        with Image.open(src) as im:
+            # As in preprocess.py: let the JPEG decoder downscale by a power of two first
+            im.draft('RGB', (edge, edge))
+            out = ImageOps.exif_transpose(im)
+            if out.mode not in ('RGB', 'RGBA') or (pil_format == 'JPEG' and out.mode != 'RGB'):
+                out = out.convert('RGB')
+            out.thumbnail((edge, edge), Image.LANCZOS)
+            out.save(tmp, pil_format, quality=DERIVATIVE_QUALITY)
+        os.replace(tmp, target)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def derivative(src, size, fmt, dest_dir) -> Path:
+    """The size copy of the image at src in format fmt, made in dest_dir on first use.
+
+    The copy is named after src's whole file name, so dest_dir must only
+    hold copies of files from one directory. Returns src itself if Pillow is
+    missing or the copy can't be made.
+    """
+    src = Path(src)
+    if Image is None:
+        return src
+    pil_format, _, ext = FORMATS[fmt]
+    target = Path(dest_dir) / f'{src.name}.{size}.{ext}'
+    hit = _fresh(target, src)
+    metrics.cache('derivative', hit)
+    if hit:
+        return target
+    with _locks[hash(str(target)) % len(_locks)]:
+        if _fresh(target, src):
+            return target
+        try:
+            with metrics.timed('image_derivative'):
+                _render(src, target, SIZES[size], pil_format)
+        except Exception as e:
+            log.warning('image derivative failed, sending original',
+                        extra={'image': src.name, 'size': size, 'format': fmt, 'error': str(e)})
+            return src
+    return target
@@ -0,0 +1,227 @@
+"""Batch report dispatch: many analyses, one digest email per doctor.
+
+/send-to-doctor sends one analysis per call and builds one message for it.
+A provider sending the reports of dozens of recent analyses would make as
+many calls and send as many emails. dispatch() takes a list of analysis_ids
+(each goes to its patient's doctor_email) or a doctor_email (that doctor's
+patients' finished analyses, newest first, optionally since a date) and:
+
+- groups the analyses by recipient, DISPATCH_DIGEST_SIZE per message, into
+  digests listing each patient, date, detections and concern, with both
+  images of each analysis attached as <analysis_id>_original / _annotated;
+- queues the digests in the outbox in one commit (outbox.py), whose
+  OUTBOX_WORKERS threads deliver them in parallel, each over its own
+  pooled SMTP connection;
+- records which digest each analysis went out in (or why it was skipped)
+  in dispatch_items (migration 5 in db.py).
+
+status() reports per-analysis outcomes from those rows joined with the
+outbox, and the batch's delivery rate in messages per second.
+"""
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import artifacts
+import db
+import outbox
+from jobs import DONE
+
+APP_ROOT = Path(__file__).parent.resolve()
+UPLOAD_DIR = APP_ROOT / 'uploads'
+
+# Analyses per digest message (two attachments each)
+DISPATCH_DIGEST_SIZE = int(os.environ.get('DISPATCH_DIGEST_SIZE', '10'))
+# Most analyses in one batch
+DISPATCH_MAX_ITEMS = int(os.environ.get('DISPATCH_MAX_ITEMS', '500'))
+
+COLUMNS = ('analysis_id', 'status', 'storage_key', 'concern', 'detection_count', 'detection_classes', 'created_at',
+           'first_name', 'last_name', 'dob', 'patient_email', 'doctor_email')
+
+_SELECT = """
+    SELECT a.analysis_id, a.status, a.storage_key, a.concern, a.detection_count, a.detection_classes, a.created_at,
+           p.first_name, p.last_name, p.dob, p.patient_email, p.doctor_email
+    FROM analyses a LEFT JOIN profiles p ON p.id = a.profile_id
+"""
+# profiles_doctor, then analyses_profile per patient
+_FOR_DOCTOR = (f"{_SELECT} WHERE p.doctor_email = ? COLLATE NOCASE AND a.status = 'done' AND a.created_at >= ? "
+               f"ORDER BY a.seq DESC LIMIT ?")
+_ITEM = "INSERT INTO dispatch_items (batch_id, analysis_id, recipient, message_id, error, created_at) VALUES (?,?,?,?,?,?)"
+_STATUS = """
+    SELECT d.analysis_id, d.recipient, d.message_id, d.error, d.created_at, o.status, o.last_error, o.sent_at
+    FROM dispatch_items d LEFT JOIN outbox o ON o.message_id = d.message_id
+    WHERE d.batch_id = ? ORDER BY d.rowid
+"""
+# SQLite's default limit on ? parameters is 999 in older versions
+_IN_CHUNK = 500
+
+
+def _rows(sql, params, database):
+    return [dict(zip(COLUMNS, r)) for r in database.query(sql, params)]
+
+
+def for_doctor(doctor_email, since=None, limit=DISPATCH_MAX_ITEMS, database=None) -> list[dict]:
+    """The doctor's patients' finished analyses, newest first.
+
+    since is compared as text with created_at, so it must be a naive UTC ISO
+    string like those (the /dispatch route normalizes it).
+    """
+    return _rows(_FOR_DOCTOR, (doctor_email, since or '', max(1, min(limit, DISPATCH_MAX_ITEMS))),
+                 database or db.get_db())
+
+
+def by_ids(analysis_ids, database=None) -> dict:
+    """{analysis_id: row} for the ids that exist."""
+    database = database or db.get_db()
+    found = {}
+    for i in range(0, len(analysis_ids), _IN_CHUNK):
+        chunk = analysis_ids[i:i + _IN_CHUNK]
+        sql = f"{_SELECT} WHERE a.analysis_id IN ({', '.join('?' * len(chunk))})"
+        found.update((row['analysis_id'], row) for row in _rows(sql, chunk, database))
+    return found
+
+
+def _attachments(row):
+    """[path, name] for the original upload and the annotated image, named after the analysis."""
+    original = UPLOAD_DIR / os.path.basename(row['storage_key'])
+    annotated = artifacts.annotated_path(row['analysis_id'])
+    return [[str(path), f"{row['analysis_id']}_{kind}{path.suffix}"]
+            for kind, path in (('original', original), ('annotated', annotated)) if path.exists()]
+
+
+def _describe(n, row, attachments):
+    name = ' '.join(x for x in (row['first_name'], row['last_name']) if x) or 'Unknown patient'
+    lines = [f"{n}. {name}" + (f" (born {row['dob']})" if row['dob'] else '')
+             + (f", {row['patient_email']}" if row['patient_email'] else '')]
+    submitted = row['created_at'][:16].replace('T', ' ') + ' UTC'
+    if row['detection_count'] is None:
+        lines.append(f'   Submitted {submitted}')
+    else:
+        classes = json.loads(row['detection_classes'] or '{}')
+        found = ', '.join(f'{cls} x{count}' for cls, count in sorted(classes.items()))
+        lines.append(f"   Submitted {submitted}; {row['detection_count']} findings" + (f': {found}' if found else ''))
+    if row['concern']:
+        lines.append(f"   Concerns: {row['concern']}")
+    names = ', '.join(filename for _, filename in attachments)
+    lines.append('   Attachments: ' + (names or 'none (files no longer available)'))
+    return lines
+
+
+def compose_digest(rows) -> tuple[str, str, list]:
+    """(subject, body, attachments) for one digest of analyses."""
+    attachments = []
+    body = ['Dear Provider,', '',
+            f'{len(rows)} dental image submission{"s" if len(rows) != 1 else ""} from your patients via the Open Wide '
+            'app. The original and annotated images of each are attached.', '']
+    for n, row in enumerate(rows, 1):
+        files = _attachments(row)
+        attachments += files
+        body += _describe(n, row, files) + ['']
+    body.append('This message was sent from the Open Wide app.')
+    subject = f'Dental images from Open Wide: {len(rows)} patient submission{"s" if len(rows) != 1 else ""}'
+    return subject, '\n'.join(body), attachments
+
+
+def dispatch(analysis_ids=None, doctor_email=None, since=None, limit=DISPATCH_MAX_ITEMS, database=None,
+             box=None) -> tuple[str, list[dict]]:
+    """Queue digests for analysis_ids (to each patient's doctor) or for doctor_email's patients.
+
+    Returns (batch_id, items): per analysis its recipient and message_id, or
+    the error it was skipped for (unknown, not finished, no doctor email).
+    """
+    database = database or db.get_db()
+    box = box or outbox.get_outbox()
+    skipped = []
+    if analysis_ids is not None:
+        found = by_ids(analysis_ids, database)
+        rows = []
+        for analysis_id in dict.fromkeys(analysis_ids):
+            row = found.get(analysis_id)
+            if row is None:
+                skipped.append((analysis_id, None, 'unknown analysis'))
+            elif row['status'] != DONE:
+                skipped.append((analysis_id, row['doctor_email'], f"analysis is {row['status']}"))
+            elif not row['doctor_email']:
+                skipped.append((analysis_id, None, 'no doctor email for this patient'))
+            else:
+                rows.append(row)
+    else:
+        rows = for_doctor(doctor_email, since, limit, database)
+        for row in rows:
+            row['doctor_email'] = doctor_email
+
+    # Digests per recipient, in the order analyses were given (newest first for a doctor)
+    groups = {}
+    for row in rows:
+        groups.setdefault(row['doctor_email'].lower(), []).append(row)
+    digests = []
+    for group in groups.values():
+        for i in range(0, len(group), DISPATCH_DIGEST_SIZE):
+            digests.append(group[i:i + DISPATCH_DIGEST_SIZE])
+    random_from = os.environ.get('SMTP_RANDOM_FROM', '').lower() in ('1', 'true', 'yes')
+    messages = []
+    for digest in digests:
+        subject, body, attachments = compose_digest(digest)
+        messages.append({'recipient': digest[0]['doctor_email'], 'subject': subject, 'body': body,
+                         'attachments': attachments,
+                         'sender': outbox.random_from_address() if random_from else None})
+    message_ids = box.enqueue_many(messages) if messages else []
+
+    batch_id = uuid.uuid4().hex
+    created = datetime.utcnow().isoformat()
+    items = [(row['analysis_id'], row['doctor_email'], message_id, None)
+             for digest, message_id in zip(digests, message_ids) for row in digest]
+    items += [(analysis_id, recipient, None, error) for analysis_id, recipient, error in skipped]
+    futures = [database.submit(_ITEM, (batch_id, *item, created)) for item in items]
+    for future in futures:
+        future.result()
+    return batch_id, [dict(zip(('analysis_id', 'recipient', 'message_id', 'error'), item)) for item in items]
+
+
+def status(batch_id, database=None) -> dict | None:
+    """Per-analysis outcomes of a batch, message counts and delivery rate; None if unknown."""
+    rows = (database or db.get_db()).query(_STATUS, (batch_id,))
+    if not rows:
+        return None
+    items = []
+    messages = {}
+    for analysis_id, recipient, message_id, error, created_at, state, last_error, sent_at in rows:
+        state = state or 'skipped'
+        items.append({'analysis_id': analysis_id, 'recipient': recipient, 'message_id': message_id,
+                      'status': state, 'error': error or last_error})
+        if message_id:
+            messages[message_id] = (state, sent_at)
+    counts = {}
+    for state, _ in messages.values():
+        counts[state] = counts.get(state, 0) + 1
+    sent_times = [sent_at for state, sent_at in messages.values() if state == outbox.SENT]
+    started = datetime.fromisoformat(rows[0][4])
+    finished = all(state in (outbox.SENT, outbox.FAILED) for state, _ in messages.values())
+    # Until the last message was delivered if done, else until now
+    end = max(datetime.fromisoformat(t) for t in sent_times) if sent_times and finished else datetime.utcnow()
+    elapsed = max((end - started).total_seconds(), 1e-6)
+    return {
+        'batch_id': batch_id,
+        'done': finished,
+        'analyses': len(items),
+        'skipped': sum(1 for item in items if item['status'] == 'skipped'),
+        'messages': len(messages),
+        'message_status': counts,
+        'created_at': rows[0][4],
+        'elapsed_s': round(elapsed, 3),
+        'messages_per_sec': round(len(sent_times) / elapsed, 2),
+        'items': items,
+    }
+
+
+def wait(batch_id, timeout, database=None) -> dict | None:
+    """status() once every message is sent or failed, or after timeout seconds."""
+    deadline = time.monotonic() + timeout
+    while True:
+        report = status(batch_id, database)
+        if report is None or report['done'] or time.monotonic() >= deadline:
+            return report
+        time.sleep(0.1)
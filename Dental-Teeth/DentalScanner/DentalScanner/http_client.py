@@ -0,0 +1,138 @@
+"""Shared outbound HTTP client.
+
+Every outbound HTTP call (OpenAI chat completions, the Roboflow workflow,
+URL-typed images in workflow results) goes through one pooled
+``requests.Session`` per process instead of module-level ``requests.post`` /
+``requests.get``, so connections are kept alive and reused rather than paying
+a new TCP + TLS handshake per call.
+
+- One connection pool per host, up to HTTP_POOL_MAXSIZE keep-alive
+  connections each (HTTP_POOL_HOSTS hosts are cached).
+- HTTP/2 is used when urllib3's HTTP/2 support and the ``h2`` package are
+  installed (HTTP_HTTP2=auto, the default); set HTTP_HTTP2=false to force
+  HTTP/1.1.
+- Per-host counters of requests, new connections (handshakes) and reused
+  connections are kept; see stats() and /debug/http-stats.
+"""
+import logging
+import os
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+HTTP_POOL_HOSTS = int(os.environ.get('HTTP_POOL_HOSTS', '10'))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '8'))
+# "auto" (use HTTP/2 if available), "true" or "false"
+HTTP_HTTP2 = os.environ.get('HTTP_HTTP2', 'auto').strip().lower()
+
+log = logging.getLogger('dental.http_client')
+
+
+class _Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _host(self, host):
+        return self._hosts.setdefault(host, {'requests': 0, 'new_connections': 0})
+
+    def request(self, host):
+        with self._lock:
+            self._host(host)['requests'] += 1
+
+    def new_connection(self, host):
+        with self._lock:
+            self._host(host)['new_connections'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            hosts = {h: dict(v) for h, v in self._hosts.items()}
+        for v in hosts.values():
+            # Every request that didn't need a new connection reused a pooled one
+            v['reused_connections'] = max(0, v['requests'] - v['new_connections'])
+            v['reuse_ratio'] = round(v['reused_connections'] / v['requests'], 3) if v['requests'] else None
+        return hosts
+
+
+def _counting_pool(base, stats):
+    class CountingPool(base):
+        def _new_conn(self):
+            stats.new_connection(self.host)
+            return super()._new_conn()
+    CountingPool.__name__ = f'Counting{base.__name__}'
+    return CountingPool
+
+
+class _CountingAdapter(HTTPAdapter):
+    def __init__(self, stats, **kwargs):
+        self._stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _counting_pool(HTTPConnectionPool, self._stats),
+            'https': _counting_pool(HTTPSConnectionPool, self._stats),
+        }
+
+
+def _enable_http2():
+    """Switch urllib3 to HTTP/2 for HTTPS when supported. Returns True if enabled."""
+    if HTTP_HTTP2 in ('0', 'false', 'no'):
+        return False
+    try:
+        import h2  # noqa: F401
+        from urllib3.http2 import inject_into_urllib3
+    except ImportError:
+        if HTTP_HTTP2 in ('1', 'true', 'yes'):
+            log.warning('HTTP_HTTP2 is set but urllib3 HTTP/2 support or the h2 package is missing; using HTTP/1.1')
+        return False
+    inject_into_urllib3()
+    return True
+
+
+class HttpClient:
+    """Thin wrapper around a pooled Session that records per-host connection use."""
+
+    def __init__(self, pool_hosts=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_MAXSIZE):
+        self._stats = _Stats()
+        self.http2 = _enable_http2()
+        self.session = requests.Session()
+        adapter = _CountingAdapter(self._stats, pool_connections=pool_hosts, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        self._stats.request(urlsplit(url).hostname or '')
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def stats(self):
+        return {'http2': self.http2, 'hosts': self._stats.snapshot()}
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> HttpClient:
+    """The process-wide client (created on first use)."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
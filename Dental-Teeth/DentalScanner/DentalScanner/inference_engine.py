@@ -0,0 +1,198 @@
+"""In-process inference for server.py.
+
+Every upload used to start a fresh interpreter running ``main.py``, which
+re-imported ``inference_sdk`` and built a new ``InferenceHTTPClient`` before
+doing any real work. This module keeps one long-lived workflow client per
+Flask worker instead, talking to the serverless workflow endpoint over the
+shared keep-alive connection pool (http_client.py), with the workflow
+definition cached server-side (``use_cache``).
+
+The subprocess path is still available as a fallback by setting
+``INFERENCE_MODE=subprocess``.
+"""
+import base64
+import logging
+import os
+import subprocess
+import threading
+from pathlib import Path
+
+import requests
+
+import http_client
+import main as workflow
+import metrics
+
+APP_ROOT = Path(__file__).parent.resolve()
+
+# "inprocess" (default) or "subprocess" (legacy: run main.py per upload)
+INFERENCE_MODE = os.environ.get('INFERENCE_MODE', 'inprocess').strip().lower()
+INFERENCE_TIMEOUT = int(os.environ.get('INFERENCE_TIMEOUT', '120'))
+
+log = logging.getLogger('dental.inference')
+
+
+class InferenceError(Exception):
+    """Raised when the workflow run did not produce an annotated image."""
+
+
+class InferenceTimeout(InferenceError):
+    """Raised when the workflow run exceeded INFERENCE_TIMEOUT."""
+
+
+class WorkflowClient(workflow.Detector):
+    """Minimal client for the Roboflow serverless workflow endpoint.
+
+    Mirrors ``InferenceHTTPClient.run_workflow`` for the single-image case but
+    uses the shared HTTP client, so repeated calls skip the TCP/TLS handshake.
+    This is the server's "roboflow" detector backend.
+    """
+
+    name = 'roboflow'
+
+    def __init__(self, api_key: str, api_url: str = workflow.ROBOFLOW_API_URL):
+        self.api_key = api_key
+        self.api_url = api_url.rstrip('/')
+        self.http = http_client.get_client()
+
+    def run_workflow(self, image_path, workspace_name=workflow.WORKSPACE_NAME, workflow_id=workflow.WORKFLOW_ID, use_cache=True, timeout=INFERENCE_TIMEOUT):
+        with open(image_path, 'rb') as fh:
+            encoded = base64.b64encode(fh.read()).decode('ascii')
+        payload = {
+            'api_key': self.api_key,
+            'use_cache': use_cache,  # cache workflow definition server-side
+            'inputs': {'image': {'type': 'base64', 'value': encoded}},
+        }
+        url = f"{self.api_url}/{workspace_name}/workflows/{workflow_id}"
+        resp = self.http.post(url, json=payload, timeout=timeout)
+        resp.raise_for_status()
+        with metrics.timed('workflow_result_parse'):
+            return [_decode_output(o) for o in resp.json().get('outputs', [])]
+
+    def detect(self, image_path):
+        return self.run_workflow(str(image_path))
+
+    def warm_up(self):
+        """Open a keep-alive connection ahead of the first upload (best effort)."""
+        try:
+            self.http.head(self.api_url, timeout=5)
+        except requests.exceptions.RequestException:
+            pass
+
+
+def _decode_output(output):
+    # The SDK flattens {"type": "base64", "value": ...} image outputs into
+    # plain base64 strings; do the same so output_result.json keeps its shape.
+    if isinstance(output, dict):
+        if output.get('type') == 'base64' and 'value' in output:
+            return output['value']
+        return {k: _decode_output(v) for k, v in output.items()}
+    if isinstance(output, list):
+        return [_decode_output(v) for v in output]
+    return output
+
+
+class InferenceEngine:
+    """Holds the long-lived detector for this worker process.
+
+    DETECTOR_BACKEND (see main.py) picks the pooled serverless workflow client
+    or the local ONNX model (local_detector.py).
+    """
+
+    def __init__(self, backend=None):
+        self.backend = (backend or workflow.DETECTOR_BACKEND).strip().lower()
+        self._client = None
+        self._client_key = None
+        self._lock = threading.Lock()
+
+    def client(self) -> workflow.Detector:
+        if self.backend == 'local':
+            with self._lock:
+                if self._client is None:
+                    with metrics.timed('engine_startup'):
+                        from local_detector import LocalDetector
+                        self._client = LocalDetector()
+                return self._client
+        if self.backend != 'roboflow':
+            raise InferenceError(f'Unknown DETECTOR_BACKEND {self.backend!r}')
+        api_key = os.environ.get('ROBOFLOW_API_KEY')
+        if not api_key:
+            raise InferenceError('ROBOFLOW_API_KEY not set')
+        with self._lock:
+            # Rebuild only if the key changed (e.g. .env reloaded)
+            if self._client is None or self._client_key != api_key:
+                if self._client is not None:
+                    self._client.close()
+                with metrics.timed('engine_startup'):
+                    self._client = WorkflowClient(api_key)
+                self._client_key = api_key
+            return self._client
+
+    def warm_up(self):
+        try:
+            self.client().warm_up()
+        except Exception as e:
+            log.warning('detector warm-up failed', extra={'backend': self.backend, 'error': str(e)})
+
+    def analyze(self, image_path, out_path, result_path):
+        """Run detection on image_path and write the annotated image and JSON result.
+
+        Returns out_path. Raises InferenceError / InferenceTimeout on failure.
+        """
+        client = self.client()
+        try:
+            with metrics.timed('run_workflow'):
+                result = client.detect(image_path)
+        except requests.exceptions.Timeout as e:
+            raise InferenceTimeout('Processing timed out') from e
+        except Exception as e:
+            raise InferenceError(_redact(str(e), getattr(client, 'api_key', None))) from e
+
+        saved = workflow.save_workflow_outputs(result, out_path=str(out_path), result_path=str(result_path), open_viewer=False)
+        if not saved:
+            raise InferenceError('No output image produced')
+        return out_path
+
+
+def run_subprocess(image_path, out_path, result_path, python_exe, timeout=INFERENCE_TIMEOUT):
+    """Legacy path: run main.py in a fresh interpreter."""
+    python_exe = Path(python_exe)
+    if not python_exe.exists():
+        raise InferenceError(f'Venv python not found at {python_exe}. Activate the correct venv or create .venv311')
+    cmd = [str(python_exe), str(APP_ROOT / 'main.py'), str(image_path)]
+    env = os.environ.copy()
+    env['OUTPUT_IMAGE_PATH'] = str(out_path)
+    env['OUTPUT_RESULT_PATH'] = str(result_path)
+    try:
+        # Interpreter + SDK startup and the workflow run together; they can't be split from out here
+        with metrics.timed('subprocess_run'):
+            proc = subprocess.run(cmd, capture_output=True, text=True, env=env, timeout=timeout, cwd=str(APP_ROOT))
+    except subprocess.TimeoutExpired as e:
+        raise InferenceTimeout('Processing timed out') from e
+    if proc.returncode != 0:
+        metrics.error('subprocess_run')
+        raise InferenceError(proc.stderr[:500])
+    if not Path(out_path).exists():
+        raise InferenceError('No output image produced')
+    return out_path
+
+
+def _redact(text, secret):
+    return text.replace(secret, '<REDACTED_API_KEY>') if secret else text
+
+
+_engine = InferenceEngine()
+
+
+def get_engine() -> InferenceEngine:
+    return _engine
+
+
+def run_inference(image_path, out_path, result_path, python_exe=None):
+    """Write the annotated image to out_path and the workflow result to result_path.
+
+    Uses the in-process engine unless INFERENCE_MODE=subprocess.
+    """
+    if INFERENCE_MODE == 'subprocess':
+        return run_subprocess(image_path, out_path, result_path, python_exe)
+    return _engine.analyze(image_path, out_path, result_path)
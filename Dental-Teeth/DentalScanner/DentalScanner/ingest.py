@@ -0,0 +1,154 @@
+"""Streaming upload ingestion.
+
+Werkzeug normally spools an uploaded file into memory / a temp file and
+upload() then wrote it out again with ``file.save``. Here the multipart parser
+streams each chunk straight into a temp file in the uploads directory while
+we hash it and sniff the image header, so:
+
+- oversized bodies are rejected from Content-Length before anything is read
+  (MAX_CONTENT_LENGTH), and chunked bodies as soon as they cross the limit;
+- non-image payloads are rejected after the first few bytes;
+- the finished file is atomically renamed to a collision-free,
+  content-addressed storage key (``<sha256>.<ext>``) without another copy.
+"""
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', str(20 * 1024 * 1024)))
+# Allowance for the other multipart fields (concern text, boundaries)
+FORM_OVERHEAD_BYTES = 256 * 1024
+
+_SNIFF_BYTES = 12
+
+
+def sniff_image_type(header: bytes) -> str | None:
+    """Return a file extension for a known image signature, else None."""
+    if header.startswith(b'\xff\xd8\xff'):
+        return '.jpg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return '.png'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return '.gif'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return '.webp'
+    if header[:2] == b'BM':
+        return '.bmp'
+    if header[:4] in (b'II*\x00', b'MM\x00*'):
+        return '.tif'
+    if header[4:8] == b'ftyp' and header[8:12] in (b'heic', b'heix', b'mif1', b'msf1'):
+        return '.heic'
+    return None
+
+
+class HashingUploadFile:
+    """Writable sink handed to Werkzeug's multipart parser for each uploaded file.
+
+    Chunks go straight to a temp file next to their final location while the
+    SHA-256 is updated; commit() then renames the temp file into place.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int = MAX_UPLOAD_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        incoming = self.directory / '.incoming'
+        incoming.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=str(incoming), prefix='upload-', suffix='.part')
+        self.tmp_path = Path(tmp)
+        self._fh = os.fdopen(fd, 'w+b')
+        self._sha = hashlib.sha256()
+        self._head = b''
+        self.size = 0
+        self.ext = None
+        self.sha256 = None
+        self.path = None
+
+    # --- file protocol used by the multipart parser / FileStorage ---
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.discard()
+            raise RequestEntityTooLarge(f'Image exceeds the {self.max_bytes // 1024} KB upload limit')
+        if self.ext is None:
+            self._head += bytes(data[:_SNIFF_BYTES])
+            if len(self._head) >= _SNIFF_BYTES:
+                self._check_header()
+        self._sha.update(data)
+        return self._fh.write(data)
+
+    def read(self, *args):
+        return self._fh.read(*args)
+
+    def seek(self, *args):
+        return self._fh.seek(*args)
+
+    def tell(self):
+        return self._fh.tell()
+
+    def flush(self):
+        return self._fh.flush()
+
+    def close(self):
+        # Called when the request is torn down; drop anything never committed
+        if self.path is None:
+            self.discard()
+
+    # ---
+    def _check_header(self):
+        self.ext = sniff_image_type(self._head)
+        if self.ext is None:
+            self.discard()
+            raise UnsupportedMediaType('Uploaded file is not a supported image')
+
+    def discard(self):
+        try:
+            self._fh.close()
+        except Exception:
+            pass
+        try:
+            self.tmp_path.unlink()
+        except OSError:
+            pass
+
+    def commit(self) -> Path:
+        """Move the upload to <directory>/<sha256><ext> and return that path."""
+        if self.path is not None:
+            return self.path
+        if self.ext is None:
+            # Body shorter than the sniff window
+            self._check_header()
+        self._fh.flush()
+        self._fh.close()
+        self.sha256 = self._sha.hexdigest()
+        self.path = self.directory / f'{self.sha256}{self.ext}'
+        # Identical bytes map to the same key, so replacing is harmless
+        os.replace(self.tmp_path, self.path)
+        return self.path
+
+
+class StreamingUploadRequest(Request):
+    """Flask request class that streams file parts through HashingUploadFile."""
+
+    upload_dir: Path = Path('uploads')
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingUploadFile(self.upload_dir)
+
+
+def commit_upload(file_storage) -> tuple[Path, str]:
+    """Persist a FileStorage parsed by StreamingUploadRequest.
+
+    Returns (path, sha256). Raises RequestEntityTooLarge / UnsupportedMediaType.
+    """
+    stream = file_storage.stream
+    if not isinstance(stream, HashingUploadFile):
+        # Parsed by some other request class: copy through a sink to get the same checks
+        stream = HashingUploadFile(StreamingUploadRequest.upload_dir)
+        for chunk in iter(lambda: file_storage.stream.read(1024 * 1024), b''):
+            stream.write(chunk)
+    path = stream.commit()
+    return path, stream.sha256
@@ -0,0 +1,263 @@
+"""Bounded background job queue used by /upload.
+
+The Roboflow workflow run and the OpenAI summary can take well over a minute
+together, which used to hold a Flask request thread for the whole time. Jobs
+are now run by a fixed pool of worker threads fed from a bounded queue; the
+request handler only enqueues and returns a job ID that clients poll (or
+long-poll) via /jobs/<id>.
+
+Each job also keeps a list of timestamped stage events (queued, started,
+whatever the job function reports through record_event(), done/failed).
+They are returned with the job status so the upload page can show real
+progress, and every event is logged (log_stage) with its offset from the
+first event and from the previous one, for latency analysis.
+"""
+import contextvars
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+import applog
+import metrics
+
+# Number of jobs processed concurrently (each writes its own artifacts/<id>/)
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '4'))
+# Jobs waiting beyond this are rejected with 503 instead of piling up
+JOB_QUEUE_DEPTH = int(os.environ.get('JOB_QUEUE_DEPTH', '32'))
+# Finished jobs are forgotten after this many seconds
+JOB_RETENTION_SECONDS = int(os.environ.get('JOB_RETENTION_SECONDS', '3600'))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when JOB_QUEUE_DEPTH jobs are already waiting."""
+
+
+class JobFailed(Exception):
+    """Raise from a job function to fail it with a specific HTTP status."""
+
+    def __init__(self, message, http_status=500):
+        super().__init__(message)
+        self.http_status = http_status
+
+
+log = logging.getLogger('dental.jobs')
+
+_current = threading.local()
+
+
+def log_stage(job_id, events):
+    """Log the last of a job's stage events with its timing (t: since the first event, step: since the previous one)."""
+    event = events[-1]
+    prev = events[-2]['at'] if len(events) > 1 else event['at']
+    fields = {k: v for k, v in event.items() if k not in ('stage', 'at')}
+    log.info('stage', extra={'job_id': job_id, 'stage': event['stage'],
+                             't': round(event['at'] - events[0]['at'], 3), 'step': round(event['at'] - prev, 3),
+                             **fields})
+
+
+def record_event(stage, **info):
+    """Add a stage event to the job running on this thread (no-op outside a job)."""
+    job = getattr(_current, 'job', None)
+    if job is not None:
+        job.add_event(stage, **info)
+
+
+class Job:
+    def __init__(self, fn, args, kwargs, job_id=None, listener=None, events=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.http_status = None
+        self._fn = fn
+        self._args = args
+        self._kwargs = kwargs
+        self._listener = listener
+        self._done = threading.Event()
+        # Logging context (request ID) of the request that queued the job
+        self._context = contextvars.copy_context()
+        # Guards events; notified on every new event and when the job finishes
+        self._changed = threading.Condition()
+        self.events = []
+        for event in events or ():
+            self._append_event(**event)
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def wait(self, timeout=None):
+        """Block until the job finishes or timeout elapses. Returns True if finished."""
+        return self._done.wait(timeout)
+
+    def _append_event(self, stage, at=None, **info):
+        at = time.time() if at is None else at
+        with self._changed:
+            self.events.append({'stage': stage, 'at': at, **info})
+            events = list(self.events)
+            self._changed.notify_all()
+        log_stage(self.id, events)
+
+    def add_event(self, stage, at=None, **info):
+        """Record that the job reached stage (at: epoch seconds, default now)."""
+        self._append_event(stage, at, **info)
+        self.notify()
+
+    def wait_for_update(self, seen_events, timeout):
+        """Block until the job has more than seen_events events or has finished."""
+        with self._changed:
+            return self._changed.wait_for(lambda: self.finished or len(self.events) > seen_events, timeout)
+
+    def notify(self):
+        """Report the current state to the queue's listener (never raises)."""
+        if self._listener is None:
+            return
+        try:
+            self._listener(self)
+        except Exception as e:
+            log.error('job listener failed', extra={'job_id': self.id, 'error': str(e)})
+
+    def fail(self, message, http_status=500):
+        self.error = message
+        self.http_status = http_status
+        self.status = FAILED
+        self.finished_at = time.time()
+        self._append_event(FAILED, self.finished_at, error=message)
+        self.notify()
+        self._done.set()
+        with self._changed:
+            self._changed.notify_all()
+
+    def run(self):
+        # In a copy of the submitting request's context, so its logs share the request ID
+        self._context.run(self._run)
+
+    def _run(self):
+        with applog.bind(job_id=self.id):
+            self._run_job()
+
+    def _run_job(self):
+        self.status = RUNNING
+        self.started_at = time.time()
+        metrics.observe('queue_wait', self.started_at - self.created_at)
+        self._append_event('started', self.started_at)
+        self.notify()
+        _current.job = self
+        try:
+            self.result = self._fn(*self._args, **self._kwargs)
+            self.status = DONE
+        except JobFailed as e:
+            self.error = str(e)
+            self.http_status = e.http_status
+            self.status = FAILED
+        except Exception as e:
+            self.error = f'Processing failed: {str(e)[:500]}'
+            self.http_status = 500
+            self.status = FAILED
+        finally:
+            _current.job = None
+            self.finished_at = time.time()
+            metrics.observe('job_run', self.finished_at - self.started_at)
+            if self.status == FAILED:
+                metrics.error('job_run')
+            self._fn = self._args = self._kwargs = None
+            self._append_event(self.status, self.finished_at)
+            self.notify()
+            self._done.set()
+            with self._changed:
+                self._changed.notify_all()
+
+    def to_dict(self, include_result=False):
+        out = {
+            'job_id': self.id,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'error': self.error,
+            'http_status': self.http_status,
+            'events': list(self.events),
+        }
+        if include_result:
+            out['result'] = self.result
+        return out
+
+
+class JobQueue:
+    """Fixed worker pool over a bounded queue.
+
+    listener, if given, is called with the Job whenever it is queued, starts
+    or finishes (used to persist job state outside this process).
+    """
+
+    def __init__(self, workers=JOB_WORKERS, max_depth=JOB_QUEUE_DEPTH, retention=JOB_RETENTION_SECONDS, listener=None):
+        self.workers = max(1, workers)
+        self.retention = retention
+        self.listener = listener
+        self._queue = queue.Queue(maxsize=max(1, max_depth))
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _ensure_started(self):
+        # Threads are started lazily so importing server.py (e.g. from tools)
+        # doesn't spawn workers.
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f'job-worker-{i}', daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, fn, *args, job_id=None, events=None, **kwargs) -> Job:
+        """Queue fn(*args, **kwargs). events: earlier stage events ({'stage', 'at', ...}) to start the job's log with."""
+        self._ensure_started()
+        job = Job(fn, args, kwargs, job_id=job_id, listener=self.listener, events=events)
+        job._append_event(QUEUED, job.created_at)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        # Report "queued" before a worker can report "running"
+        job.notify()
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+            job.fail('Server busy, please retry shortly', http_status=503)
+            raise QueueFull(f'{self._queue.maxsize} jobs already queued')
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                job.run()
+            finally:
+                self._queue.task_done()
+
+    def _prune(self):
+        # Caller holds self._lock
+        cutoff = time.time() - self.retention
+        stale = [jid for jid, j in self._jobs.items() if j.finished and j.finished_at < cutoff]
+        for jid in stale:
+            del self._jobs[jid]
@@ -0,0 +1,150 @@
+"""Offline detection backend: an exported model run on CPU with onnxruntime.
+
+Selected with DETECTOR_BACKEND=local. It mirrors what the serverless
+small-object-detection-sahi workflow does: the image is cut into overlapping
+slices (plus one full-image pass for large objects) that are run through the
+model in batches, boxes are mapped back to image coordinates and merged with
+per-class NMS (see sahi.py), and an annotated copy is drawn. The result has the same shape as the
+workflow's (see main.Detector), so nothing downstream changes.
+
+The model is expected to be a YOLOv8-style ONNX export (Roboflow / Ultralytics):
+one float32 NCHW RGB input scaled to 0-1, and one output of shape
+(1, 4 + classes, anchors) with centre-x/centre-y/width/height in input pixels
+followed by per-class scores. Class names are read from the model's "names"
+metadata, or from LOCAL_MODEL_CLASSES (comma separated).
+"""
+import ast
+import base64
+import io
+import logging
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import onnxruntime as ort
+except Exception:
+    ort = None
+try:
+    from PIL import Image, ImageDraw, ImageOps
+except Exception:
+    Image = None
+
+import sahi
+from main import Detector
+
+APP_ROOT = Path(__file__).parent.resolve()
+LOCAL_MODEL_PATH = Path(os.environ.get('LOCAL_MODEL_PATH', APP_ROOT / 'models' / 'dental.onnx'))
+LOCAL_MODEL_CLASSES = os.environ.get('LOCAL_MODEL_CLASSES', '')
+LOCAL_CONFIDENCE = float(os.environ.get('LOCAL_CONFIDENCE', '0.4'))
+LOCAL_IOU_THRESHOLD = float(os.environ.get('LOCAL_IOU_THRESHOLD', '0.5'))
+# SAHI slicing: square slices of this many pixels, overlapping by this fraction
+LOCAL_SLICE_SIZE = int(os.environ.get('LOCAL_SLICE_SIZE', '640'))
+LOCAL_SLICE_OVERLAP = float(os.environ.get('LOCAL_SLICE_OVERLAP', '0.2'))
+# Slices sent to the model per call (fixed-batch exports use their own size)
+LOCAL_BATCH_SIZE = int(os.environ.get('LOCAL_BATCH_SIZE', '16'))
+# 0 lets onnxruntime pick (one thread per core)
+LOCAL_NUM_THREADS = int(os.environ.get('LOCAL_NUM_THREADS', '0'))
+
+log = logging.getLogger('dental.local_detector')
+
+
+class LocalDetector(Detector):
+    name = 'local'
+
+    def __init__(self, model_path=LOCAL_MODEL_PATH, confidence=LOCAL_CONFIDENCE, iou_threshold=LOCAL_IOU_THRESHOLD,
+                 slice_size=LOCAL_SLICE_SIZE, slice_overlap=LOCAL_SLICE_OVERLAP):
+        self.model_path = Path(model_path)
+        self.confidence = confidence
+        self.iou_threshold = iou_threshold
+        self.slice_size = slice_size
+        self.slice_overlap = slice_overlap
+        self.class_names = {}
+        self._session = None
+        self._input_name = None
+        self._input_size = None
+        self._batch_size = LOCAL_BATCH_SIZE
+        self._fixed_batch = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._session is not None:
+                return self._session
+            if ort is None:
+                raise RuntimeError('onnxruntime is not installed (pip install onnxruntime)')
+            if Image is None:
+                raise RuntimeError('Pillow is not installed (pip install pillow)')
+            if not self.model_path.exists():
+                raise FileNotFoundError(f'Local model not found at {self.model_path} (set LOCAL_MODEL_PATH)')
+            opts = ort.SessionOptions()
+            if LOCAL_NUM_THREADS > 0:
+                opts.intra_op_num_threads = LOCAL_NUM_THREADS
+            session = ort.InferenceSession(str(self.model_path), sess_options=opts, providers=['CPUExecutionProvider'])
+            inp = session.get_inputs()[0]
+            self._input_name = inp.name
+            # Fixed-size exports declare [N, 3, H, W]; dynamic ones get the slice size
+            fixed = [v for v in inp.shape[2:4] if isinstance(v, int)]
+            self._input_size = min(fixed) if fixed else self.slice_size
+            if isinstance(inp.shape[0], int):
+                # Every call must then have exactly that many tiles
+                self._batch_size = inp.shape[0]
+                self._fixed_batch = True
+            self.class_names = self._read_class_names(session)
+            self._session = session
+            return session
+
+    def _read_class_names(self, session):
+        if LOCAL_MODEL_CLASSES.strip():
+            return {i: n.strip() for i, n in enumerate(LOCAL_MODEL_CLASSES.split(','))}
+        try:
+            names = session.get_modelmeta().custom_metadata_map.get('names')
+            if names:
+                parsed = ast.literal_eval(names)
+                if isinstance(parsed, dict):
+                    return {int(k): str(v) for k, v in parsed.items()}
+                return dict(enumerate(parsed))
+        except Exception as e:
+            log.warning('could not read class names from model metadata', extra={'error': str(e)})
+        return {}
+
+    def warm_up(self):
+        self._load()
+
+    def detect(self, image_path):
+        session = self._load()
+        with Image.open(image_path) as src:
+            im = ImageOps.exif_transpose(src).convert('RGB')
+        width, height = im.size
+
+        boxes, scores, class_ids = sahi.sliced_predict(
+            np.asarray(im),
+            lambda blob: session.run(None, {self._input_name: blob})[0],
+            input_size=self._input_size,
+            slice_size=self.slice_size,
+            overlap=self.slice_overlap,
+            confidence=self.confidence,
+            iou_threshold=self.iou_threshold,
+            batch_size=self._batch_size,
+            pad_batches=self._fixed_batch,
+        )
+        predictions = sahi.to_predictions(boxes, scores, class_ids, self.class_names)
+        return [{
+            'output_image': _annotate(im, predictions),
+            'predictions': {'image': {'width': width, 'height': height}, 'predictions': predictions},
+        }]
+
+
+def _annotate(im, predictions):
+    """Base64 JPEG of im with the predicted boxes drawn on it."""
+    im = im.copy()
+    draw = ImageDraw.Draw(im)
+    for p in predictions:
+        x0, y0 = p['x'] - p['width'] / 2, p['y'] - p['height'] / 2
+        draw.rectangle((x0, y0, x0 + p['width'], y0 + p['height']), outline=(0, 200, 255), width=2)
+        draw.text((x0 + 2, y0 + 1), p['class'], fill=(0, 200, 255))
+    buf = io.BytesIO()
+    im.save(buf, 'JPEG', quality=90)
+    return base64.b64encode(buf.getvalue()).decode('ascii')
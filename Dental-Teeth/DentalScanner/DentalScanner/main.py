@@ -1,165 +1,343 @@
-import os
-import sys
-import re
-import base64
-import requests
-from io import BytesIO
-try:
-    from PIL import Image
-except Exception:
-    Image = None
-import json
-
-
-def _save_and_open_image_from_result(result, out_path="output.jpg"):
-    """Try to find an image in the result (url, data url, b64, bytes, or PIL Image), save it to out_path, and open it on Windows.
-    Returns out_path if saved, else None.
-    """
-    def find_image(obj):
-        if obj is None:
-            return None
-        # bytes
-        if isinstance(obj, (bytes, bytearray)):
-            return ("bytes", bytes(obj))
-        # Pillow image
-        try:
-            if Image is not None and isinstance(obj, Image.Image):
-                return ("pil", obj)
-        except Exception:
-            pass
-        # string -> url or data url or raw base64
-        if isinstance(obj, str):
-            if obj.startswith("http://") or obj.startswith("https://"):
-                return ("url", obj)
-            if obj.startswith("data:image/"):
-                return ("dataurl", obj)
-            # Heuristic: long base64 string
-            if len(obj) > 200 and re.fullmatch(r"[A-Za-z0-9+/=\n\r]+", obj[:1000]):
-                return ("b64", obj)
-        # dict/list -> search recursively
-        if isinstance(obj, dict):
-            for v in obj.values():
-                found = find_image(v)
-                if found:
-                    return found
-        if isinstance(obj, (list, tuple, set)):
-            for v in obj:
-                found = find_image(v)
-                if found:
-                    return found
-        return None
-
-    found = find_image(result)
-    if not found:
-        print("No image-like field found in result.")
-        return None
-
-    typ, data = found
-    try:
-        if typ == "url":
-            r = requests.get(data, timeout=30)
-            r.raise_for_status()
-            with open(out_path, "wb") as f:
-                f.write(r.content)
-        elif typ == "dataurl":
-            m = re.match(r"data:image/\w+;base64,(.+)", data)
-            b = base64.b64decode(m.group(1)) if m else base64.b64decode(data)
-            with open(out_path, "wb") as f:
-                f.write(b)
-        elif typ == "b64":
-            with open(out_path, "wb") as f:
-                f.write(base64.b64decode(data))
-        elif typ == "bytes":
-            with open(out_path, "wb") as f:
-                f.write(data)
-        elif typ == "pil":
-            data.save(out_path)
-        else:
-            print("Unhandled image type:", typ)
-            return None
-    except Exception as e:
-        print("Failed saving image:", e)
-        return None
-
-    # Try to open on Windows
-    try:
-        if os.name == 'nt':
-            os.startfile(out_path)
-        else:
-            # Fallback: print path for manual opening
-            print("Saved output image to:", out_path)
-    except Exception as e:
-        print("Saved to", out_path, "but couldn't open automatically:", e)
-    return out_path
-
-
-def main():
-    # Accept image path from env or first arg; default is placeholder
-    image_path = os.environ.get("IMAGE_PATH") or (sys.argv[1] if len(sys.argv) > 1 else "two.jpg")
-
-    # Read API key from environment for safety. Do NOT keep API keys in source.
-    api_key = os.environ.get("ROBOFLOW_API_KEY")
-
-    # Basic validation to avoid running heavy imports and network calls when inputs are missing
-    if image_path == "YOUR_IMAGE.jpg" or not os.path.isfile(image_path):
-        print("Image not provided or not found. Set IMAGE_PATH env var or pass an image path as the first argument.")
-        print(f"Tried: {image_path}")
-        return
-
-    if not api_key:
-        print("API key not found. Set ROBOFLOW_API_KEY in your environment.")
-        return
-
-    # Import the heavy SDK only after validation
-    try:
-        from inference_sdk import InferenceHTTPClient
-    except Exception as e:
-        print("Failed to import inference_sdk:", e)
-        return
-
-    client = InferenceHTTPClient(
-        api_url="https://serverless.roboflow.com",
-        api_key=api_key
-    )
-
-    try:
-        result = client.run_workflow(
-            workspace_name="dentalissuedetectorhackgt12",
-            workflow_id="small-object-detection-sahi",
-            images={
-                "image": image_path
-            },
-            use_cache=True  # cache workflow definition for 15 minutes
-        )
-
-        # Print a short summary of the result to avoid dumping large or sensitive data
-        print("Workflow run completed. Result type:", type(result))
-        if hasattr(result, 'keys'):
-            print("Result keys:", list(result.keys()))
-        else:
-            print(result)
-
-        # Attempt to save and open the first image found in the result (if any).
-        try:
-            saved = _save_and_open_image_from_result(result)
-            if saved:
-                print("Saved output image to:", saved)
-            # Also persist the structured workflow result so the web server can
-            # use detection details (classes, confidences, bounding boxes) when
-            # composing AI prompts. Save to output_result.json in the cwd.
-            try:
-                with open('output_result.json', 'w', encoding='utf-8') as jf:
-                    json.dump(result, jf, ensure_ascii=False, indent=2)
-                print('Saved workflow result to: output_result.json')
-            except Exception as _e:
-                print('Failed to save workflow result JSON:', _e)
-        except Exception as e:
-            print("Failed to save/open output image:", e)
-    except Exception as e:
-        # Redact API key if it appears in error messages
-        err = str(e).replace(api_key, "<REDACTED_API_KEY>")
-        print("Workflow invocation failed:", err)
-
-
-if __name__ == "__main__":
+import os
+import sys
+import re
+import base64
+from io import BytesIO
+try:
+    from PIL import Image
+except Exception:
+    Image = None
+import json
+import logging
+
+import http_client
+import metrics
+
+# Roboflow workflow settings, shared by the CLI below and the in-process
+# engine used by server.py (inference_engine.py).
+ROBOFLOW_API_URL = os.environ.get("ROBOFLOW_API_URL", "https://serverless.roboflow.com")
+WORKSPACE_NAME = os.environ.get("ROBOFLOW_WORKSPACE", "dentalissuedetectorhackgt12")
+WORKFLOW_ID = os.environ.get("ROBOFLOW_WORKFLOW_ID", "small-object-detection-sahi")
+# Which detector produces the result: "roboflow" (serverless workflow) or
+# "local" (exported ONNX model on CPU, no network; see local_detector.py)
+DETECTOR_BACKEND = os.environ.get("DETECTOR_BACKEND", "roboflow").strip().lower()
+
+log = logging.getLogger("dental.workflow")
+
+
+class Detector:
+    """Interface for detection backends.
+
+    detect() returns a result shaped like the serverless workflow output (what
+    output_result.json holds), so save_workflow_outputs() and the server don't
+    care which backend ran:
+
+        [{"output_image": <base64 annotated JPEG>,
+          "predictions": {"image": {"width": w, "height": h},
+                          "predictions": [{"x", "y", "width", "height", "confidence",
+                                           "class", "class_id", "detection_id", "parent_id"}, ...]}}]
+
+    x/y are box centres in pixels of the image that was sent.
+    """
+
+    name = "base"
+
+    def detect(self, image_path):
+        raise NotImplementedError
+
+    def warm_up(self):
+        """Optional: open connections / load the model ahead of the first image."""
+
+    def close(self):
+        pass
+
+
+class RoboflowDetector(Detector):
+    """Serverless workflow through the inference SDK (used by the CLI below)."""
+
+    name = "roboflow"
+
+    def __init__(self, api_key, api_url=ROBOFLOW_API_URL):
+        # Import the heavy SDK only when this backend is actually used
+        from inference_sdk import InferenceHTTPClient
+        self.api_key = api_key
+        self._client = InferenceHTTPClient(api_url=api_url, api_key=api_key)
+
+    def detect(self, image_path):
+        return self._client.run_workflow(
+            workspace_name=WORKSPACE_NAME,
+            workflow_id=WORKFLOW_ID,
+            images={
+                "image": str(image_path)
+            },
+            use_cache=True  # cache workflow definition for 15 minutes
+        )
+
+
+def create_detector(backend=None, api_key=None) -> Detector:
+    """Build the detector selected by DETECTOR_BACKEND (or backend)."""
+    backend = (backend or DETECTOR_BACKEND).strip().lower()
+    if backend == "local":
+        from local_detector import LocalDetector
+        return LocalDetector()
+    if backend == "roboflow":
+        return RoboflowDetector(api_key)
+    raise ValueError(f"Unknown DETECTOR_BACKEND {backend!r} (expected 'roboflow' or 'local')")
+
+
+# Known shape of a workflow result: a list with one output per input image,
+# each a dict holding the annotated image and the predictions block.
+OUTPUT_IMAGE_KEY = "output_image"
+PREDICTIONS_KEY = "predictions"
+# Base64 characters decoded per write (multiple of 4, so chunks split on whole quads)
+_B64_CHUNK = 64 * 1024
+
+
+def extract_outputs(result):
+    """Return (output_image, predictions) from a workflow result by their known keys.
+
+    Accepts the SDK's list of outputs, a single output dict, or the raw
+    {"outputs": [...]} response. Returns None if no output has an
+    output_image key, i.e. the schema is unknown.
+    """
+    outputs = result.get("outputs", result) if isinstance(result, dict) else result
+    if isinstance(outputs, dict):
+        outputs = [outputs]
+    if not isinstance(outputs, (list, tuple)):
+        return None
+    for out in outputs:
+        if isinstance(out, dict) and OUTPUT_IMAGE_KEY in out:
+            image = out[OUTPUT_IMAGE_KEY]
+            if isinstance(image, dict) and image.get("type") == "base64":
+                image = image.get("value")
+            return image, out.get(PREDICTIONS_KEY)
+    return None
+
+
+def _classify_image_value(value):
+    """(type, data) for a value already known to be the output image (no sniffing)."""
+    if isinstance(value, (bytes, bytearray)):
+        return ("bytes", bytes(value))
+    if Image is not None and isinstance(value, Image.Image):
+        return ("pil", value)
+    if isinstance(value, str) and value:
+        if value.startswith(("http://", "https://")):
+            return ("url", value)
+        if value.startswith("data:image/"):
+            return ("dataurl", value)
+        return ("b64", value)
+    return None
+
+
+def write_base64(text, out_path, start=0):
+    """Decode base64 text[start:] into out_path chunk by chunk.
+
+    Only one chunk of decoded bytes is held at a time instead of the whole image.
+    """
+    if "\n" in text or "\r" in text:
+        text = text[start:].replace("\n", "").replace("\r", "")
+        start = 0
+    with open(out_path, "wb") as f:
+        for i in range(start, len(text), _B64_CHUNK):
+            f.write(base64.b64decode(text[i:i + _B64_CHUNK]))
+
+
+def _save_and_open_image_from_result(result, out_path="output.jpg", open_viewer=True):
+    """Find the image in the result (url, data url, b64, bytes, or PIL Image), save it to out_path, and open it on Windows.
+
+    The workflow's output_image key is read directly; only results of an
+    unknown shape are walked looking for something image-like.
+    Returns out_path if saved, else None.
+    """
+    def find_image(obj):
+        if obj is None:
+            return None
+        # bytes
+        if isinstance(obj, (bytes, bytearray)):
+            return ("bytes", bytes(obj))
+        # Pillow image
+        try:
+            if Image is not None and isinstance(obj, Image.Image):
+                return ("pil", obj)
+        except Exception:
+            pass
+        # string -> url or data url or raw base64
+        if isinstance(obj, str):
+            if obj.startswith("http://") or obj.startswith("https://"):
+                return ("url", obj)
+            if obj.startswith("data:image/"):
+                return ("dataurl", obj)
+            # Heuristic: long base64 string
+            if len(obj) > 200 and re.fullmatch(r"[A-Za-z0-9+/=\n\r]+", obj[:1000]):
+                return ("b64", obj)
+        # dict/list -> search recursively
+        if isinstance(obj, dict):
+            for v in obj.values():
+                found = find_image(v)
+                if found:
+                    return found
+        if isinstance(obj, (list, tuple, set)):
+            for v in obj:
+                found = find_image(v)
+                if found:
+                    return found
+        return None
+
+    known = extract_outputs(result)
+    found = _classify_image_value(known[0]) if known else None
+    if not found:
+        # Unknown schema: fall back to walking the whole result
+        found = find_image(result)
+    if not found:
+        log.warning("No image-like field found in result.")
+        return None
+
+    typ, data = found
+    try:
+        if typ == "url":
+            with http_client.get_client().get(data, timeout=30, stream=True) as r:
+                r.raise_for_status()
+                with open(out_path, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=64 * 1024):
+                        f.write(chunk)
+        elif typ == "dataurl":
+            write_base64(data, out_path, start=data.index(",") + 1)
+        elif typ == "b64":
+            write_base64(data, out_path)
+        elif typ == "bytes":
+            with open(out_path, "wb") as f:
+                f.write(data)
+        elif typ == "pil":
+            data.save(out_path)
+        else:
+            log.warning("Unhandled image type", extra={"image_type": typ})
+            return None
+    except Exception as e:
+        log.error("Failed saving image", extra={"error": str(e)})
+        return None
+
+    # Try to open on Windows (never from inside the web server)
+    if not open_viewer:
+        return out_path
+    try:
+        if os.name == 'nt':
+            os.startfile(out_path)
+        else:
+            # Fallback: print path for manual opening
+            print("Saved output image to:", out_path)
+    except Exception as e:
+        print("Saved to", out_path, "but couldn't open automatically:", e)
+    return out_path
+
+
+# Fields kept per prediction in the compact detections file
+DETECTION_FIELDS = ("x", "y", "width", "height", "confidence", "class", "class_id")
+
+
+def compact_detections(predictions):
+    """Boxes, classes and confidences from a workflow "predictions" block, without any image data."""
+    predictions = predictions if isinstance(predictions, dict) else {}
+    compact = []
+    for p in predictions.get("predictions") or []:
+        if not isinstance(p, dict):
+            continue
+        row = {k: p[k] for k in DETECTION_FIELDS if k in p}
+        if isinstance(row.get("confidence"), float):
+            row["confidence"] = round(row["confidence"], 4)
+        compact.append(row)
+    return {"image": predictions.get("image") or {}, "predictions": compact}
+
+
+def load_detections(path):
+    """Read a detections file as {"image": {...}, "predictions": [...]}.
+
+    Also accepts a full workflow result (written before the compact format,
+    e.g. older cache entries). Returns None if neither shape is recognised.
+    """
+    with metrics.timed('detections_parse'), open(path, 'r', encoding='utf-8') as fh:
+        data = json.load(fh)
+    if isinstance(data, dict) and isinstance(data.get("predictions"), list):
+        return data
+    known = extract_outputs(data)
+    if known and isinstance(known[1], dict):
+        return compact_detections(known[1])
+    return None
+
+
+def save_workflow_outputs(result, out_path="output.jpg", result_path="output_result.json", open_viewer=True):
+    """Save the annotated image and the detections from a workflow result.
+
+    The image goes to out_path; result_path gets a compact JSON with only the
+    boxes, classes and confidences (see compact_detections), which is what the
+    web server reads when composing AI prompts. Results of an unknown shape
+    are written in full. Returns the saved image path, or None if the result
+    contained no image.
+    """
+    with metrics.timed('image_extract'):
+        saved = _save_and_open_image_from_result(result, out_path=out_path, open_viewer=open_viewer)
+    known = extract_outputs(result)
+    try:
+        with metrics.timed('detections_write'), open(result_path, 'w', encoding='utf-8') as jf:
+            if known:
+                json.dump(compact_detections(known[1]), jf, ensure_ascii=False, separators=(",", ":"))
+            else:
+                json.dump(result, jf, ensure_ascii=False, indent=2)
+        log.debug('Saved workflow result', extra={'result_path': str(result_path)})
+    except Exception as _e:
+        log.error('Failed to save workflow result JSON', extra={'error': str(_e)})
+    return saved
+
+
+def main():
+    # Accept image path from env or first arg; default is placeholder
+    image_path = os.environ.get("IMAGE_PATH") or (sys.argv[1] if len(sys.argv) > 1 else "two.jpg")
+    # Output locations; server.py points these into artifacts/<id>/ when it runs us as a subprocess
+    out_path = os.environ.get("OUTPUT_IMAGE_PATH", "output.jpg")
+    result_path = os.environ.get("OUTPUT_RESULT_PATH", "output_result.json")
+
+    # Read API key from environment for safety. Do NOT keep API keys in source.
+    api_key = os.environ.get("ROBOFLOW_API_KEY")
+
+    # Basic validation to avoid running heavy imports and network calls when inputs are missing
+    if image_path == "YOUR_IMAGE.jpg" or not os.path.isfile(image_path):
+        print("Image not provided or not found. Set IMAGE_PATH env var or pass an image path as the first argument.")
+        print(f"Tried: {image_path}")
+        return
+
+    if DETECTOR_BACKEND == "roboflow" and not api_key:
+        print("API key not found. Set ROBOFLOW_API_KEY in your environment.")
+        return
+
+    try:
+        detector = create_detector(api_key=api_key)
+    except Exception as e:
+        print(f"Failed to set up {DETECTOR_BACKEND} detector:", e)
+        return
+
+    try:
+        result = detector.detect(image_path)
+
+        # Print a short summary of the result to avoid dumping large or sensitive data
+        print("Workflow run completed. Result type:", type(result))
+        if hasattr(result, 'keys'):
+            print("Result keys:", list(result.keys()))
+        else:
+            print(result)
+
+        # Attempt to save and open the first image found in the result (if any).
+        try:
+            saved = save_workflow_outputs(result, out_path=out_path, result_path=result_path)
+            if saved:
+                print("Saved output image to:", saved)
+        except Exception as e:
+            print("Failed to save/open output image:", e)
+    except Exception as e:
+        # Redact API key if it appears in error messages
+        err = str(e).replace(api_key, "<REDACTED_API_KEY>") if api_key else str(e)
+        print("Workflow invocation failed:", err)
+    finally:
+        detector.close()
+
+
+if __name__ == "__main__":
     main()
\ No newline at end of file
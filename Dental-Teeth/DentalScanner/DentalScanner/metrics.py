@@ -0,0 +1,173 @@
+"""Per-stage latency histograms and counters, exposed on /metrics.
+
+Hot paths are wrapped in ``timed(stage)`` (a context manager that also works
+as a decorator); it records the duration into that stage's histogram and
+counts an error for the stage if the block raises. Other failures that don't
+raise (an HTTP error status, a False return) are counted with ``error()``,
+and cache lookups with ``cache(name, hit)``.
+
+render() produces the Prometheus text format:
+
+- dental_stage_duration_seconds (histogram): cumulative buckets, _sum and
+  _count per stage, for rate()/histogram_quantile() in Prometheus;
+- dental_stage_latency_seconds (summary): p50/p95/p99 per stage over the
+  last METRICS_WINDOW observations, for reading straight off the endpoint;
+- dental_stage_errors_total and dental_cache_requests_total counters.
+
+Metrics are kept per process; with several gunicorn workers each one
+reports its own numbers (scrape them individually or sum in Prometheus).
+No prometheus_client dependency: the format is simple enough to write here.
+"""
+import bisect
+import os
+import threading
+import time
+from collections import deque
+from contextlib import ContextDecorator
+
+# Observations per stage kept for the quantiles
+METRICS_WINDOW = int(os.environ.get('METRICS_WINDOW', '1024'))
+# Histogram bucket upper bounds in seconds (+Inf is implied)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+_PREFIX = 'dental'
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS, window=METRICS_WINDOW):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._recent = deque(maxlen=max(1, window))
+
+    def observe(self, seconds):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self._sum += seconds
+            self._count += 1
+            self._recent.append(seconds)
+
+    def snapshot(self):
+        """(cumulative bucket counts, sum, count, {quantile: value})"""
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+            recent = sorted(self._recent)
+        cumulative = []
+        running = 0
+        for c in counts:
+            running += c
+            cumulative.append(running)
+        quantiles = {}
+        if recent:
+            for q in QUANTILES:
+                quantiles[q] = recent[min(len(recent) - 1, int(q * len(recent)))]
+        return cumulative, total, count, quantiles
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._errors = {}
+        self._cache = {}
+
+    def histogram(self, stage) -> Histogram:
+        with self._lock:
+            h = self._stages.get(stage)
+            if h is None:
+                h = self._stages[stage] = Histogram()
+            return h
+
+    def observe(self, stage, seconds):
+        self.histogram(stage).observe(seconds)
+
+    def error(self, stage):
+        with self._lock:
+            self._errors[stage] = self._errors.get(stage, 0) + 1
+
+    def cache(self, name, hit):
+        key = (name, 'hit' if hit else 'miss')
+        with self._lock:
+            self._cache[key] = self._cache.get(key, 0) + 1
+
+    def render(self) -> str:
+        with self._lock:
+            stages = sorted(self._stages.items())
+            errors = sorted(self._errors.items())
+            cache = sorted(self._cache.items())
+        snaps = [(stage, h.snapshot()) for stage, h in stages]
+        lines = []
+
+        name = f'{_PREFIX}_stage_duration_seconds'
+        lines += [f'# HELP {name} Time spent in each pipeline stage.', f'# TYPE {name} histogram']
+        for stage, (cumulative, total, count, _) in snaps:
+            for bound, c in zip(BUCKETS, cumulative):
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {c}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {cumulative[-1]}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+
+        name = f'{_PREFIX}_stage_latency_seconds'
+        lines += [f'# HELP {name} Per-stage latency quantiles over the last {METRICS_WINDOW} observations.',
+                  f'# TYPE {name} summary']
+        for stage, (_, total, count, quantiles) in snaps:
+            for q, v in quantiles.items():
+                lines.append(f'{name}{{stage="{stage}",quantile="{q}"}} {v:.6f}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+
+        name = f'{_PREFIX}_stage_errors_total'
+        lines += [f'# HELP {name} Failures per pipeline stage.', f'# TYPE {name} counter']
+        lines += [f'{name}{{stage="{stage}"}} {n}' for stage, n in errors]
+
+        name = f'{_PREFIX}_cache_requests_total'
+        lines += [f'# HELP {name} Result cache lookups by cache and outcome.', f'# TYPE {name} counter']
+        lines += [f'{name}{{cache="{c}",result="{r}"}} {n}' for (c, r), n in cache]
+        return '\n'.join(lines) + '\n'
+
+
+class timed(ContextDecorator):
+    """Record the duration of a block (or function) as stage; count an error if it raises."""
+
+    def __init__(self, stage, registry=None):
+        self.stage = stage
+        self.registry = registry or REGISTRY
+        self._starts = threading.local()
+
+    def __enter__(self):
+        # Per-thread start stack, so one instance can decorate a function
+        # that runs concurrently (or recursively)
+        stack = getattr(self._starts, 'stack', None)
+        if stack is None:
+            stack = self._starts.stack = []
+        stack.append(time.perf_counter())
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.observe(self.stage, time.perf_counter() - self._starts.stack.pop())
+        if exc_type is not None:
+            self.registry.error(self.stage)
+        return False
+
+
+REGISTRY = Registry()
+
+
+def observe(stage, seconds):
+    REGISTRY.observe(stage, seconds)
+
+
+def error(stage):
+    REGISTRY.error(stage)
+
+
+def cache(name, hit):
+    REGISTRY.cache(name, hit)
+
+
+def render() -> str:
+    return REGISTRY.render()
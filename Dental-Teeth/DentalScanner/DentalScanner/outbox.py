@@ -0,0 +1,403 @@
+"""Email outbox: a durable queue delivered in the background over reused SMTP connections.
+
+send_email_smtp() used to run in the /send-to-doctor request thread: a new
+SMTP connection, STARTTLS and login for every message, with a 30s timeout
+the patient sat through. Instead:
+
+- enqueue() stores the message in the outbox table (migration 4 in db.py)
+  and returns its message_id once the row is committed, so the route
+  answers in milliseconds; status() (GET /outbox/<message_id>) reports
+  whether it has been delivered.
+- OUTBOX_WORKERS background threads deliver messages. Each keeps one
+  authenticated SMTP connection open between messages (SmtpSession), so
+  STARTTLS and login happen once per connection; it is reopened when the
+  server drops it, after an error, or after SMTP_IDLE_TIMEOUT idle seconds.
+- A worker claims up to OUTBOX_BATCH due messages at once (one group
+  commit), sends them back to back over its connection and records the
+  outcomes together.
+- Temporary failures (4xx replies, dropped connections, timeouts) are
+  retried with full-jitter exponential backoff (up to OUTBOX_RETRY_BASE **
+  attempt seconds, at most OUTBOX_RETRY_MAX) until OUTBOX_MAX_ATTEMPTS
+  attempts were made; 5xx replies fail the message right away.
+- A rejected SMTP login is a configuration problem, not the message's: the
+  message is put back with the longest retry wait, without counting the
+  attempt, and "SMTP login rejected" is logged as an error, until the
+  credentials are fixed. The rest of that batch is put back unsent.
+- A claim is a lease: the row stays "sending" for OUTBOX_LEASE seconds and
+  is due again afterwards, so messages claimed by a process that died are
+  delivered by another, and gunicorn workers can share the table. (If a
+  process dies after the server accepted a message but before the row was
+  updated, that message is sent twice.)
+
+Without SMTP_SERVER/SMTP_USER/SMTP_PASSWORD the worker saves messages to
+the local spool in outgoing_emails/ instead (local testing, see spool.py);
+tools/replay_spool.py sends them on once SMTP is set up.
+"""
+import json
+import logging
+import os
+import smtplib
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+from email.message import EmailMessage
+from email.utils import parseaddr
+from pathlib import Path
+
+import attachment_cache
+import db
+import metrics
+import spool
+from circuit_breaker import backoff_delay
+
+# Delivery threads per process, each with its own SMTP connection
+OUTBOX_WORKERS = int(os.environ.get('OUTBOX_WORKERS', '2'))
+# Messages a worker claims and sends in one go
+OUTBOX_BATCH = int(os.environ.get('OUTBOX_BATCH', '20'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '6'))
+OUTBOX_RETRY_BASE = float(os.environ.get('OUTBOX_RETRY_BASE', '4'))
+OUTBOX_RETRY_MAX = float(os.environ.get('OUTBOX_RETRY_MAX', '600'))
+# Idle workers look for due messages (retries, other processes' leftovers) this often
+OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', '5'))
+SMTP_TIMEOUT = float(os.environ.get('SMTP_TIMEOUT', '30'))
+SMTP_IDLE_TIMEOUT = float(os.environ.get('SMTP_IDLE_TIMEOUT', '60'))
+# Long enough for a whole batch to time out message by message
+OUTBOX_LEASE = float(os.environ.get('OUTBOX_LEASE', str(2 * OUTBOX_BATCH * SMTP_TIMEOUT)))
+
+QUEUED = 'queued'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+
+log = logging.getLogger('dental.outbox')
+
+_INSERT = """
+    INSERT INTO outbox (message_id, analysis_id, recipient, sender, reply_to, subject, body, attachments,
+                        status, next_attempt_at, created_at)
+    VALUES (?,?,?,?,?,?,?,?,?,?,?)
+"""
+# Queued messages and expired claims, oldest first
+_DUE = ("SELECT id FROM outbox WHERE status IN ('queued', 'sending') AND next_attempt_at <= ? "
+        "ORDER BY next_attempt_at LIMIT ?")
+# Matches nothing if another worker claimed the row since _DUE read it
+_CLAIM = """
+    UPDATE outbox SET status = 'sending', attempts = attempts + 1, next_attempt_at = ?
+    WHERE id = ? AND status IN ('queued', 'sending') AND next_attempt_at <= ?
+    RETURNING id, message_id, recipient, sender, reply_to, subject, body, attachments, attempts, created_at
+"""
+_CLAIM_COLUMNS = ('id', 'message_id', 'recipient', 'sender', 'reply_to', 'subject', 'body', 'attachments',
+                  'attempts', 'created_at')
+_SENT = "UPDATE outbox SET status = 'sent', detail = ?, last_error = NULL, sent_at = ? WHERE id = ?"
+_RETRY = "UPDATE outbox SET status = 'queued', next_attempt_at = ?, last_error = ? WHERE id = ?"
+# Put back without counting the attempt the claim added
+_HOLD = "UPDATE outbox SET status = 'queued', attempts = attempts - 1, next_attempt_at = ?, last_error = ? WHERE id = ?"
+_FAILED = "UPDATE outbox SET status = 'failed', last_error = ? WHERE id = ?"
+
+STATUS_COLUMNS = ('message_id', 'analysis_id', 'status', 'attempts', 'next_attempt_at', 'last_error', 'detail',
+                  'created_at', 'sent_at')
+_STATUS = f"SELECT {', '.join(STATUS_COLUMNS)} FROM outbox WHERE message_id = ?"
+
+
+def _now():
+    return datetime.utcnow().isoformat()
+
+
+def smtp_settings() -> dict | None:
+    """SMTP settings from the environment, or None if the server or credentials are missing."""
+    server, user, password = (os.environ.get(k) for k in ('SMTP_SERVER', 'SMTP_USER', 'SMTP_PASSWORD'))
+    if not server or not user or not password:
+        return None
+    return {
+        'server': server,
+        'port': int(os.environ.get('SMTP_PORT', '587')),
+        'user': user,
+        'password': password,
+        'use_tls': os.environ.get('SMTP_USE_TLS', 'true').lower() not in ('0', 'false', 'no'),
+    }
+
+
+def random_from_address() -> str:
+    """A random local part at the domain of SMTP_FROM / SMTP_USER (or SMTP_FROM_DOMAIN, or example.com)."""
+    user = os.environ.get('SMTP_USER')
+    domain = None
+    for src in (os.environ.get('SMTP_FROM', user), user):
+        if src and '@' in src:
+            domain = src.split('@', 1)[1]
+            break
+    return f"{uuid.uuid4().hex[:12]}@{domain or os.environ.get('SMTP_FROM_DOMAIN', 'example.com')}"
+
+
+def _attachment_entry(p):
+    return [str(p[0]), p[1]] if isinstance(p, (list, tuple)) else str(p)
+
+
+def _attachments(item):
+    """(path, file name) per attachment; entries are a path or [path, name to attach it as]."""
+    for entry in json.loads(item['attachments']):
+        path, name = (entry, None) if isinstance(entry, str) else entry
+        yield Path(path), name or Path(path).name
+
+
+def compose(item) -> EmailMessage:
+    """The EmailMessage for a claimed outbox row; attachments that are gone or unreadable are left out."""
+    msg = EmailMessage()
+    msg['From'] = item['sender'] or os.environ.get('SMTP_FROM', os.environ.get('SMTP_USER'))
+    # Replies go to the patient, if given
+    if item['reply_to']:
+        msg['Reply-To'] = item['reply_to']
+    msg['To'] = item['recipient']
+    msg['Subject'] = item['subject']
+    msg.set_content(item['body'])
+    cache = attachment_cache.get_cache()
+    for path, name in _attachments(item):
+        try:
+            if not path.exists():
+                continue
+            # Encoded once per file content (and downsized if configured), see attachment_cache.py
+            part = cache.part(path, name)
+        except OSError as e:
+            log.warning('attachment failed', extra={'attachment': name, 'error': str(e)})
+            continue
+        if not msg.is_multipart():
+            msg.make_mixed()
+            # Set rather than left to the generator, which would scan the whole message
+            # for a clash; "=_" never occurs in base64 or quoted-printable text
+            msg.set_boundary(f'=_{uuid.uuid4().hex}')
+        msg.attach(part)
+    return msg
+
+
+def save_locally(item) -> str:
+    """Spool the message and its attachments under outgoing_emails/ (no SMTP configured), see spool.py."""
+    box = spool.get_spool()
+    box.put(item, [(path, name) for path, name in _attachments(item) if path.exists()])
+    # Where and why only in the log: the detail is served by the unauthenticated GET /outbox/<id>
+    missing = [k for k in ('SMTP_SERVER', 'SMTP_USER', 'SMTP_PASSWORD') if not os.environ.get(k)]
+    log.warning('SMTP not configured, email saved to the local spool',
+                extra={'message_id': item['message_id'], 'spool': str(box.root), 'missing': missing})
+    return 'Saved to the local spool'
+
+
+def is_permanent(exc) -> bool:
+    """5xx replies (unknown recipient, rejected message) won't succeed on retry; anything else might."""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPAuthenticationError):
+        # Wrong credentials are a configuration problem: _deliver() holds the messages until it is fixed
+        return False
+    return isinstance(exc, smtplib.SMTPResponseException) and exc.smtp_code >= 500
+
+
+class SmtpSession:
+    """One authenticated SMTP connection, reused for consecutive messages."""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self._smtp = None
+        self._last_used = 0.0
+
+    def _connect(self):
+        s = self.settings
+        log.debug('smtp connect', extra={'smtp_server': s['server'], 'smtp_port': s['port'], 'use_tls': s['use_tls']})
+        with metrics.timed('smtp_connect'):
+            smtp = smtplib.SMTP(s['server'], s['port'], timeout=SMTP_TIMEOUT)
+            try:
+                if s['use_tls']:
+                    smtp.starttls()
+                smtp.login(s['user'], s['password'])
+            except BaseException:
+                smtp.close()
+                raise
+        self._smtp = smtp
+
+    def send(self, msg):
+        # What send_message() does, flattened by attachment_cache (cached attachment bodies aren't re-split)
+        from_addr, to_addrs = parseaddr(msg['From'])[1], [parseaddr(msg['To'])[1]]
+        international = not ''.join([from_addr, *to_addrs]).isascii()
+        data = attachment_cache.to_bytes(msg, utf8=international)
+        options = ('SMTPUTF8', 'BODY=8BITMIME') if international else ()
+        self.close_if_idle()
+        fresh = self._smtp is None
+        if fresh:
+            self._connect()
+        try:
+            self._smtp.sendmail(from_addr, to_addrs, data, options)
+        except smtplib.SMTPServerDisconnected:
+            self.close()
+            if fresh:
+                raise
+            # The server dropped a connection we had kept open: once more on a new one
+            self._connect()
+            self._smtp.sendmail(from_addr, to_addrs, data, options)
+        self._last_used = time.monotonic()
+
+    def close_if_idle(self):
+        # Servers drop idle connections; closing ours first avoids a failed send
+        if self._smtp is not None and time.monotonic() - self._last_used > SMTP_IDLE_TIMEOUT:
+            self.close()
+
+    def close(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (OSError, smtplib.SMTPException):
+            self._smtp.close()
+        self._smtp = None
+
+
+class Outbox:
+    def __init__(self, database=None, workers=OUTBOX_WORKERS, batch=OUTBOX_BATCH):
+        self.database = database
+        self.workers = max(1, workers)
+        self.batch = max(1, batch)
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+
+    def _db(self):
+        return self.database or db.get_db()
+
+    def ensure_started(self):
+        # Started lazily so importing server.py (e.g. from tools) doesn't spawn
+        # workers; threads don't survive a fork, so a forked process starts its own
+        with self._lock:
+            if self._threads and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._threads = [threading.Thread(target=self._worker, name=f'outbox-{i}', daemon=True)
+                             for i in range(self.workers)]
+            for t in self._threads:
+                t.start()
+
+    def enqueue(self, recipient, subject, body, attachments=(), reply_to=None, sender=None, analysis_id=None) -> str:
+        """Store a message for delivery and wake a worker. Returns its message_id.
+
+        attachments: file paths, or [path, name] to attach a file under another name.
+        """
+        return self.enqueue_many([{
+            'recipient': recipient, 'subject': subject, 'body': body, 'attachments': attachments,
+            'reply_to': reply_to, 'sender': sender, 'analysis_id': analysis_id,
+        }])[0]
+
+    def enqueue_many(self, messages) -> list[str]:
+        """Store several messages (dicts of enqueue()'s arguments) in one commit. Returns their message_ids."""
+        now, created = time.time(), _now()
+        message_ids = [uuid.uuid4().hex for _ in messages]
+        futures = [self._db().submit(_INSERT, (
+            message_id, m.get('analysis_id'), m['recipient'], m.get('sender'), m.get('reply_to'), m['subject'],
+            m['body'], json.dumps([_attachment_entry(p) for p in m.get('attachments', ())]),
+            QUEUED, now, created)) for message_id, m in zip(message_ids, messages)]
+        for future in futures:
+            future.result()
+        self.ensure_started()
+        self._wake.set()
+        return message_ids
+
+    def status(self, message_id) -> dict | None:
+        values = self._db().query_one(_STATUS, (message_id,))
+        if values is None:
+            return None
+        row = dict(zip(STATUS_COLUMNS, values))
+        # Only meaningful while waiting for a retry (for "sending" it is the lease)
+        due = row.pop('next_attempt_at')
+        row['next_attempt_at'] = (datetime.utcfromtimestamp(due).isoformat()
+                                  if row['status'] == QUEUED and (row['attempts'] or row['last_error']) else None)
+        return row
+
+    def _claim(self) -> list[dict]:
+        now = time.time()
+        ids = [r[0] for r in self._db().query(_DUE, (now, self.batch))]
+        # Submitted together, so the claims share one commit
+        futures = [self._db().submit(_CLAIM, (now + OUTBOX_LEASE, i, now)) for i in ids]
+        rows = [f.result() for f in futures]
+        return [dict(zip(_CLAIM_COLUMNS, r)) for r in rows if r is not None]
+
+    def _worker(self):
+        session = None
+        while True:
+            try:
+                batch = self._claim()
+            except Exception:
+                log.exception('outbox claim failed')
+                batch = []
+            if not batch:
+                if session is not None:
+                    session.close_if_idle()
+                self._wake.wait(OUTBOX_POLL_INTERVAL)
+                self._wake.clear()
+                continue
+            settings = smtp_settings()
+            if session is not None and session.settings != settings:
+                session.close()
+                session = None
+            if session is None and settings is not None:
+                session = SmtpSession(settings)
+            futures, login_error = [], None
+            for item in batch:
+                if login_error is None:
+                    sql, params = self._deliver(session, item)
+                    if sql is _HOLD:
+                        login_error = params[1]
+                else:
+                    # Don't log in again (and again) with credentials just rejected
+                    sql, params = _hold(item, login_error)
+                futures.append(self._db().submit(sql, params))
+            for future in futures:
+                try:
+                    future.result()
+                except sqlite3.Error:
+                    # The claim expires and the message is sent again
+                    log.exception('recording outbox delivery failed')
+
+    def _deliver(self, session, item):
+        """Send one claimed message; returns the (sql, params) recording the outcome."""
+        try:
+            if session is None:
+                detail = save_locally(item)
+            else:
+                with metrics.timed('smtp_send'):
+                    session.send(compose(item))
+                detail = 'Email sent'
+        except Exception as e:
+            if session is not None and not isinstance(e, smtplib.SMTPResponseException):
+                # Timeout or dropped connection: its state is unknown
+                session.close()
+            if isinstance(e, smtplib.SMTPAuthenticationError):
+                log.error('SMTP login rejected, email held until the credentials are fixed',
+                          extra={'message_id': item['message_id'], 'error': str(e)})
+                return _hold(item, str(e))
+            fields = {'message_id': item['message_id'], 'attempts': item['attempts'], 'error': str(e)}
+            if is_permanent(e) or item['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+                log.error('email failed', extra=fields)
+                return _FAILED, (str(e), item['id'])
+            delay = backoff_delay(item['attempts'], base=OUTBOX_RETRY_BASE, cap=OUTBOX_RETRY_MAX)
+            log.warning('email send failed, will retry', extra={**fields, 'retry_in_s': round(delay, 1)})
+            return _RETRY, (time.time() + delay, str(e), item['id'])
+        queued_for = (datetime.utcnow() - datetime.fromisoformat(item['created_at'])).total_seconds()
+        metrics.observe('outbox_delivery', queued_for)
+        log.info('email sent', extra={'message_id': item['message_id'], 'attempts': item['attempts'],
+                                      'queued_ms': round(queued_for * 1000, 1)})
+        return _SENT, (detail, _now(), item['id'])
+
+
+def _hold(item, error):
+    """The (sql, params) putting a claimed message back with the longest retry wait, its attempt uncounted."""
+    delay = backoff_delay(OUTBOX_MAX_ATTEMPTS, base=OUTBOX_RETRY_BASE, cap=OUTBOX_RETRY_MAX)
+    return _HOLD, (time.time() + delay, error, item['id'])
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox() -> Outbox:
+    """The process-wide outbox (created on first use)."""
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = Outbox()
+        return _outbox
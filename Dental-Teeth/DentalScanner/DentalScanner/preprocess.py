@@ -0,0 +1,74 @@
+"""Image normalization before inference.
+
+Phone cameras produce 12-48MP JPEGs, often stored sideways with an EXIF
+orientation tag. Sending those as-is to the serverless workflow costs upload
+bandwidth and latency, and the SAHI workflow slices the image anyway, so
+resolution beyond PREPROCESS_MAX_EDGE adds little. normalize_image():
+
+- applies the EXIF orientation to the pixels (and drops the tag),
+- downsizes so the longest edge is at most PREPROCESS_MAX_EDGE,
+- re-encodes as JPEG at PREPROCESS_JPEG_QUALITY.
+
+The original upload stays untouched in uploads/ for records; the normalized
+copy is written to artifacts/<id>/normalized.jpg and is what gets sent on.
+Without Pillow installed, images are passed through unchanged.
+"""
+import logging
+import os
+from pathlib import Path
+
+try:
+    from PIL import Image, ImageOps
+except Exception:
+    Image = None
+    ImageOps = None
+
+# Set PREPROCESS_ENABLED=false to send original uploads to the workflow
+PREPROCESS_ENABLED = os.environ.get('PREPROCESS_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+PREPROCESS_MAX_EDGE = int(os.environ.get('PREPROCESS_MAX_EDGE', '2048'))
+PREPROCESS_JPEG_QUALITY = int(os.environ.get('PREPROCESS_JPEG_QUALITY', '85'))
+
+_EXIF_ORIENTATION = 0x0112
+
+log = logging.getLogger('dental.preprocess')
+
+
+def available() -> bool:
+    return Image is not None
+
+
+def settings_key() -> str:
+    """Short description of the active settings, for cache keys."""
+    if not (PREPROCESS_ENABLED and available()):
+        return 'original'
+    return f'edge{PREPROCESS_MAX_EDGE}-q{PREPROCESS_JPEG_QUALITY}'
+
+
+def normalize_image(src, dest, max_edge=PREPROCESS_MAX_EDGE, quality=PREPROCESS_JPEG_QUALITY) -> Path:
+    """Write an oriented, downsized JPEG of src to dest.
+
+    Returns the path to send to inference: dest, or src itself when the image
+    is already a small, upright JPEG (re-encoding it would only lose quality)
+    or when it can't be normalized.
+    """
+    src = Path(src)
+    if Image is None:
+        return src
+    try:
+        with Image.open(src) as im:
+            orientation = im.getexif().get(_EXIF_ORIENTATION, 1)
+            if im.format == 'JPEG' and orientation == 1 and max(im.size) <= max_edge:
+                return src
+            # Let the JPEG decoder downscale by a power of two first; much
+            # cheaper than decoding all 48MP and resizing afterwards.
+            im.draft('RGB', (max_edge, max_edge))
+            out = ImageOps.exif_transpose(im)
+            if out.mode != 'RGB':
+                out = out.convert('RGB')
+            out.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            dest = Path(dest)
+            out.save(dest, 'JPEG', quality=quality, optimize=True)
+    except Exception as e:
+        log.warning('image normalization failed, sending original', extra={'image': src.name, 'error': str(e)})
+        return src
+    return dest
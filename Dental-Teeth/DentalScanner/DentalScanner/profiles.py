@@ -0,0 +1,75 @@
+"""Patient profiles: upsert from the landing page and indexed lookups.
+
+A patient is identified by patient_email + last_name + first_name + dob,
+compared case-insensitively; saving the landing page again updates that
+row (provider, doctor_email, updated_at) instead of adding a duplicate.
+
+Every lookup is answered from an index created by migration 2 in db.py,
+using the same COLLATE NOCASE comparisons so SQLite can use it:
+
+- by patient email:            profiles_identity (its leading column)
+- by last name, first name, dob: profiles_name_dob
+- by doctor email / provider:    profiles_doctor / profiles_provider
+
+Lists are paged by key rather than OFFSET: a page is the next `limit` rows
+with id > `after`, and each page returns the `after` for the next one. An
+index on a column also holds the rowid, so a page is one range scan no
+matter how deep it is.
+"""
+from datetime import datetime
+
+import db
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+COLUMNS = ('id', 'first_name', 'last_name', 'provider', 'dob', 'patient_email', 'doctor_email',
+           'created_at', 'updated_at')
+
+UPSERT_SQL = """
+    INSERT INTO profiles (first_name, last_name, provider, dob, patient_email, doctor_email, created_at, updated_at)
+    VALUES (?,?,?,?,?,?,?,?)
+    ON CONFLICT (patient_email COLLATE NOCASE, last_name COLLATE NOCASE, first_name COLLATE NOCASE, dob)
+    DO UPDATE SET provider = excluded.provider, doctor_email = excluded.doctor_email, updated_at = excluded.updated_at
+    RETURNING id
+"""
+
+_SELECT = f"SELECT {', '.join(COLUMNS)} FROM profiles"
+_BY_EMAIL = f"{_SELECT} WHERE patient_email = ? COLLATE NOCASE AND id > ? ORDER BY id LIMIT ?"
+_BY_NAME = (f"{_SELECT} WHERE last_name = ? COLLATE NOCASE AND first_name = ? COLLATE NOCASE AND dob = ? "
+            f"AND id > ? ORDER BY id LIMIT ?")
+_BY_DOCTOR = f"{_SELECT} WHERE doctor_email = ? COLLATE NOCASE AND id > ? ORDER BY id LIMIT ?"
+_BY_PROVIDER = f"{_SELECT} WHERE provider = ? COLLATE NOCASE AND id > ? ORDER BY id LIMIT ?"
+
+
+def upsert(first_name, last_name, provider, dob, patient_email, doctor_email, database=None) -> int:
+    """Insert or update the patient's profile; returns its id."""
+    now = datetime.utcnow().isoformat()
+    row = (database or db.get_db()).write(
+        UPSERT_SQL, (first_name, last_name, provider, dob, patient_email, doctor_email, now, now))
+    return row[0]
+
+
+def _page(sql, params, after, limit, database):
+    """(rows as dicts, `after` for the next page or None)"""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    # One extra row tells whether there is a next page
+    rows = (database or db.get_db()).query(sql, (*params, after, limit + 1))
+    page = [dict(zip(COLUMNS, r)) for r in rows[:limit]]
+    return page, (page[-1]['id'] if len(rows) > limit else None)
+
+
+def find_by_email(patient_email, after=0, limit=PAGE_SIZE, database=None):
+    return _page(_BY_EMAIL, (patient_email,), after, limit, database)
+
+
+def find_by_name(last_name, first_name, dob, after=0, limit=PAGE_SIZE, database=None):
+    return _page(_BY_NAME, (last_name, first_name, dob), after, limit, database)
+
+
+def list_by_doctor(doctor_email, after=0, limit=PAGE_SIZE, database=None):
+    return _page(_BY_DOCTOR, (doctor_email,), after, limit, database)
+
+
+def list_by_provider(provider, after=0, limit=PAGE_SIZE, database=None):
+    return _page(_BY_PROVIDER, (provider,), after, limit, database)
@@ -0,0 +1,207 @@
+"""Content-addressed cache of workflow results and AI summaries.
+
+Patients often re-upload the exact same photo. Entries are keyed by the
+SHA-256 of the uploaded bytes plus the workspace/workflow that produced them,
+so a repeat upload skips the Roboflow run entirely:
+
+    cache/<key>/annotated.jpg
+    cache/<key>/detections.json
+    cache/<key>/summary-<summary_key>.txt
+
+Summaries also depend on the prompt (model, PROMPT_VERSION, filename and the
+patient's concern text), so they are stored per summary key inside the entry.
+
+The cache is bounded by total size (LRU eviction) and by age (TTL). Recency
+is tracked in memory and mirrored to the entry's mtime so it survives
+restarts and is shared by workers using the same directory.
+"""
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+APP_ROOT = Path(__file__).parent.resolve()
+RESULT_CACHE_DIR = Path(os.environ.get('RESULT_CACHE_DIR', APP_ROOT / 'cache'))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', str(7 * 24 * 3600)))
+# Set RESULT_CACHE_ENABLED=false to always run the workflow
+RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+
+ANNOTATED_NAME = 'annotated.jpg'
+DETECTIONS_NAME = 'detections.json'
+
+
+def sha256_file(path, chunk_size=1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def make_key(*parts) -> str:
+    """Stable hex key for a tuple of strings."""
+    h = hashlib.sha256()
+    for p in parts:
+        h.update(str(p).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def _dir_size(path: Path) -> int:
+    total = 0
+    for p in path.iterdir():
+        try:
+            total += p.stat().st_size
+        except OSError:
+            pass
+    return total
+
+
+def _link_or_copy(src: Path, dst: Path):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class ResultCache:
+    def __init__(self, root=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES, ttl=RESULT_CACHE_TTL):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> size in bytes; order is least- to most-recently used
+        self._index = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._load_index()
+
+    def _load_index(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for d in self.root.iterdir():
+            if d.is_dir() and not d.name.startswith('.'):
+                try:
+                    entries.append((d.stat().st_mtime, d.name, _dir_size(d)))
+                except OSError:
+                    pass
+        for _mtime, key, size in sorted(entries):
+            self._index[key] = size
+            self._bytes += size
+
+    def _entry(self, key) -> Path:
+        return self.root / key
+
+    def _fresh(self, entry: Path) -> bool:
+        try:
+            return (time.time() - entry.stat().st_mtime) < self.ttl
+        except OSError:
+            return False
+
+    def lookup(self, key):
+        """Entry directory for key if it holds a fresh result, else None."""
+        entry = self._entry(key)
+        ok = (entry / ANNOTATED_NAME).exists() and (entry / DETECTIONS_NAME).exists() and self._fresh(entry)
+        with self._lock:
+            if not ok:
+                self.misses += 1
+                if key in self._index and entry.exists():
+                    self._remove_locked(key)
+                return None
+            self.hits += 1
+            if key not in self._index:
+                # Stored by another worker process
+                self._index[key] = _dir_size(entry)
+                self._bytes += self._index[key]
+            self._index.move_to_end(key)
+        try:
+            # Refresh recency for restarts and other workers. This also extends
+            # the TTL, which is fine: results for identical bytes don't change.
+            os.utime(entry)
+        except OSError:
+            pass
+        return entry
+
+    def store(self, key, annotated_path, detections_path):
+        """Copy a finished workflow result into the cache."""
+        entry = self._entry(key)
+        if entry.exists():
+            return entry
+        tmp = self.root / f'.tmp-{uuid.uuid4().hex}'
+        tmp.mkdir(parents=True)
+        try:
+            _link_or_copy(Path(annotated_path), tmp / ANNOTATED_NAME)
+            _link_or_copy(Path(detections_path), tmp / DETECTIONS_NAME)
+            os.rename(tmp, entry)
+        except OSError:
+            # Lost a race with another worker storing the same key, or disk trouble
+            shutil.rmtree(tmp, ignore_errors=True)
+            return entry if entry.exists() else None
+        with self._lock:
+            size = _dir_size(entry)
+            self._index[key] = size
+            self._bytes += size
+            self._evict_locked()
+        return entry
+
+    def materialize(self, key, dest_dir):
+        """Hard-link (or copy) a cached result into dest_dir. Returns False if it vanished."""
+        entry = self._entry(key)
+        dest_dir = Path(dest_dir)
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            _link_or_copy(entry / ANNOTATED_NAME, dest_dir / ANNOTATED_NAME)
+            _link_or_copy(entry / DETECTIONS_NAME, dest_dir / DETECTIONS_NAME)
+        except OSError:
+            return False
+        return True
+
+    def get_summary(self, key, summary_key):
+        try:
+            with open(self._entry(key) / f'summary-{summary_key}.txt', 'r', encoding='utf-8') as fh:
+                return fh.read()
+        except OSError:
+            return None
+
+    def put_summary(self, key, summary_key, text):
+        entry = self._entry(key)
+        if not entry.exists():
+            return
+        path = entry / f'summary-{summary_key}.txt'
+        tmp = entry / f'.summary-{uuid.uuid4().hex}.tmp'
+        try:
+            # A rewritten summary only adds the difference to the entry's size
+            old_size = path.stat().st_size
+        except OSError:
+            old_size = 0
+        try:
+            with open(tmp, 'w', encoding='utf-8') as fh:
+                fh.write(text)
+            size = tmp.stat().st_size
+            os.replace(tmp, path)
+        except OSError:
+            return
+        with self._lock:
+            if key in self._index:
+                self._index[key] += size - old_size
+                self._bytes += size - old_size
+                self._evict_locked()
+
+    def _remove_locked(self, key):
+        self._bytes -= self._index.pop(key, 0)
+        shutil.rmtree(self._entry(key), ignore_errors=True)
+
+    def _evict_locked(self):
+        while self._bytes > self.max_bytes and len(self._index) > 1:
+            oldest = next(iter(self._index))
+            self._remove_locked(oldest)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._index), 'bytes': self._bytes, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,233 @@
+"""SAHI-style sliced inference: tiling, batched model calls and NMS merge.
+
+Used by the local detector backend (local_detector.py). Everything between
+the model call and the final prediction dicts is NumPy-vectorized:
+
+- slice windows come from a meshgrid of start offsets;
+- tiles are gathered from a sliding-window view of the image in one
+  indexing operation and sent to the model in batches (plus one letterboxed full-image pass so large
+  objects are still found);
+- raw outputs for the whole batch are decoded, thresholded and remapped to
+  image coordinates in one go;
+- per-class NMS uses the class-offset trick and a boolean overlap matrix, so
+  the greedy result is reached by a few matrix-vector passes instead of a
+  Python loop per box (or, for long chains of overlaps, one ordered scan).
+
+run_model is any callable taking a float32 (N, 3, S, S) RGB batch scaled to
+0-1 and returning YOLOv8-style output of shape (N, 4 + classes, anchors)
+(or (N, anchors, 4 + classes)), with centre-x/centre-y/width/height in input
+pixels followed by per-class scores.
+"""
+import uuid
+
+import numpy as np
+
+PAD_VALUE = 114
+# Rows of the IoU matrix computed at a time (bounds the float temporaries)
+_NMS_BLOCK = 1024
+# Only the highest-scoring candidates go into NMS; the overlap matrix is n x n
+MAX_CANDIDATES = 6000
+# Matrix-vector NMS passes before falling back to one ordered scan (chains of overlaps)
+_NMS_PASSES = 8
+
+
+def slice_windows(width, height, size, overlap):
+    """(n, 4) int array of x0, y0, x1, y1 windows covering the image.
+
+    Windows are size x size and overlap by the given fraction; the last row /
+    column is shifted back so it ends at the image edge. An image smaller
+    than size in a dimension gets a single, shorter window in it.
+    """
+    step = max(1, int(size * (1 - overlap)))
+
+    def starts(length):
+        if length <= size:
+            return np.zeros(1, dtype=np.int64)
+        s = np.arange(0, length - size + 1, step)
+        if s[-1] + size < length:
+            s = np.append(s, length - size)
+        return s
+
+    xs, ys = np.meshgrid(starts(width), starts(height))
+    x0, y0 = xs.ravel(), ys.ravel()
+    return np.stack([x0, y0, np.minimum(x0 + size, width), np.minimum(y0 + size, height)], axis=1)
+
+
+def gather_tiles(image, windows, size):
+    """(n, 3, size, size) uint8 channel-first tiles cut from an HxWx3 image.
+
+    The image is padded to at least size in each dimension first, so every
+    window is full size; tiles are then picked out of a strided sliding-window
+    view in one indexing operation, already in the model's NCHW layout.
+    """
+    h, w = image.shape[:2]
+    if h < size or w < size:
+        padded = np.full((max(h, size), max(w, size), 3), PAD_VALUE, dtype=np.uint8)
+        padded[:h, :w] = image
+        image = padded
+    view = np.lib.stride_tricks.sliding_window_view(image, (size, size), axis=(0, 1))  # (H', W', 3, size, size)
+    return view[windows[:, 1], windows[:, 0]]
+
+
+def decode(raw, confidence):
+    """Threshold a batch of raw outputs.
+
+    Returns (batch_index, boxes xyxy in input pixels, scores, class_ids) for
+    every anchor whose best class score is at least confidence.
+    """
+    raw = np.asarray(raw, dtype=np.float32)
+    # (N, 4 + classes, anchors) for YOLOv8 exports; some exports are transposed
+    if raw.shape[1] > raw.shape[2]:
+        raw = raw.transpose(0, 2, 1)
+    class_scores = raw[:, 4:, :]
+    class_ids = class_scores.argmax(axis=1)  # (N, anchors)
+    scores = np.take_along_axis(class_scores, class_ids[:, None, :], axis=1)[:, 0, :]
+    batch_idx, anchor_idx = np.nonzero(scores >= confidence)
+    cx, cy, bw, bh = (raw[batch_idx, i, anchor_idx] for i in range(4))
+    boxes = np.stack([cx - bw / 2, cy - bh / 2, cx + bw / 2, cy + bh / 2], axis=1)
+    return batch_idx, boxes, scores[batch_idx, anchor_idx], class_ids[batch_idx, anchor_idx]
+
+
+def nms(boxes, scores, class_ids, iou_threshold):
+    """Indices kept by per-class greedy NMS, highest score first (boxes are xyxy)."""
+    n = len(boxes)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    order = np.argsort(-scores, kind='stable')[:MAX_CANDIDATES]
+    n = len(order)
+    b = boxes[order].astype(np.float64)
+    # Shift each class into its own coordinate range so boxes of different
+    # classes never overlap; one pass then handles every class.
+    b += (class_ids[order].astype(np.float64) * (b.max() - b.min() + 1))[:, None]
+    area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+
+    # over[i, j]: box i outscores box j and overlaps it past the threshold
+    over = np.zeros((n, n), dtype=bool)
+    for start in range(0, n, _NMS_BLOCK):
+        blk = slice(start, min(start + _NMS_BLOCK, n))
+        iw = np.minimum(b[blk, None, 2], b[None, :, 2]) - np.maximum(b[blk, None, 0], b[None, :, 0])
+        ih = np.minimum(b[blk, None, 3], b[None, :, 3]) - np.maximum(b[blk, None, 1], b[None, :, 1])
+        inter = np.clip(iw, 0, None) * np.clip(ih, 0, None)
+        iou = inter / np.maximum(area[blk, None] + area[None, :] - inter, 1e-9)
+        over[blk] = iou > iou_threshold
+    over = np.triu(over, k=1)
+
+    # Greedy NMS keeps j iff no *kept* i < j overlaps it. Iterating
+    # keep <- "not suppressed by anything in keep" from keep=all reaches that
+    # fixed point; each pass settles at least one more box in score order,
+    # and in practice it takes a handful of passes.
+    keep = np.ones(n, dtype=bool)
+    for _ in range(_NMS_PASSES):
+        new_keep = ~over[keep].any(axis=0)
+        if np.array_equal(new_keep, keep):
+            return order[keep]
+        keep = new_keep
+    # A chain of overlaps (each box suppressing only the next) settles one box
+    # per pass, O(n^3) in all: do the greedy scan itself instead, one row
+    # operation per box that suppresses anything.
+    keep = np.ones(n, dtype=bool)
+    for i in np.flatnonzero(over.any(axis=1)):
+        if keep[i]:
+            keep[i + 1:] &= ~over[i, i + 1:]
+    return order[keep]
+
+
+def letterbox(image, size):
+    """Letterbox for the full-image pass: returns (tile, scale).
+
+    Nearest-neighbour downsampling (cheap, and this pass only has to catch
+    objects larger than a slice) into the top-left of a size x size canvas.
+    """
+    h, w = image.shape[:2]
+    scale = min(size / w, size / h, 1.0)
+    nh, nw = max(1, int(round(h * scale))), max(1, int(round(w * scale)))
+    rows = np.minimum((np.arange(nh) / scale).astype(np.int64), h - 1)
+    cols = np.minimum((np.arange(nw) / scale).astype(np.int64), w - 1)
+    canvas = np.full((size, size, 3), PAD_VALUE, dtype=np.uint8)
+    canvas[:nh, :nw] = image[rows[:, None], cols[None, :]]
+    return canvas, scale
+
+
+def sliced_predict(image, run_model, input_size, slice_size, overlap, confidence, iou_threshold,
+                   batch_size=16, full_image_pass=True, pad_batches=False):
+    """Detect on an HxWx3 uint8 RGB image with overlapping slices.
+
+    The image is first scaled so a slice_size window maps onto the model's
+    input_size. With pad_batches (models exported with a fixed batch
+    dimension), a last batch short of batch_size is padded with blank tiles
+    whose detections are dropped. Returns (boxes xyxy, scores, class_ids) in
+    original image pixels, already merged with NMS and sorted by score.
+    """
+    h, w = image.shape[:2]
+    ratio = input_size / slice_size
+    if ratio != 1.0:
+        # Resample once instead of resizing each tile
+        nh, nw = max(1, int(round(h * ratio))), max(1, int(round(w * ratio)))
+        rows = np.minimum((np.arange(nh) / ratio).astype(np.int64), h - 1)
+        cols = np.minimum((np.arange(nw) / ratio).astype(np.int64), w - 1)
+        scaled = image[rows[:, None], cols[None, :]]
+    else:
+        scaled = image
+    sh, sw = scaled.shape[:2]
+
+    windows = slice_windows(sw, sh, input_size, overlap)
+    tiles = gather_tiles(scaled, windows, input_size)
+    # Per-tile mapping back to original pixels: (box / scale) + offset
+    offsets = windows[:, :2].astype(np.float32) / ratio
+    scales = np.full(len(windows), ratio, dtype=np.float32)
+    if full_image_pass and len(windows) > 1:
+        canvas, full_scale = letterbox(image, input_size)
+        tiles = np.concatenate([tiles, canvas.transpose(2, 0, 1)[None]])
+        offsets = np.concatenate([offsets, np.zeros((1, 2), dtype=np.float32)])
+        scales = np.append(scales, np.float32(full_scale))
+
+    all_idx, all_boxes, all_scores, all_classes = [], [], [], []
+    batch_size = max(1, batch_size)
+    for start in range(0, len(tiles), batch_size):
+        batch = tiles[start:start + batch_size]
+        blob = batch.astype(np.float32) / 255.0
+        n = len(blob)
+        if pad_batches and n < batch_size:
+            blob = np.concatenate([blob, np.zeros((batch_size - n, *blob.shape[1:]), dtype=np.float32)])
+        idx, boxes, scores, class_ids = decode(run_model(blob), confidence)
+        if n < len(blob):
+            real = idx < n
+            idx, boxes, scores, class_ids = idx[real], boxes[real], scores[real], class_ids[real]
+        all_idx.append(idx + start)
+        all_boxes.append(boxes)
+        all_scores.append(scores)
+        all_classes.append(class_ids)
+    tile_idx = np.concatenate(all_idx)
+    boxes = np.concatenate(all_boxes).reshape(-1, 4)
+    scores = np.concatenate(all_scores)
+    class_ids = np.concatenate(all_classes)
+
+    boxes = boxes / scales[tile_idx, None] + np.tile(offsets[tile_idx], 2)
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, w)
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, h)
+    keep = nms(boxes, scores, class_ids, iou_threshold)
+    return boxes[keep], scores[keep], class_ids[keep]
+
+
+def to_predictions(boxes, scores, class_ids, class_names=None):
+    """Workflow-style prediction dicts (x/y are box centres)."""
+    class_names = class_names or {}
+    xywh = np.empty_like(boxes, dtype=np.float64)
+    xywh[:, 0] = (boxes[:, 0] + boxes[:, 2]) / 2
+    xywh[:, 1] = (boxes[:, 1] + boxes[:, 3]) / 2
+    xywh[:, 2] = boxes[:, 2] - boxes[:, 0]
+    xywh[:, 3] = boxes[:, 3] - boxes[:, 1]
+    return [
+        {
+            'width': bw,
+            'height': bh,
+            'x': x,
+            'y': y,
+            'confidence': conf,
+            'class_id': cls,
+            'class': class_names.get(cls, f'class_{cls}'),
+            'detection_id': str(uuid.uuid4()),
+            'parent_id': 'image',
+        }
+        for (x, y, bw, bh), conf, cls in zip(xywh.tolist(), scores.tolist(), class_ids.tolist())
+    ]
@@ -1,676 +1,1357 @@
-import os
-from dotenv import load_dotenv
-import subprocess
-import json
-import requests
-import sqlite3
-import smtplib
-import shutil
-import mimetypes
-from email.message import EmailMessage
-from pathlib import Path
-from flask import Flask, request, render_template, redirect, url_for, send_file, send_from_directory, flash, session, jsonify
-from datetime import datetime
-
-APP_ROOT = Path(__file__).parent.resolve()
-UPLOAD_DIR = APP_ROOT / "uploads"
-UPLOAD_DIR.mkdir(exist_ok=True)
-
-app = Flask(__name__)
-app.secret_key = os.environ.get("FLASK_SECRET", "change-me")
-
-# Load environment variables from .env if present (local dev convenience).
-load_dotenv()
-
-# Default OpenAI model used for AI summarization. Can be overridden by setting
-# OPENAI_API_MODEL in the environment or .env (example: OPENAI_API_MODEL=gpt-5-mini)
-DEFAULT_OPENAI_MODEL = os.environ.get('OPENAI_API_MODEL', 'gpt-5-mini')
-
-# Path to the Python interpreter inside a venv. Try several common locations so
-# the app works on Windows and Unix without forcing a specific venv name.
-cand_paths = [
-    APP_ROOT / ".venv" / "Scripts" / "python.exe",      # Windows (typical)
-    APP_ROOT / ".venv311" / "Scripts" / "python.exe",  # Windows alt
-    APP_ROOT / ".venv311" / "bin" / "python",         # Unix-style venv311
-    APP_ROOT / ".venv" / "bin" / "python",            # Unix-style .venv
-]
-
-VENV_PY = None
-for p in cand_paths:
-    if p.exists():
-        VENV_PY = p
-        break
-
-# If none of the expected venv python paths exist, default to the first
-# candidate (keeps behavior similar to before; startup will print a helpful
-# warning which prompts the user to create/point to the correct venv).
-if VENV_PY is None:
-    VENV_PY = cand_paths[0]
-
-# --- Simple SQLite database for storing landing-page profiles ---
-DB_PATH = APP_ROOT / "data.db"
-
-def init_db():
-    """Create the profiles table if it doesn't exist."""
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS profiles (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                first_name TEXT NOT NULL,
-                last_name TEXT NOT NULL,
-                provider TEXT NOT NULL,
-                dob TEXT NOT NULL,
-                patient_email TEXT NOT NULL,
-                doctor_email TEXT NOT NULL,
-                created_at TEXT NOT NULL
-            )
-            """
-        )
-        conn.commit()
-    finally:
-        conn.close()
-
-# Initialize DB on import/startup
-init_db()
-
-
-# --- Email helper --------------------------------------------------------
-def send_email_smtp(to_email: str, subject: str, body: str, attachments: list[str], use_random_from: bool = False, reply_to: str | None = None) -> tuple[bool, str]:
-    """Send an email using SMTP settings from environment.
-
-    Returns (success, message).
-    Expects attachments as list of absolute path strings.
-    """
-    smtp_server = os.environ.get('SMTP_SERVER')
-    smtp_port = int(os.environ.get('SMTP_PORT', '587'))
-    smtp_user = os.environ.get('SMTP_USER')
-    smtp_pass = os.environ.get('SMTP_PASSWORD')
-    use_tls = os.environ.get('SMTP_USE_TLS', 'true').lower() not in ('0','false','no')
-
-    # Debug: print masked SMTP env info so we can diagnose missing-config vs runtime send errors
-    try:
-        print(f"send_email_smtp: smtp_server={smtp_server!r}, smtp_port={smtp_port!r}, smtp_user_set={bool(smtp_user)}, smtp_pass_set={bool(smtp_pass)}, use_tls={use_tls}")
-    except Exception:
-        pass
-
-    if not smtp_server or not smtp_user or not smtp_pass:
-        # Fallback for local testing: save the composed message and attachments to disk
-        try:
-            out_dir = APP_ROOT / 'outgoing_emails'
-            out_dir.mkdir(exist_ok=True)
-            stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
-            import uuid as _uuid
-            fname = f'email_{stamp}_{_uuid.uuid4().hex[:8]}.json'
-            target = out_dir / fname
-            # Copy attachments into a subfolder for this message
-            attach_dir = out_dir / (fname + '_attachments')
-            attach_dir.mkdir(exist_ok=True)
-            copied = []
-            for p in attachments:
-                try:
-                    src = Path(p)
-                    if src.exists():
-                        dest = attach_dir / src.name
-                        shutil.copy(src, dest)
-                        copied.append(str(dest.name))
-                except Exception:
-                    pass
-
-            # Include a brief snapshot of the env so we can diagnose why fallback was used
-            env_snapshot = {
-                'SMTP_SERVER': bool(os.environ.get('SMTP_SERVER')),
-                'SMTP_USER': bool(os.environ.get('SMTP_USER')),
-                'SMTP_PASSWORD': bool(os.environ.get('SMTP_PASSWORD')),
-                'SMTP_FROM': bool(os.environ.get('SMTP_FROM')),
-                'SMTP_PORT': os.environ.get('SMTP_PORT')
-            }
-
-            payload = {
-                'from': os.environ.get('SMTP_FROM', smtp_user),
-                'to': to_email,
-                'subject': subject,
-                'body': body,
-                'attachments': copied,
-                'note': 'Saved locally because SMTP_SERVER/SMTP_USER/SMTP_PASSWORD not configured.',
-                'env_snapshot': env_snapshot
-            }
-            import json as _json
-            with open(target, 'w', encoding='utf-8') as fh:
-                _json.dump(payload, fh, ensure_ascii=False, indent=2)
-            return True, f"Saved email to {str(target)}"
-        except Exception as e:
-            return False, f"SMTP not configured and fallback save failed: {str(e)}"
-
-    msg = EmailMessage()
-    # Determine From address. Optionally generate a random local-part if requested.
-    configured_from = os.environ.get('SMTP_FROM', smtp_user)
-    from_addr = configured_from
-
-    if use_random_from:
-        # Derive domain from configured_from or smtp_user or fall back to example.com
-        domain = None
-        for src in (configured_from, smtp_user):
-            if src and '@' in src:
-                domain = src.split('@',1)[1]
-                break
-        if not domain:
-            domain = os.environ.get('SMTP_FROM_DOMAIN', 'example.com')
-        import uuid
-        local = uuid.uuid4().hex[:12]
-        from_addr = f"{local}@{domain}"
-
-    msg['From'] = from_addr
-    # If a reply-to address is provided (e.g., patient), ensure replies go there
-    if reply_to:
-        msg['Reply-To'] = reply_to
-    msg['To'] = to_email
-    msg['Subject'] = subject
-    msg.set_content(body)
-
-    # Attach files
-    for p in attachments:
-        try:
-            path = Path(p)
-            if not path.exists():
-                continue
-            ctype, encoding = mimetypes.guess_type(str(path))
-            if ctype is None:
-                ctype = 'application/octet-stream'
-            maintype, subtype = ctype.split('/', 1)
-            with open(path, 'rb') as fh:
-                data = fh.read()
-            msg.add_attachment(data, maintype=maintype, subtype=subtype, filename=path.name)
-        except Exception as e:
-            # continue attaching other files
-            print('Attachment failed', p, str(e))
-
-    try:
-        with smtplib.SMTP(smtp_server, smtp_port, timeout=30) as s:
-            if use_tls:
-                s.starttls()
-            s.login(smtp_user, smtp_pass)
-            s.send_message(msg)
-        print('send_email_smtp: Email sent successfully')
-        return True, 'Email sent'
-    except Exception as e:
-        # Log exception to help debugging; return the error message upstream
-        print('send_email_smtp: Exception during SMTP send:', str(e))
-        return False, str(e)
-
-
-
-@app.route("/", methods=["GET"])
-def terms():
-    # Show terms and services page first
-    return render_template("terms.html")
-
-
-@app.route("/accept-terms", methods=["POST"])
-def accept_terms():
-    print("Accept terms route called")
-    print("Form data:", request.form)
-    print("Headers:", dict(request.headers))
-    print("User Agent:", request.headers.get('User-Agent', 'Unknown'))
-    
-    # Check if both checkboxes were checked
-    if request.form.get('acceptTerms') and request.form.get('medicalDisclaimer'):
-        # Handle terms acceptance
-        session['terms_accepted'] = True
-        print("Terms accepted, session updated")
-        
-        # For mobile preview compatibility, also use URL parameter as backup
-        # Check if this is a JSON request (AJAX) or form submission
-        if request.is_json or request.headers.get('Content-Type') == 'application/json':
-            return jsonify({"success": True})
-        else:
-            # Form submission - redirect with URL parameter for mobile compatibility
-            print("Redirecting to welcome page with URL parameter")
-            return redirect(url_for('welcome', terms_accepted='true'))
-    else:
-        print("Terms not properly accepted")
-        flash('You must accept both terms to continue.')
-        return redirect(url_for('terms'))
-
-
-@app.route("/debug-session", methods=["GET"])
-def debug_session():
-    return jsonify({
-        "session": dict(session),
-        "terms_accepted": session.get('terms_accepted', False)
-    })
-
-@app.route("/welcome", methods=["GET"])
-def welcome():
-    print("Welcome route called")
-    print("Session:", dict(session))
-    print("URL args:", request.args)
-    print("Terms accepted in session:", session.get('terms_accepted'))
-    
-    # Check if terms have been accepted (session OR URL parameter for mobile compatibility)
-    terms_accepted_session = session.get('terms_accepted', False)
-    terms_accepted_url = request.args.get('terms_accepted') == 'true'
-    
-    print("Terms accepted via session:", terms_accepted_session)
-    print("Terms accepted via URL:", terms_accepted_url)
-    
-    if not (terms_accepted_session or terms_accepted_url):
-        print("Terms not accepted, redirecting to terms page")
-        return redirect(url_for('terms'))
-    
-    # If terms accepted via URL but not in session, update session
-    if terms_accepted_url and not terms_accepted_session:
-        session['terms_accepted'] = True
-        print("Updated session from URL parameter")
-    
-    print("Terms accepted, showing welcome page")
-    # show a welcome form that collects basic user info before proceeding
-    return render_template("welcome.html")
-
-
-@app.route('/upload-page', methods=['GET'])
-def index():
-    # Check if terms have been accepted (session OR URL parameter for mobile compatibility)
-    terms_accepted_session = session.get('terms_accepted', False)
-    terms_accepted_url = request.args.get('terms_accepted') == 'true'
-    
-    if not (terms_accepted_session or terms_accepted_url):
-        return redirect(url_for('terms'))
-    
-    # If terms accepted via URL but not in session, update session
-    if terms_accepted_url and not terms_accepted_session:
-        session['terms_accepted'] = True
-    
-    # show upload form and recent output if present
-    output_path = APP_ROOT / "output.jpg"
-    output_exists = output_path.exists()
-    return render_template("index.html", output_exists=output_exists)
-
-
-@app.route('/save-profile', methods=['POST'])
-def save_profile():
-    """Persist landing-page profile into SQLite and set session values.
-
-    Expected form fields: firstName, lastName, provider, dob, patientEmail, doctorEmail, terms_accepted
-    """
-    data = {}
-    for f in ('firstName', 'lastName', 'provider', 'dob', 'patientEmail', 'doctorEmail'):
-        val = request.form.get(f)
-        if not val:
-            flash('Please fill out all required fields')
-            return redirect(url_for('welcome'))
-        data[f] = val.strip()
-
-    terms_accepted = request.form.get('terms_accepted') == 'true'
-
-    # Save to DB
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO profiles (first_name, last_name, provider, dob, patient_email, doctor_email, created_at) VALUES (?,?,?,?,?,?,?)",
-            (
-                data['firstName'],
-                data['lastName'],
-                data['provider'],
-                data['dob'],
-                data['patientEmail'],
-                data['doctorEmail'],
-                datetime.utcnow().isoformat(),
-            ),
-        )
-        conn.commit()
-    except Exception as e:
-        print('DB insert failed:', str(e))
-        flash('Could not save profile (internal error)')
-        return redirect(url_for('welcome'))
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
-
-    # Store basic info in session so other pages can use it locally
-    session['first_name'] = data['firstName']
-    session['last_name'] = data['lastName']
-    session['provider'] = data['provider']
-    session['dob'] = data['dob']
-    session['patient_email'] = data['patientEmail']
-    session['doctor_email'] = data['doctorEmail']
-    session['terms_accepted'] = terms_accepted
-
-    # Redirect to upload page; for mobile compatibility, append URL param if terms accepted via URL
-    if terms_accepted:
-        return redirect(url_for('index', terms_accepted='true'))
-    return redirect(url_for('index'))
-
-
-@app.route("/upload", methods=["POST"])
-def upload():
-    if 'image' not in request.files:
-        if request.headers.get('Accept') == 'application/json' or request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-            return {"success": False, "error": "No file part"}, 400
-        flash('No file part')
-        return redirect(url_for('index'))
-
-    file = request.files['image']
-    if file.filename == '':
-        flash('No selected file')
-        return redirect(url_for('index'))
-
-    # Save uploaded file
-    save_path = UPLOAD_DIR / file.filename
-    file.save(save_path)
-
-    # If a concern string was sent in the form, save it next to the uploaded file
-    concern_text = request.form.get('concern', '').strip()
-    if concern_text:
-        safe_name = os.path.basename(file.filename)
-        concern_path = UPLOAD_DIR / (safe_name + '.concern.txt')
-        try:
-            with open(concern_path, 'w', encoding='utf-8') as fh:
-                fh.write(concern_text)
-        except Exception:
-            # non-fatal: continue processing the main image
-            pass
-
-    # Ensure the venv python exists
-    if not VENV_PY.exists():
-        flash(f'Venv python not found at {VENV_PY}. Activate the correct venv or create .venv311')
-        return redirect(url_for('index'))
-
-    # Run main.py with the uploaded image path
-    main_py = APP_ROOT / "main.py"
-    cmd = [str(VENV_PY), str(main_py), str(save_path)]
-
-    # Keep environment so main.py can read ROBOFLOW_API_KEY from env
-    env = os.environ.copy()
-
-    try:
-        # Run main.py with the app's root as the working directory so any relative
-        # output files (like "output.jpg") are written where the server looks
-        # for them (APP_ROOT). This avoids mismatches when the Flask process
-        # was started from a different cwd.
-        proc = subprocess.run(cmd, capture_output=True, text=True, env=env, timeout=120, cwd=str(APP_ROOT))
-    except subprocess.TimeoutExpired:
-        if request.headers.get('Accept') == 'application/json' or request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-            return {"success": False, "error": "Processing timed out"}, 504
-        flash('Processing timed out')
-        return redirect(url_for('index'))
-
-    if proc.returncode != 0:
-        err = proc.stderr[:500]
-        if request.headers.get('Accept') == 'application/json' or request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-            return {"success": False, "error": err}, 500
-        flash('Processing failed: ' + err)
-        return redirect(url_for('index'))
-
-    # If main.py saved output.jpg in repo root, serve it
-    output_path = APP_ROOT / "output.jpg"
-    if not output_path.exists():
-        if request.headers.get('Accept') == 'application/json' or request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-            return {"success": False, "error": "No output image produced"}, 500
-        flash('No output image produced')
-        return redirect(url_for('index'))
-
-    # AJAX client expects JSON with the result URL; include uploaded filename so client can attach concerns
-    if request.headers.get('Accept') == 'application/json' or request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        # Attempt to summarize findings using OpenAI if an API key is available.
-        ai_summary = None
-        ai_error = None
-        
-        try:
-            OPENAI_KEY = os.environ.get('OPENAI_API_KEY')
-            # Try reading structured detections produced by main.py (if any)
-            detection_summary = None
-            try:
-                result_json_path = APP_ROOT / 'output_result.json'
-                if result_json_path.exists():
-                    with open(result_json_path, 'r', encoding='utf-8') as rf:
-                        jr = json.load(rf)
-                    # result may be a list containing a single dict
-                    entry = jr[0] if isinstance(jr, list) and len(jr) > 0 else jr
-                    preds = entry.get('predictions') if isinstance(entry, dict) else None
-                    if preds and isinstance(preds, dict):
-                        pimg = preds.get('image', {})
-                        p_list = preds.get('predictions', [])
-                        count = len(p_list)
-                        avg_conf = None
-                        if count:
-                            avg_conf = sum([float(p.get('confidence', 0) or 0) for p in p_list]) / count
-                        detection_summary = {
-                            'count': count,
-                            'avg_confidence': avg_conf,
-                            'image_size': pimg,
-                        }
-            except Exception:
-                detection_summary = None
-
-            if OPENAI_KEY:
-                # Compose a short prompt that asks for a concise summary, risk assessment, and recommended actions.
-                # Prefer explicit env override but fall back to the module-level default
-                model = os.environ.get('OPENAI_API_MODEL', DEFAULT_OPENAI_MODEL)
-                system_msg = (
-                    "You are a helpful dental assistant. Given a patient's short concern text and that an image of their teeth was uploaded, "
-                    "provide a concise (3-6 line) summary of possible issues, a brief risk assessment (low/medium/high) with reasons, "
-                    "and suggested next actions. Reply in plain text, organized into sections: Summary:, Risk:, Actions:."
-                )
-                user_msg = f"Uploaded filename: {file.filename}\nPatient concerns: {concern_text}" if concern_text else f"Uploaded filename: {file.filename}\nPatient provided no additional concerns."
-                # If we have structured detection info, include a short factual
-                # summary for the AI assistant to ground its output.
-                if detection_summary:
-                    ds = detection_summary
-                    # Format avg confidence safely (avoid inline conditional inside format specifier)
-                    avg_conf = ds.get('avg_confidence')
-                    if avg_conf is None:
-                        avg_conf_str = 'N/A'
-                    else:
-                        try:
-                            avg_conf_str = f"{float(avg_conf):.2f}"
-                        except Exception:
-                            avg_conf_str = str(avg_conf)
-                    ds_text = (
-                        f"\n\nDetections: {ds.get('count', 0)} objects detected; "
-                        f"avg confidence={avg_conf_str}. Workflow image size: {ds.get('image_size')}"
-                    )
-                    user_msg += ds_text
-
-                payload = {
-                    "model": model,
-                    "messages": [
-                        {"role": "system", "content": system_msg},
-                        {"role": "user", "content": user_msg}
-                    ],
-                    # Use max_tokens for OpenAI Chat Completions API
-                    "max_completion_tokens": 5000,
-                    "temperature": 1,
-                }
-
-                headers = {
-                    "Authorization": f"Bearer {OPENAI_KEY}",
-                    "Content-Type": "application/json"
-                }
-
-                # Use configurable timeout/retries/backoff to reduce transient ReadTimeouts
-                OPENAI_TIMEOUT = int(os.environ.get('OPENAI_TIMEOUT', '30'))
-                OPENAI_RETRIES = int(os.environ.get('OPENAI_RETRIES', '3'))
-                OPENAI_BACKOFF_BASE = float(os.environ.get('OPENAI_BACKOFF_BASE', '1.5'))
-
-                resp = None
-                last_exc = None
-                for attempt in range(1, OPENAI_RETRIES + 1):
-                    try:
-                        print(f"OpenAI request attempt {attempt}/{OPENAI_RETRIES} (timeout={OPENAI_TIMEOUT}s)")
-                        resp = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload, timeout=OPENAI_TIMEOUT)
-                        break
-                    except requests.exceptions.RequestException as e:
-                        last_exc = e
-                        print(f"OpenAI request attempt {attempt} failed: {str(e)}")
-                        if attempt < OPENAI_RETRIES:
-                            try:
-                                import time as _time
-                                sleep_sec = OPENAI_BACKOFF_BASE ** (attempt - 1)
-                                print(f"OpenAI retrying after {sleep_sec:.1f}s")
-                                _time.sleep(sleep_sec)
-                            except Exception:
-                                pass
-
-                if resp is None:
-                    ai_error = f'OpenAI request failed after {OPENAI_RETRIES} attempts: {str(last_exc)}'
-                else:
-                    if resp.status_code == 200:
-                        j = resp.json()
-                        # Safely extract assistant text
-                        ai_text = None
-                        try:
-                            ai_text = j['choices'][0]['message']['content']
-                        except Exception:
-                            ai_text = None
-                        if ai_text:
-                            ai_summary = ai_text.strip()
-                            # Save summary next to the uploaded file for records
-                            try:
-                                safe_name = os.path.basename(file.filename)
-                                summary_path = UPLOAD_DIR / (safe_name + '.summary.txt')
-                                with open(summary_path, 'w', encoding='utf-8') as sf:
-                                    sf.write(ai_summary)
-                            except Exception:
-                                # non-fatal: ignore file write issues
-                                pass
-                        else:
-                            ai_error = 'No assistant content returned'
-                    else:
-                        ai_error = f'OpenAI API error {resp.status_code}: {resp.text[:400]}'
-            else:
-                ai_error = 'OPENAI_API_KEY not set; skipping AI summary'
-        except Exception as e:
-            ai_error = f'AI summarization failed: {str(e)[:300]}'
-
-        # Provide both the annotated result URL and a direct URL to the original uploaded file
-        out = {
-            "success": True,
-            "result_url": url_for('result'),
-            "original_url": url_for('uploaded_file', filename=file.filename),
-            "uploaded_filename": file.filename
-        }
-        if ai_summary:
-            out['ai_summary'] = ai_summary
-        else:
-            out['ai_summary_error'] = ai_error
-        return out
-
-    return redirect(url_for('result'))
-
-
-@app.route('/result')
-def result():
-    out = APP_ROOT / 'output.jpg'
-    if not out.exists():
-        flash('No output image found')
-        return redirect(url_for('index'))
-    return send_file(out, mimetype='image/jpeg')
-
-
-@app.route('/uploads/<path:filename>')
-def uploaded_file(filename):
-    """Serve files from the uploads directory (original uploaded images and sidecar files)."""
-    # Use send_from_directory for safety
-    return send_from_directory(str(UPLOAD_DIR), filename)
-
-
-# (Concerns are saved as part of the upload form under uploads/<filename>.concern.txt)
-@app.route('/send-to-doctor', methods=['POST'])
-def send_to_doctor():
-    """Send an email to the stored doctor_email with concerns and both original and annotated images.
-
-    Expects JSON body or form with optional 'uploaded_filename' and optional 'concern' override.
-    """
-    # Debug: log incoming request data and session for diagnosis
-    try:
-        print('send_to_doctor called; headers=', dict(request.headers))
-        print('send_to_doctor called; form=', dict(request.form))
-        print('send_to_doctor called; json=', request.get_json(silent=True))
-        print('send_to_doctor session keys=', {k: bool(session.get(k)) for k in ('patient_email','doctor_email')})
-    except Exception:
-        pass
-
-    # Determine uploaded filename: priority JSON/form uploaded_filename, then session stored value on result div is client-side
-    uploaded_filename = request.form.get('uploaded_filename') or (request.json or {}).get('uploaded_filename') if request.is_json else None
-    concern = request.form.get('concern') or (request.json or {}).get('concern') if request.is_json else None
-
-    # Best-effort: use session values if present
-    doctor_email = session.get('doctor_email') or request.form.get('doctor_email') or (request.json or {}).get('doctor_email')
-    patient_email = session.get('patient_email')
-
-    if not doctor_email:
-        return jsonify({'success': False, 'error': 'No doctor email available'}), 400
-
-    # Build attachments: uploaded original in uploads/<filename> and annotated output.jpg in repo root
-    attachments = []
-    if uploaded_filename:
-        upath = UPLOAD_DIR / uploaded_filename
-        if upath.exists():
-            attachments.append(str(upath))
-    # annotated output
-    annotated = APP_ROOT / 'output.jpg'
-    if annotated.exists():
-        attachments.append(str(annotated))
-
-    if not attachments:
-        return jsonify({'success': False, 'error': 'No files available to attach'}), 400
-
-    # Compose email body
-    body_lines = []
-    body_lines.append('Dear Provider,')
-    body_lines.append('')
-    body_lines.append('A patient has submitted dental images via the Open Wide app. See attachments for the original and annotated images.')
-    body_lines.append('')
-    if patient_email:
-        body_lines.append(f'Patient contact email: {patient_email}')
-    if concern:
-        body_lines.append('Patient concerns:')
-        body_lines.append(concern)
-    else:
-        # try to read concern file saved next to uploaded file
-        if uploaded_filename:
-            cfile = UPLOAD_DIR / (uploaded_filename + '.concern.txt')
-            if cfile.exists():
-                try:
-                    body_lines.append('Patient concerns:')
-                    body_lines.append(open(cfile, encoding='utf-8').read())
-                except Exception:
-                    pass
-
-    body_lines.append('')
-    body_lines.append('This message was sent from the Open Wide app.')
-
-    subject = 'Dental images from Open Wide'
-
-    # Check if caller requested a random from-address
-    random_from_flag = False
-    try:
-        if request.is_json:
-            random_from_flag = bool((request.json or {}).get('random_from'))
-        else:
-            random_from_flag = bool(request.form.get('random_from'))
-    except Exception:
-        random_from_flag = False
-
-    # Environment can also force random-from behavior
-    if os.environ.get('SMTP_RANDOM_FROM', '').lower() in ('1','true','yes'):
-        random_from_flag = True
-
-    success, msg = send_email_smtp(doctor_email, subject, '\n'.join(body_lines), attachments, use_random_from=random_from_flag, reply_to=patient_email)
-    if not success:
-        return jsonify({'success': False, 'error': msg}), 500
-    return jsonify({'success': True, 'message': msg})
-
-
-if __name__ == '__main__':
-    # Helpful startup checks
-    if not VENV_PY.exists():
-        print(f"Warning: venv python not found at {VENV_PY}. Create venv311 and install deps first.")
-    print('Starting server on http://127.0.0.1:5000')
+import os
+from dotenv import load_dotenv
+import json
+import requests
+from pathlib import Path
+from flask import Flask, request, render_template, redirect, url_for, send_file, send_from_directory, flash, session, jsonify, Response, stream_with_context, g
+from werkzeug.security import safe_join
+from datetime import datetime, timezone
+import logging
+import re
+import hmac
+import threading
+import time
+import uuid
+
+APP_ROOT = Path(__file__).parent.resolve()
+UPLOAD_DIR = APP_ROOT / "uploads"
+UPLOAD_DIR.mkdir(exist_ok=True)
+
+app = Flask(__name__)
+app.secret_key = os.environ.get("FLASK_SECRET", "change-me")
+
+# Load environment variables from .env if present (local dev convenience).
+load_dotenv()
+
+# Structured, queued logging (LOG_LEVEL, LOG_FORMAT, LOG_DEBUG_SAMPLE_RATE) instead of print()
+import applog
+applog.setup()
+log = logging.getLogger('dental.server')
+
+# Imported after load_dotenv() so INFERENCE_MODE and the Roboflow settings can come from .env
+from inference_engine import INFERENCE_MODE, InferenceError, InferenceTimeout, get_engine, run_inference
+from jobs import DONE, FAILED, QUEUED, JobFailed, JobQueue, QueueFull, log_stage, record_event
+import artifacts
+import db
+import profiles
+import analyses
+import outbox
+import dispatch
+from main import DETECTOR_BACKEND, WORKSPACE_NAME, WORKFLOW_ID, load_detections
+from result_cache import RESULT_CACHE_ENABLED, ResultCache, make_key
+from ingest import FORM_OVERHEAD_BYTES, MAX_UPLOAD_BYTES, StreamingUploadRequest, commit_upload
+import preprocess
+import derivatives
+import http_client
+import metrics
+from circuit_breaker import CircuitBreaker, CircuitOpen, RetryBudget, backoff_delay
+
+# Accepted client-supplied request IDs (anything else gets a fresh one)
+_REQUEST_ID_RE = re.compile(r'^[\w.-]{8,64}$')
+
+
+@app.before_request
+def _start_request_log():
+    """Tag everything logged for this request with a request ID."""
+    g.request_started = time.perf_counter()
+    rid = request.headers.get('X-Request-ID', '')
+    g.request_id = rid if _REQUEST_ID_RE.match(rid) else uuid.uuid4().hex[:16]
+    g.log_token = applog.set_context(request_id=g.request_id, sampled=applog.sample_debug())
+
+
+@app.before_request
+def _start_outbox():
+    # Delivers messages left queued by an earlier run without waiting for a new send
+    outbox.get_outbox().ensure_started()
+
+
+@app.after_request
+def _log_request(response):
+    response.headers['X-Request-ID'] = g.request_id
+    log.info('request', extra={
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'duration_ms': round((time.perf_counter() - g.request_started) * 1000, 1),
+    })
+    return response
+
+
+@app.teardown_request
+def _end_request_log(exc):
+    token = g.pop('log_token', None)
+    if token is not None:
+        applog.reset_context(token)
+
+
+# Stream uploads to disk while hashing/sniffing them (see ingest.py); bodies
+# over the limit are refused from Content-Length before they are read.
+StreamingUploadRequest.upload_dir = UPLOAD_DIR
+app.request_class = StreamingUploadRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + FORM_OVERHEAD_BYTES
+
+# Default OpenAI model used for AI summarization. Can be overridden by setting
+# OPENAI_API_MODEL in the environment or .env (example: OPENAI_API_MODEL=gpt-5-mini)
+DEFAULT_OPENAI_MODEL = os.environ.get('OPENAI_API_MODEL', 'gpt-5-mini')
+# Base URL of the OpenAI-compatible API (override for a proxy or a local fake)
+OPENAI_API_BASE = os.environ.get('OPENAI_API_BASE', 'https://api.openai.com/v1').rstrip('/')
+# Bump whenever the summarization prompt changes so cached summaries aren't reused
+PROMPT_VERSION = '1'
+
+# Shared by every job in this process: while OpenAI is failing, summaries are
+# skipped immediately (and reported as pending) instead of each upload
+# burning OPENAI_RETRIES x OPENAI_TIMEOUT; retries are capped process-wide.
+openai_breaker = CircuitBreaker(
+    'openai',
+    failure_threshold=int(os.environ.get('OPENAI_BREAKER_FAILURES', '5')),
+    cooldown=float(os.environ.get('OPENAI_BREAKER_COOLDOWN', '30')),
+)
+openai_retry_budget = RetryBudget(ratio=float(os.environ.get('OPENAI_RETRY_BUDGET_RATIO', '0.2')))
+
+# Path to the Python interpreter inside a venv. Try several common locations so
+# the app works on Windows and Unix without forcing a specific venv name.
+cand_paths = [
+    APP_ROOT / ".venv" / "Scripts" / "python.exe",      # Windows (typical)
+    APP_ROOT / ".venv311" / "Scripts" / "python.exe",  # Windows alt
+    APP_ROOT / ".venv311" / "bin" / "python",         # Unix-style venv311
+    APP_ROOT / ".venv" / "bin" / "python",            # Unix-style .venv
+]
+
+VENV_PY = None
+for p in cand_paths:
+    if p.exists():
+        VENV_PY = p
+        break
+
+# If none of the expected venv python paths exist, default to the first
+# candidate (keeps behavior similar to before; startup will print a helpful
+# warning which prompts the user to create/point to the correct venv).
+if VENV_PY is None:
+    VENV_PY = cand_paths[0]
+
+# Open the workflow connection in the background so the first upload doesn't
+# pay for the TLS handshake.
+if INFERENCE_MODE != 'subprocess':
+    threading.Thread(target=get_engine().warm_up, daemon=True).start()
+
+def _persist_job(job):
+    """Mirror job state into artifacts/<id>/analysis.json so any worker process can report it."""
+    artifacts.write_record(job.id, job.to_dict(include_result=True))
+
+
+# Bounded worker pool for /upload (JOB_WORKERS, JOB_QUEUE_DEPTH)
+job_queue = JobQueue(listener=_persist_job)
+
+# Re-uploads of identical bytes reuse earlier workflow results and summaries
+result_cache = ResultCache() if RESULT_CACHE_ENABLED else None
+
+
+def _detector_cache_id() -> str:
+    if DETECTOR_BACKEND == 'local':
+        # A re-exported model should not be served stale results
+        from local_detector import LOCAL_MODEL_PATH
+        try:
+            st = LOCAL_MODEL_PATH.stat()
+            return f'local:{LOCAL_MODEL_PATH.name}:{st.st_size}:{st.st_mtime_ns}'
+        except OSError:
+            return 'local'
+    return f'{DETECTOR_BACKEND}:{WORKSPACE_NAME}/{WORKFLOW_ID}'
+
+
+def _detections_cache_key(image_hash: str) -> str:
+    # Preprocessing settings change what the detector sees, so they're part of the key
+    return make_key(image_hash, _detector_cache_id(), preprocess.settings_key())
+
+
+def _summary_cache_key(filename: str, concern_text: str) -> str:
+    model = os.environ.get('OPENAI_API_MODEL', DEFAULT_OPENAI_MODEL)
+    return make_key(model, PROMPT_VERSION, filename, concern_text)
+
+# --- SQLite database for storing landing-page profiles (db.py) ---
+# Create or upgrade the schema on import/startup
+db.migrate()
+
+
+@app.route("/", methods=["GET"])
+def terms():
+    # Show terms and services page first
+    return render_template("terms.html")
+
+
+@app.route("/accept-terms", methods=["POST"])
+def accept_terms():
+    log.debug('accept_terms', extra={'form_fields': sorted(request.form.keys()),
+                                     'user_agent': request.headers.get('User-Agent', 'Unknown')})
+    
+    # Check if both checkboxes were checked
+    if request.form.get('acceptTerms') and request.form.get('medicalDisclaimer'):
+        # Handle terms acceptance
+        session['terms_accepted'] = True
+        log.debug('terms accepted')
+        
+        # For mobile preview compatibility, also use URL parameter as backup
+        # Check if this is a JSON request (AJAX) or form submission
+        if request.is_json or request.headers.get('Content-Type') == 'application/json':
+            return jsonify({"success": True})
+        else:
+            # Form submission - redirect with URL parameter for mobile compatibility
+            return redirect(url_for('welcome', terms_accepted='true'))
+    else:
+        log.debug('terms not accepted')
+        flash('You must accept both terms to continue.')
+        return redirect(url_for('terms'))
+
+
+@app.route("/debug-session", methods=["GET"])
+def debug_session():
+    return jsonify({
+        "session": dict(session),
+        "terms_accepted": session.get('terms_accepted', False)
+    })
+
+@app.route("/welcome", methods=["GET"])
+def welcome():
+    # Check if terms have been accepted (session OR URL parameter for mobile compatibility)
+    terms_accepted_session = session.get('terms_accepted', False)
+    terms_accepted_url = request.args.get('terms_accepted') == 'true'
+    log.debug('welcome', extra={'terms_via_session': terms_accepted_session, 'terms_via_url': terms_accepted_url})
+    
+    if not (terms_accepted_session or terms_accepted_url):
+        return redirect(url_for('terms'))
+    
+    # If terms accepted via URL but not in session, update session
+    if terms_accepted_url and not terms_accepted_session:
+        session['terms_accepted'] = True
+    
+    # show a welcome form that collects basic user info before proceeding
+    return render_template("welcome.html")
+
+
+@app.route('/upload-page', methods=['GET'])
+def index():
+    # Check if terms have been accepted (session OR URL parameter for mobile compatibility)
+    terms_accepted_session = session.get('terms_accepted', False)
+    terms_accepted_url = request.args.get('terms_accepted') == 'true'
+    
+    if not (terms_accepted_session or terms_accepted_url):
+        return redirect(url_for('terms'))
+    
+    # If terms accepted via URL but not in session, update session
+    if terms_accepted_url and not terms_accepted_session:
+        session['terms_accepted'] = True
+    
+    # show upload form and this session's most recent output if present
+    analysis_id = session.get('last_analysis_id')
+    output_exists = artifacts.is_valid_id(analysis_id) and artifacts.annotated_path(analysis_id).exists()
+    return render_template("index.html", output_exists=output_exists)
+
+
+@app.route('/save-profile', methods=['POST'])
+def save_profile():
+    """Persist landing-page profile into SQLite and set session values.
+
+    Expected form fields: firstName, lastName, provider, dob, patientEmail, doctorEmail, terms_accepted
+    """
+    data = {}
+    for f in ('firstName', 'lastName', 'provider', 'dob', 'patientEmail', 'doctorEmail'):
+        val = request.form.get(f)
+        if not val:
+            flash('Please fill out all required fields')
+            return redirect(url_for('welcome'))
+        data[f] = val.strip()
+
+    terms_accepted = request.form.get('terms_accepted') == 'true'
+
+    # Insert, or update the returning patient's existing row (profiles.py)
+    try:
+        with metrics.timed('sqlite_write'):
+            profile_id = profiles.upsert(
+                data['firstName'],
+                data['lastName'],
+                data['provider'],
+                data['dob'],
+                data['patientEmail'],
+                data['doctorEmail'],
+            )
+    except Exception as e:
+        log.error('profile save failed', extra={'error': str(e)})
+        flash('Could not save profile (internal error)')
+        return redirect(url_for('welcome'))
+
+    # Store basic info in session so other pages can use it locally
+    session['profile_id'] = profile_id
+    session['first_name'] = data['firstName']
+    session['last_name'] = data['lastName']
+    session['provider'] = data['provider']
+    session['dob'] = data['dob']
+    session['patient_email'] = data['patientEmail']
+    session['doctor_email'] = data['doctorEmail']
+    session['terms_accepted'] = terms_accepted
+
+    # Redirect to upload page; for mobile compatibility, append URL param if terms accepted via URL
+    if terms_accepted:
+        return redirect(url_for('index', terms_accepted='true'))
+    return redirect(url_for('index'))
+
+
+# Profile lookups return patient data, so they are off unless PROFILE_API_TOKEN
+# is set, and then need "Authorization: Bearer <token>"
+PROFILE_API_TOKEN = os.environ.get('PROFILE_API_TOKEN', '')
+
+
+def _check_api_token():
+    """Error response unless the request carries PROFILE_API_TOKEN (the provider API's routes are 404 without one)."""
+    if not PROFILE_API_TOKEN:
+        return jsonify({'success': False, 'error': 'Not found'}), 404
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {PROFILE_API_TOKEN}'):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    return None
+
+
+@app.route('/profiles', methods=['GET'])
+def profile_lookup():
+    """Indexed profile lookups, paged by id.
+
+    Query by ?patient_email=, ?first_name=&last_name=&dob=, ?doctor_email= or
+    ?provider= (case-insensitive), plus &limit= and &after=<next_after of the
+    previous page>.
+    """
+    denied = _check_api_token()
+    if denied:
+        return denied
+    try:
+        after = int(request.args.get('after', 0))
+        limit = int(request.args.get('limit', profiles.PAGE_SIZE))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'after and limit must be integers'}), 400
+
+    args = request.args
+    if args.get('patient_email'):
+        rows, next_after = profiles.find_by_email(args['patient_email'], after, limit)
+    elif args.get('first_name') and args.get('last_name') and args.get('dob'):
+        rows, next_after = profiles.find_by_name(args['last_name'], args['first_name'], args['dob'], after, limit)
+    elif args.get('doctor_email'):
+        rows, next_after = profiles.list_by_doctor(args['doctor_email'], after, limit)
+    elif args.get('provider'):
+        rows, next_after = profiles.list_by_provider(args['provider'], after, limit)
+    else:
+        return jsonify({'success': False,
+                        'error': 'Pass patient_email, first_name+last_name+dob, doctor_email or provider'}), 400
+    return jsonify({'success': True, 'profiles': rows, 'next_after': next_after})
+
+
+class SummaryError(Exception):
+    """Raised by stream_summary when no summary could be produced."""
+
+
+def _summary_payload(filename: str, concern_text: str, result_json_path: Path) -> dict:
+    """Chat completions request body asking for a summary of the detections in result_json_path."""
+    # Try reading structured detections produced by the workflow (if any)
+    detection_summary = None
+    try:
+        if result_json_path.exists():
+            # Compact boxes/classes/confidences only (a few KB), see main.save_workflow_outputs
+            preds = load_detections(result_json_path)
+            if preds:
+                pimg = preds.get('image', {})
+                p_list = preds.get('predictions', [])
+                count = len(p_list)
+                avg_conf = None
+                if count:
+                    avg_conf = sum([float(p.get('confidence', 0) or 0) for p in p_list]) / count
+                detection_summary = {
+                    'count': count,
+                    'avg_confidence': avg_conf,
+                    'image_size': pimg,
+                }
+    except Exception:
+        detection_summary = None
+
+
+    # Compose a short prompt that asks for a concise summary, risk assessment, and recommended actions.
+    # Prefer explicit env override but fall back to the module-level default
+    model = os.environ.get('OPENAI_API_MODEL', DEFAULT_OPENAI_MODEL)
+    system_msg = (
+        "You are a helpful dental assistant. Given a patient's short concern text and that an image of their teeth was uploaded, "
+        "provide a concise (3-6 line) summary of possible issues, a brief risk assessment (low/medium/high) with reasons, "
+        "and suggested next actions. Reply in plain text, organized into sections: Summary:, Risk:, Actions:."
+    )
+    user_msg = f"Uploaded filename: {filename}\nPatient concerns: {concern_text}" if concern_text else f"Uploaded filename: {filename}\nPatient provided no additional concerns."
+    # If we have structured detection info, include a short factual
+    # summary for the AI assistant to ground its output.
+    if detection_summary:
+        ds = detection_summary
+        # Format avg confidence safely (avoid inline conditional inside format specifier)
+        avg_conf = ds.get('avg_confidence')
+        if avg_conf is None:
+            avg_conf_str = 'N/A'
+        else:
+            try:
+                avg_conf_str = f"{float(avg_conf):.2f}"
+            except Exception:
+                avg_conf_str = str(avg_conf)
+        ds_text = (
+            f"\n\nDetections: {ds.get('count', 0)} objects detected; "
+            f"avg confidence={avg_conf_str}. Workflow image size: {ds.get('image_size')}"
+        )
+        user_msg += ds_text
+
+
+    payload = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_msg},
+            {"role": "user", "content": user_msg}
+        ],
+        # Use max_tokens for OpenAI Chat Completions API
+        "max_completion_tokens": 5000,
+        "temperature": 1,
+    }
+    return payload
+
+
+def _post_chat_completion(payload: dict, stream: bool = False):
+    """POST payload to the chat completions API.
+
+    Retries request errors, 429 and 5xx within the shared retry budget, with
+    jittered backoff. Returns (resp, None) for the first other response (which
+    may still be an error status), or (None, error) once retries run out.
+    Raises CircuitOpen while the breaker is open.
+    """
+    headers = {
+        "Authorization": f"Bearer {os.environ.get('OPENAI_API_KEY')}",
+        "Content-Type": "application/json"
+    }
+
+    # Use configurable timeout/retries/backoff to reduce transient ReadTimeouts
+    OPENAI_TIMEOUT = int(os.environ.get('OPENAI_TIMEOUT', '30'))
+    OPENAI_RETRIES = int(os.environ.get('OPENAI_RETRIES', '3'))
+    OPENAI_BACKOFF_BASE = float(os.environ.get('OPENAI_BACKOFF_BASE', '1.5'))
+
+    resp = None
+    last_exc = None
+    openai_retry_budget.deposit()
+    for attempt in range(1, OPENAI_RETRIES + 1):
+        if attempt > 1:
+            if not openai_retry_budget.try_spend():
+                log.warning('OpenAI retry budget exhausted; not retrying')
+                break
+            if resp is not None:
+                # The failed attempt's response isn't returned: give its pooled
+                # connection back (a streamed body is never read otherwise)
+                resp.close()
+                resp = None
+            sleep_sec = backoff_delay(attempt - 1, OPENAI_BACKOFF_BASE)
+            log.info('OpenAI retrying', extra={'attempt': attempt, 'backoff_s': round(sleep_sec, 2)})
+            metrics.observe('openai_backoff', sleep_sec)
+            time.sleep(sleep_sec)
+        # Raises CircuitOpen (handled by the caller) while OpenAI is failing
+        openai_breaker.before_call()
+        try:
+            log.debug('OpenAI request', extra={'attempt': attempt, 'retries': OPENAI_RETRIES, 'timeout_s': OPENAI_TIMEOUT})
+            # Pooled keep-alive connection (http_client.py) instead of a new handshake per call.
+            # One observation per attempt, so retries show up as openai_attempt count > openai_call count.
+            with metrics.timed('openai_attempt'):
+                resp = http_client.get_client().post(f"{OPENAI_API_BASE}/chat/completions", headers=headers, json=payload,
+                                                     timeout=OPENAI_TIMEOUT, stream=stream)
+        except requests.exceptions.RequestException as e:
+            openai_breaker.record_failure()
+            last_exc = e
+            log.warning('OpenAI request failed', extra={'attempt': attempt, 'error': str(e)})
+            continue
+        except Exception:
+            # Anything else must still end a half-open probe, or the breaker stays shut
+            openai_breaker.record_failure()
+            raise
+        if resp.status_code == 429 or resp.status_code >= 500:
+            # Provider-side trouble: counts towards opening the breaker and is retried
+            openai_breaker.record_failure()
+            metrics.error('openai_attempt')
+            log.warning('OpenAI request failed', extra={'attempt': attempt, 'http_status': resp.status_code})
+            continue
+        openai_breaker.record_success()
+        return resp, None
+
+    if resp is not None:
+        return resp, None
+    return None, f'OpenAI request failed after {OPENAI_RETRIES} attempts: {str(last_exc)}'
+
+
+def summarize_findings(filename: str, concern_text: str, result_json_path: Path) -> tuple[str | None, str | None]:
+    """Ask OpenAI for a short summary of the detections in result_json_path.
+
+    Returns (ai_summary, ai_error); exactly one of them is set. Raises
+    CircuitOpen without calling OpenAI while the breaker is open.
+    """
+    # Attempt to summarize findings using OpenAI if an API key is available.
+    ai_summary = None
+    ai_error = None
+
+    started = time.perf_counter()
+    try:
+        if os.environ.get('OPENAI_API_KEY'):
+            resp, ai_error = _post_chat_completion(_summary_payload(filename, concern_text, result_json_path))
+            if resp is not None:
+                if resp.status_code == 200:
+                    j = resp.json()
+                    # Safely extract assistant text
+                    ai_text = None
+                    try:
+                        ai_text = j['choices'][0]['message']['content']
+                    except Exception:
+                        ai_text = None
+                    if ai_text:
+                        ai_summary = ai_text.strip()
+                    else:
+                        ai_error = 'No assistant content returned'
+                else:
+                    ai_error = f'OpenAI API error {resp.status_code}: {resp.text[:400]}'
+        else:
+            ai_error = 'OPENAI_API_KEY not set; skipping AI summary'
+    except CircuitOpen:
+        metrics.error('openai_call')
+        raise
+    except Exception as e:
+        ai_error = f'AI summarization failed: {str(e)[:300]}'
+    metrics.observe('openai_call', time.perf_counter() - started)
+    if ai_summary is None:
+        metrics.error('openai_call')
+    return ai_summary, ai_error
+
+
+def stream_summary(filename: str, concern_text: str, result_json_path: Path):
+    """Yield the summary text piece by piece as the model generates it.
+
+    Raises CircuitOpen while the breaker is open and SummaryError for any
+    other failure (before or during the stream).
+    """
+    if not os.environ.get('OPENAI_API_KEY'):
+        raise SummaryError('OPENAI_API_KEY not set; skipping AI summary')
+    payload = _summary_payload(filename, concern_text, result_json_path)
+    payload['stream'] = True
+    started = time.perf_counter()
+    ok = False
+    try:
+        resp, error = _post_chat_completion(payload, stream=True)
+        if resp is None:
+            raise SummaryError(error)
+        with resp:
+            if resp.status_code != 200:
+                raise SummaryError(f'OpenAI API error {resp.status_code}: {resp.text[:400]}')
+            resp.encoding = 'utf-8'
+            first = True
+            try:
+                # Server-sent events: "data: {chunk json}" lines, ending with "data: [DONE]"
+                for line in resp.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith('data:'):
+                        continue
+                    data = line[5:].strip()
+                    if data == '[DONE]':
+                        break
+                    try:
+                        piece = json.loads(data)['choices'][0]['delta'].get('content')
+                    except (ValueError, KeyError, IndexError, TypeError):
+                        continue
+                    if piece:
+                        if first:
+                            metrics.observe('openai_first_token', time.perf_counter() - started)
+                            first = False
+                        yield piece
+            except requests.exceptions.RequestException as e:
+                openai_breaker.record_failure()
+                raise SummaryError(f'AI summary stream interrupted: {str(e)[:300]}') from e
+        ok = True
+    finally:
+        # Also reached when the browser disconnects mid-stream (GeneratorExit)
+        metrics.observe('openai_call', time.perf_counter() - started)
+        if not ok:
+            metrics.error('openai_call')
+
+
+def process_upload(analysis_id: str, save_path: Path, filename: str, cache_key: str | None = None,
+                   detections_cached: bool = False, started_at: float | None = None) -> dict:
+    """Background job body for /upload: run the workflow.
+
+    Outputs go to artifacts/<analysis_id>/. With a cache_key, cached workflow
+    results are reused and fresh ones are stored. The AI summary is not part
+    of the job; clients fetch it afterwards from /result/<id>/summary/stream
+    (or /result/<id>/summary), so detections come back without waiting on
+    OpenAI. The outcome, detection stats and timings (from started_at, when
+    the upload began) go to the analysis's row. Returns the
+    JSON-serializable part of the upload response; raises JobFailed so
+    /jobs/<id> can report the same errors upload() used to.
+    """
+    detection_started = time.time()
+    try:
+        cached = _run_detection(analysis_id, save_path, cache_key, detections_cached)
+    except Exception as e:
+        _finish_analysis(analysis_id, FAILED, started_at, error=str(e)[:500])
+        raise
+    _finish_analysis(analysis_id, DONE, started_at, cached=cached,
+                     detection_ms=(time.time() - detection_started) * 1000)
+    return {"analysis_id": analysis_id, "uploaded_filename": save_path.name, "original_filename": filename}
+
+
+def _run_detection(analysis_id: str, save_path: Path, cache_key: str | None, detections_cached: bool) -> bool:
+    """Annotated image and detections into artifacts/<analysis_id>/. Returns True if they came from the cache."""
+    artifact_dir = artifacts.artifact_dir(analysis_id, create=True)
+    annotated_path = artifacts.annotated_path(analysis_id)
+    detections_path = artifacts.detections_path(analysis_id)
+    use_cache = result_cache is not None and cache_key is not None
+
+    if use_cache and detections_cached and result_cache.materialize(cache_key, artifact_dir):
+        record_event('detection_finished', cached=True)
+        return True
+
+    # Send an oriented, downsized copy; the original stays in uploads/
+    inference_input = save_path
+    if preprocess.PREPROCESS_ENABLED:
+        with metrics.timed('normalize'):
+            inference_input = preprocess.normalize_image(save_path, artifacts.normalized_path(analysis_id))
+        record_event('normalized', resized=inference_input != save_path)
+    # Run the Roboflow workflow: in-process by default, or via main.py in a
+    # subprocess when INFERENCE_MODE=subprocess.
+    record_event('detection_started', backend=DETECTOR_BACKEND)
+    try:
+        run_inference(inference_input, annotated_path, detections_path, python_exe=VENV_PY)
+    except InferenceTimeout:
+        raise JobFailed('Processing timed out', http_status=504)
+    except InferenceError as e:
+        raise JobFailed(str(e)[:500], http_status=500)
+    record_event('detection_finished', cached=False)
+    if use_cache:
+        result_cache.store(cache_key, annotated_path, detections_path)
+    return False
+
+
+def _finish_analysis(analysis_id: str, status: str, started_at: float | None, **fields):
+    """Record an analysis outcome in its row; a database error doesn't fail the upload."""
+    try:
+        analyses.finish(analysis_id, status,
+                        detections_path=artifacts.detections_path(analysis_id) if status == DONE else None,
+                        total_ms=(time.time() - started_at) * 1000 if started_at else None, **fields)
+    except Exception as e:
+        log.error('analysis update failed', extra={'analysis_id': analysis_id, 'error': str(e)})
+
+
+def _import_legacy_analysis(analysis_id: str, record: dict) -> dict | None:
+    """Row for an analysis recorded before the analyses table, from its record and uploads/ sidecars."""
+    res = record.get('result') or {}
+    uploaded = res.get('uploaded_filename')
+    if not uploaded:
+        return None
+
+    def sidecar(suffix):
+        try:
+            with open(UPLOAD_DIR / (uploaded + suffix), 'r', encoding='utf-8') as fh:
+                return fh.read()
+        except OSError:
+            return None
+
+    status = record.get('status', DONE)
+    created = record.get('created_at')
+    try:
+        # Stored uploads are named <sha256>.<ext>
+        analyses.create(analysis_id, Path(uploaded).stem, uploaded, res.get('original_filename'),
+                        sidecar('.concern.txt'), status,
+                        created_at=datetime.utcfromtimestamp(created).isoformat() if created else None)
+        analyses.finish(analysis_id, status, cached=bool(record.get('cached')), error=record.get('error'),
+                        detections_path=artifacts.detections_path(analysis_id) if status == DONE else None)
+        summary = res.get('ai_summary') or sidecar('.summary.txt')
+        if summary:
+            analyses.set_summary(analysis_id, summary)
+    except Exception as e:
+        # Most likely imported by a concurrent request, which the lookup below picks up
+        log.warning('legacy analysis import failed', extra={'analysis_id': analysis_id, 'error': str(e)})
+    return analyses.get(analysis_id)
+
+
+def _analysis_row(analysis_id: str | None) -> dict | None:
+    """The analysis's database row (an indexed lookup); None if unknown."""
+    if not artifacts.is_valid_id(analysis_id):
+        return None
+    row = analyses.get(analysis_id)
+    if row is None:
+        record = artifacts.read_record(analysis_id)
+        if record is not None:
+            row = _import_legacy_analysis(analysis_id, record)
+    return row
+
+
+def _summary_context(analysis_id: str) -> dict | None:
+    """Everything needed to summarize a finished analysis, from its record and row; None if unknown."""
+    record = artifacts.read_record(analysis_id) if artifacts.is_valid_id(analysis_id) else None
+    res = (record or {}).get('result')
+    if not res:
+        return None
+    row = analyses.get(analysis_id) or _import_legacy_analysis(analysis_id, record)
+    if row is None:
+        return None
+    filename = row['original_filename'] or row['storage_key']
+    concern_text = row['concern'] or ''
+    return {
+        'analysis_id': analysis_id,
+        'result': res,
+        'filename': filename,
+        'concern_text': concern_text,
+        'summary': row['summary'],
+        'detections_path': artifacts.detections_path(analysis_id),
+        'cache_key': _detections_cache_key(row['image_hash']) if result_cache is not None else None,
+        'summary_key': _summary_cache_key(filename, concern_text),
+    }
+
+
+def _cached_summary(ctx: dict) -> str | None:
+    """Summary already stored in the analysis row or the result cache."""
+    if ctx['summary']:
+        return ctx['summary']
+    if ctx['cache_key']:
+        ai_summary = result_cache.get_summary(ctx['cache_key'], ctx['summary_key'])
+        metrics.cache('summary', ai_summary is not None)
+        return ai_summary
+    return None
+
+
+def _store_summary(ctx: dict, ai_summary: str, summary_ms: float | None = None):
+    """Record a finished summary: result cache, the analysis row and the analysis record."""
+    if ctx['cache_key']:
+        result_cache.put_summary(ctx['cache_key'], ctx['summary_key'], ai_summary)
+    if ctx['summary'] != ai_summary:
+        try:
+            analyses.set_summary(ctx['analysis_id'], ai_summary, summary_ms)
+            ctx['summary'] = ai_summary
+        except Exception as e:
+            # non-fatal: the record below still has it for this analysis
+            log.error('analysis summary update failed', extra={'analysis_id': ctx['analysis_id'], 'error': str(e)})
+    if ctx['result'].get('ai_summary') != ai_summary:
+        res = dict(ctx['result'], ai_summary=ai_summary)
+        job = job_queue.get(ctx['analysis_id'])
+        if job is not None and job.result is not None:
+            # Keep the in-memory job in step, or its next write would drop the summary
+            job.result = res
+        artifacts.update_record(ctx['analysis_id'], result=res)
+        ctx['result'] = res
+
+
+def _summary_event(analysis_id: str, stage: str, **info):
+    """Add a summary stage event to the analysis's job (or its record, if the job isn't in this process)."""
+    job = job_queue.get(analysis_id)
+    if job is not None:
+        job.add_event(stage, **info)
+        return
+    record = artifacts.read_record(analysis_id) or {}
+    events = record.get('events', [])
+    events.append({'stage': stage, 'at': time.time(), **info})
+    log_stage(analysis_id, events)
+    artifacts.update_record(analysis_id, events=events)
+
+
+def _summarize_analysis(ctx: dict) -> dict:
+    """AI summary fields for an analysis, generating the summary if needed.
+
+    One of ai_summary, ai_summary_error, or ai_summary_pending (OpenAI's
+    circuit breaker is open; retry after summary_retry_after seconds).
+    """
+    ai_summary = _cached_summary(ctx)
+    ai_error = None
+    summary_ms = None
+    if ai_summary is None:
+        _summary_event(ctx['analysis_id'], 'summary_started', streamed=False)
+        started = time.time()
+        try:
+            ai_summary, ai_error = summarize_findings(ctx['filename'], ctx['concern_text'], ctx['detections_path'])
+        except CircuitOpen as e:
+            _summary_event(ctx['analysis_id'], 'summary_finished', outcome='pending')
+            return {'ai_summary_pending': True, 'summary_retry_after': int(e.retry_after + 0.999)}
+        _summary_event(ctx['analysis_id'], 'summary_finished', outcome='ok' if ai_summary else 'error')
+        summary_ms = (time.time() - started) * 1000
+    if ai_summary:
+        _store_summary(ctx, ai_summary, summary_ms)
+        return {'ai_summary': ai_summary}
+    return {'ai_summary_error': ai_error}
+
+
+def _upload_response(res: dict) -> dict:
+    """Client-facing upload result (image and summary URLs) for a finished analysis."""
+    # Provide both the annotated result URL and a direct URL to the original uploaded file
+    out = {
+        "success": True,
+        "status": DONE,
+        "result_url": url_for('analysis_result', analysis_id=res['analysis_id']),
+        "original_url": url_for('uploaded_file', filename=res['uploaded_filename']),
+    }
+    out.update(res)
+    out['summary_url'] = url_for('analysis_summary', analysis_id=res['analysis_id'])
+    out['summary_stream_url'] = url_for('analysis_summary_stream', analysis_id=res['analysis_id'])
+    return out
+
+
+def _complete_from_cache(analysis_id: str, cache_key: str, save_path: Path, filename: str, events: list) -> dict | None:
+    """Finish an upload synchronously from a cache hit, without touching the job queue.
+
+    Returns the result dict, or None if the entry vanished and the job queue
+    has to do the work. A cached summary is picked up by the summary routes.
+    """
+    res = {"analysis_id": analysis_id, "uploaded_filename": save_path.name, "original_filename": filename}
+    started = time.time()
+    if not result_cache.materialize(cache_key, artifacts.artifact_dir(analysis_id)):
+        return None
+    now = time.time()
+    events = events + [{'stage': 'detection_finished', 'at': now, 'cached': True}, {'stage': DONE, 'at': now}]
+    log_stage(analysis_id, events)
+    artifacts.write_record(analysis_id, {
+        'job_id': analysis_id, 'status': DONE, 'created_at': now, 'started_at': now, 'finished_at': now,
+        'error': None, 'http_status': None, 'result': res, 'cached': True, 'events': events,
+    })
+    _finish_analysis(analysis_id, DONE, events[0]['at'], cached=True, detection_ms=(now - started) * 1000)
+    return res
+
+
+@app.errorhandler(413)
+@app.errorhandler(415)
+def upload_rejected(e):
+    """Oversized or non-image uploads, rejected by ingest.py while streaming."""
+    if request.headers.get('Accept') == 'application/json' or request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return {"success": False, "error": e.description}, e.code
+    flash(e.description)
+    return redirect(url_for('index'))
+
+
+@app.route("/upload", methods=["POST"])
+def upload():
+    # The multipart body is read (and streamed to disk) on first access to request.files
+    upload_started = time.time()
+    if 'image' not in request.files:
+        if request.headers.get('Accept') == 'application/json' or request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return {"success": False, "error": "No file part"}, 400
+        flash('No file part')
+        return redirect(url_for('index'))
+
+    file = request.files['image']
+    if file.filename == '':
+        flash('No selected file')
+        return redirect(url_for('index'))
+
+    # The multipart parser already streamed the file into uploads/.incoming
+    # (rejecting oversized/non-image bodies early); move it to its
+    # content-addressed name, uploads/<sha256>.<ext>.
+    save_path, image_hash = commit_upload(file)
+    # Receiving/parsing the multipart body, hashing and moving it into place
+    metrics.observe('upload_save', time.time() - upload_started)
+    events = [
+        {'stage': 'upload_started', 'at': upload_started},
+        {'stage': 'received', 'at': time.time(), 'bytes': save_path.stat().st_size},
+    ]
+    # Client-supplied name, only used for display and the AI prompt
+    original_filename = os.path.basename(file.filename)
+
+    concern_text = request.form.get('concern', '').strip()
+
+    # AJAX clients get a job ID right away and poll /jobs/<id>; the workflow
+    # runs on the job queue and the OpenAI summary is streamed separately.
+    wants_json = request.headers.get('Accept') == 'application/json' or request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+    analysis_id = artifacts.new_id()
+
+    # The analysis row holds the concern and, later, the outcome and summary,
+    # linked to this session's profile
+    try:
+        analyses.create(analysis_id, image_hash, save_path.name, original_filename, concern_text, QUEUED,
+                        profile_id=session.get('profile_id'),
+                        created_at=datetime.utcfromtimestamp(upload_started).isoformat())
+    except Exception as e:
+        log.error('analysis insert failed', extra={'analysis_id': analysis_id, 'error': str(e)})
+        if wants_json:
+            return {"success": False, "error": "Could not record the analysis (internal error)"}, 500
+        flash('Could not record the analysis (internal error)')
+        return redirect(url_for('index'))
+
+    # Identical bytes seen before: answer straight from the result cache
+    cache_key = None
+    entry = None
+    if result_cache is not None:
+        cache_key = _detections_cache_key(image_hash)
+        entry = result_cache.lookup(cache_key)
+        metrics.cache('detections', entry is not None)
+        if entry is not None:
+            res = _complete_from_cache(analysis_id, cache_key, save_path, original_filename, events)
+            if res is not None:
+                session['last_analysis_id'] = analysis_id
+                if wants_json:
+                    out = _upload_response(res)
+                    out['job_id'] = analysis_id
+                    out['cached'] = True
+                    return out
+                return redirect(url_for('analysis_result', analysis_id=analysis_id))
+
+    try:
+        job = job_queue.submit(process_upload, analysis_id, save_path, original_filename,
+                               cache_key=cache_key, detections_cached=entry is not None, started_at=upload_started,
+                               job_id=analysis_id, events=events)
+    except QueueFull:
+        _finish_analysis(analysis_id, FAILED, upload_started, error='Server busy')
+        if wants_json:
+            return {"success": False, "error": "Server busy, please retry shortly"}, 503, {'Retry-After': '5'}
+        flash('Server busy, please retry shortly')
+        return redirect(url_for('index'))
+
+    if wants_json:
+        return {
+            "success": True,
+            "job_id": job.id,
+            "analysis_id": analysis_id,
+            "status": job.status,
+            "status_url": url_for('job_status', job_id=job.id),
+            "job_result_url": url_for('job_result', job_id=job.id),
+            "uploaded_filename": save_path.name,
+            "original_filename": original_filename,
+        }, 202
+
+    # Plain form posts keep the old behavior: wait for the workflow, then show the image
+    job.wait()
+    if job.status == FAILED:
+        flash(job.error if job.http_status == 504 else 'Processing failed: ' + (job.error or ''))
+        return redirect(url_for('index'))
+    session['last_analysis_id'] = analysis_id
+    return redirect(url_for('analysis_result', analysis_id=analysis_id))
+
+
+def _job_snapshot(job_id: str, wait: float = 0.0, events_after: int | None = None) -> dict | None:
+    """Current state of job_id as a dict (see Job.to_dict), or None if unknown.
+
+    Jobs queued by this process are read from memory; otherwise the record in
+    artifacts/<id>/analysis.json written by whichever worker owns the job.
+    With wait, blocks until the job finishes or, if events_after is given,
+    until it has more than that many stage events.
+    """
+    job = job_queue.get(job_id)
+    if job is not None:
+        if wait > 0 and not job.finished:
+            if events_after is None:
+                job.wait(wait)
+            else:
+                job.wait_for_update(events_after, wait)
+        return job.to_dict(include_result=True)
+    deadline = time.monotonic() + wait
+    while True:
+        record = artifacts.read_record(job_id)
+        if record is None:
+            return None
+        if record.get('status') in (DONE, FAILED) or time.monotonic() >= deadline:
+            return record
+        if events_after is not None and len(record.get('events', [])) > events_after:
+            return record
+        time.sleep(0.5)
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Job status and stage events.
+
+    Pass ?wait=<seconds> (max 30) to long-poll until the job finishes, and
+    also &events_after=<n> to return as soon as there are more than n events.
+    """
+    try:
+        wait = min(float(request.args.get('wait', 0)), 30.0)
+    except ValueError:
+        wait = 0
+    events_after = request.args.get('events_after', type=int)
+    snap = _job_snapshot(job_id, wait, events_after)
+    if snap is None:
+        return jsonify({'success': False, 'error': 'Unknown job'}), 404
+    snap.pop('result', None)
+    snap['success'] = snap['status'] != FAILED
+    snap['queue_depth'] = job_queue.depth()
+    if snap['status'] in (DONE, FAILED):
+        snap['job_result_url'] = url_for('job_result', job_id=job_id)
+    return jsonify(snap)
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """The upload response (image and summary URLs) once the job has finished."""
+    snap = _job_snapshot(job_id)
+    if snap is None:
+        return jsonify({'success': False, 'error': 'Unknown job'}), 404
+    if snap['status'] == FAILED:
+        return jsonify({'success': False, 'status': snap['status'], 'error': snap.get('error')}), snap.get('http_status') or 500
+    if snap['status'] != DONE:
+        return jsonify({'success': False, 'status': snap['status'], 'error': 'Job not finished'}), 202
+
+    res = snap['result']
+    # Remember the latest analysis so /result and /send-to-doctor default to it
+    session['last_analysis_id'] = res['analysis_id']
+    return jsonify(_upload_response(res))
+
+
+@app.route('/result')
+def result():
+    """Annotated image of this session's most recent analysis."""
+    analysis_id = session.get('last_analysis_id')
+    if not artifacts.is_valid_id(analysis_id):
+        flash('No output image found')
+        return redirect(url_for('index'))
+    return redirect(url_for('analysis_result', analysis_id=analysis_id, size=request.args.get('size')))
+
+
+def _sized_image(path: Path, size: str, dest_dir: Path, mimetype=None):
+    """The image at path, or its ?size= copy in the best format the client accepts (see derivatives.py)."""
+    if size not in derivatives.SIZES:
+        sizes = ', '.join(['original', *derivatives.SIZES])
+        return jsonify({'success': False, 'error': f'Unknown size, use one of: {sizes}'}), 400
+    fmt = derivatives.negotiate(request.headers.get('Accept'))
+    out = derivatives.derivative(path, size, fmt, dest_dir)
+    resp = send_file(out, mimetype=derivatives.content_type(out) if out != path else mimetype)
+    # The format depends on what the client accepts
+    resp.vary.add('Accept')
+    return resp
+
+
+@app.route('/result/<analysis_id>')
+def analysis_result(analysis_id):
+    """Annotated image for one analysis (artifacts/<id>/annotated.jpg); ?size=thumb or medium for a smaller copy."""
+    if not artifacts.is_valid_id(analysis_id):
+        return jsonify({'success': False, 'error': 'Invalid analysis id'}), 404
+    out = artifacts.annotated_path(analysis_id)
+    if not out.exists():
+        return jsonify({'success': False, 'error': 'No output image found'}), 404
+    size = request.args.get('size', 'original')
+    if size != 'original':
+        return _sized_image(out, size, out.parent, mimetype='image/jpeg')
+    return send_file(out, mimetype='image/jpeg')
+
+
+@app.route('/result/<analysis_id>/detections')
+def analysis_detections(analysis_id):
+    """Structured workflow result (boxes, classes, confidences) for one analysis."""
+    if not artifacts.is_valid_id(analysis_id):
+        return jsonify({'success': False, 'error': 'Invalid analysis id'}), 404
+    path = artifacts.detections_path(analysis_id)
+    if not path.exists():
+        return jsonify({'success': False, 'error': 'No detections found'}), 404
+    return send_file(path, mimetype='application/json')
+
+
+@app.route('/result/<analysis_id>/summary')
+def analysis_summary(analysis_id):
+    """AI summary for an analysis as JSON, generated on first request."""
+    ctx = _summary_context(analysis_id)
+    if ctx is None:
+        return jsonify({'success': False, 'error': 'Analysis not found'}), 404
+    fields = _summarize_analysis(ctx)
+    resp = jsonify({'success': True, 'analysis_id': analysis_id, **fields})
+    if fields.get('ai_summary_pending'):
+        resp.headers['Retry-After'] = str(fields['summary_retry_after'])
+    return resp
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route('/result/<analysis_id>/summary/stream')
+def analysis_summary_stream(analysis_id):
+    """AI summary for an analysis as server-sent events, streamed as OpenAI generates it.
+
+    Events (data is JSON): "token" (next piece of text), "summary" (the whole
+    text, when it was already available), "pending" ({"retry_after": s},
+    OpenAI's breaker is open), "failed" (error message) and "done".
+    """
+    ctx = _summary_context(analysis_id)
+    if ctx is None:
+        return jsonify({'success': False, 'error': 'Analysis not found'}), 404
+
+    def events():
+        ai_summary = _cached_summary(ctx)
+        if ai_summary:
+            _store_summary(ctx, ai_summary)
+            yield _sse('summary', ai_summary)
+            yield _sse('done', None)
+            return
+        parts = []
+        _summary_event(analysis_id, 'summary_started', streamed=True)
+        started = time.time()
+        try:
+            for piece in stream_summary(ctx['filename'], ctx['concern_text'], ctx['detections_path']):
+                if not parts:
+                    # Time to first token is what the user actually waits for
+                    _summary_event(analysis_id, 'summary_first_token')
+                parts.append(piece)
+                yield _sse('token', piece)
+        except CircuitOpen as e:
+            _summary_event(analysis_id, 'summary_finished', outcome='pending')
+            yield _sse('pending', {'retry_after': int(e.retry_after + 0.999)})
+            return
+        except SummaryError as e:
+            _summary_event(analysis_id, 'summary_finished', outcome='error')
+            yield _sse('failed', str(e))
+            return
+        except Exception as e:
+            _summary_event(analysis_id, 'summary_finished', outcome='error')
+            yield _sse('failed', f'AI summarization failed: {str(e)[:300]}')
+            return
+        ai_summary = ''.join(parts).strip()
+        if not ai_summary:
+            _summary_event(analysis_id, 'summary_finished', outcome='error')
+            yield _sse('failed', 'No assistant content returned')
+            return
+        _store_summary(ctx, ai_summary, (time.time() - started) * 1000)
+        _summary_event(analysis_id, 'summary_finished', outcome='ok', chars=len(ai_summary))
+        yield _sse('done', None)
+
+    # No buffering anywhere on the way, so tokens reach the browser as they arrive
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/history')
+def analysis_history():
+    """This session's patient's analyses, newest first, as JSON.
+
+    Paged with ?limit= and ?before=<next_before of the previous page>.
+    """
+    profile_id = session.get('profile_id')
+    if not profile_id:
+        return jsonify({'success': False, 'error': 'No profile in this session'}), 404
+    rows, next_before = analyses.history(profile_id, before=request.args.get('before', type=int),
+                                         limit=request.args.get('limit', analyses.PAGE_SIZE, type=int))
+    items = []
+    for row in rows:
+        item = {k: v for k, v in row.items() if k not in ('seq', 'profile_id', 'image_hash', 'storage_key')}
+        item['original_url'] = url_for('uploaded_file', filename=row['storage_key'])
+        if row['status'] == DONE:
+            item['result_url'] = url_for('analysis_result', analysis_id=row['analysis_id'])
+        items.append(item)
+    return jsonify({'success': True, 'analyses': items, 'next_before': next_before})
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Per-stage latency histograms/quantiles, error and cache counters (Prometheus text format)."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/debug/http-stats')
+def http_stats():
+    """Per-host outbound request, handshake and connection-reuse counters, plus OpenAI breaker state."""
+    stats = http_client.get_client().stats()
+    stats['openai_breaker'] = openai_breaker.stats()
+    stats['openai_retry_budget'] = openai_retry_budget.stats()
+    return jsonify(stats)
+
+
+@app.route('/uploads/<path:filename>')
+def uploaded_file(filename):
+    """Serve original uploaded images from the uploads directory; ?size=thumb or medium for a smaller copy."""
+    # Dot directories are internal: .incoming/ (uploads in flight) and .derivatives/
+    if any(part.startswith('.') for part in filename.replace('\\', '/').split('/')):
+        return jsonify({'success': False, 'error': 'File not found'}), 404
+    size = request.args.get('size', 'original')
+    if size != 'original':
+        path = safe_join(str(UPLOAD_DIR), filename)
+        if path is not None and os.path.isfile(path):
+            # .derivatives/ mirrors the upload's subdirectory, so copies of same-named files don't mix
+            path = Path(path)
+            return _sized_image(path, size, UPLOAD_DIR / '.derivatives' / path.parent.relative_to(UPLOAD_DIR))
+    # Use send_from_directory for safety
+    return send_from_directory(str(UPLOAD_DIR), filename)
+
+
+@app.route('/send-to-doctor', methods=['POST'])
+def send_to_doctor():
+    """Queue an email to the stored doctor_email with concerns and both original and annotated images.
+
+    Expects JSON body or form with optional 'analysis_id' and 'concern' override. A given
+    analysis_id must be this session's upload or one of its patient's analyses (400 if malformed,
+    404 otherwise). Without one, the analysis defaults to this session's latest, then this
+    profile's latest; 'uploaded_filename' alone (older clients) attaches just that upload.
+    Answers 202 with the outbox message_id and its status_url once the message is stored.
+    """
+    # Which fields arrived (never their values: they're patient data)
+    body = request.get_json(silent=True)
+    log.debug('send_to_doctor', extra={
+        'form_fields': sorted(request.form.keys()),
+        'json_fields': sorted(body.keys()) if isinstance(body, dict) else [],
+        'has_patient_contact': bool(session.get('patient_email')),
+        'has_doctor_contact': bool(session.get('doctor_email')),
+    })
+
+    # uploaded_filename only matters for older clients that don't send an analysis_id
+    uploaded_filename = request.form.get('uploaded_filename') or (request.json or {}).get('uploaded_filename') if request.is_json else None
+    concern = request.form.get('concern') or (request.json or {}).get('concern') if request.is_json else None
+    # Which analysis to attach: explicit analysis_id, else this session's latest,
+    # else the profile's latest (one indexed query either way)
+    analysis_id = (request.json or {}).get('analysis_id') if request.is_json else request.form.get('analysis_id')
+    if analysis_id:
+        # Never swap in another analysis for the one the user picked
+        if not artifacts.is_valid_id(analysis_id):
+            return jsonify({'success': False, 'error': 'Invalid analysis id'}), 400
+        analysis = _analysis_row(analysis_id)
+        # Only this session's upload or its patient's analyses; others look unknown
+        if analysis is None or not (analysis_id == session.get('last_analysis_id') or (
+                analysis['profile_id'] is not None and analysis['profile_id'] == session.get('profile_id'))):
+            return jsonify({'success': False, 'error': 'Analysis not found'}), 404
+    else:
+        # Older clients send no analysis_id
+        analysis = _analysis_row(session.get('last_analysis_id'))
+        if analysis is None and session.get('profile_id'):
+            analysis = analyses.latest_for_profile(session['profile_id'])
+
+    # Best-effort: use session values if present
+    doctor_email = session.get('doctor_email') or request.form.get('doctor_email') or (request.json or {}).get('doctor_email')
+    patient_email = session.get('patient_email')
+
+    if not doctor_email:
+        return jsonify({'success': False, 'error': 'No doctor email available'}), 400
+
+    # Build attachments: uploaded original in uploads/<storage_key> and the annotated image in artifacts/<id>/
+    attachments = []
+    if analysis is not None:
+        uploaded_filename = analysis['storage_key']
+        concern = concern or analysis['concern']
+    if uploaded_filename:
+        upath = UPLOAD_DIR / os.path.basename(uploaded_filename)
+        if upath.exists():
+            attachments.append(str(upath))
+    # annotated output
+    if analysis is not None:
+        annotated = artifacts.annotated_path(analysis['analysis_id'])
+        if annotated.exists():
+            attachments.append(str(annotated))
+
+    if not attachments:
+        return jsonify({'success': False, 'error': 'No files available to attach'}), 400
+
+    # Compose email body
+    body_lines = []
+    body_lines.append('Dear Provider,')
+    body_lines.append('')
+    body_lines.append('A patient has submitted dental images via the Open Wide app. See attachments for the original and annotated images.')
+    body_lines.append('')
+    if patient_email:
+        body_lines.append(f'Patient contact email: {patient_email}')
+    if concern:
+        body_lines.append('Patient concerns:')
+        body_lines.append(concern)
+
+    body_lines.append('')
+    body_lines.append('This message was sent from the Open Wide app.')
+
+    subject = 'Dental images from Open Wide'
+
+    # Check if caller requested a random from-address
+    random_from_flag = False
+    try:
+        if request.is_json:
+            random_from_flag = bool((request.json or {}).get('random_from'))
+        else:
+            random_from_flag = bool(request.form.get('random_from'))
+    except Exception:
+        random_from_flag = False
+
+    # Environment can also force random-from behavior
+    if os.environ.get('SMTP_RANDOM_FROM', '').lower() in ('1','true','yes'):
+        random_from_flag = True
+
+    # Queued for the outbox workers (outbox.py); delivery is reported by /outbox/<message_id>
+    try:
+        message_id = outbox.get_outbox().enqueue(
+            doctor_email, subject, '\n'.join(body_lines), attachments, reply_to=patient_email,
+            sender=outbox.random_from_address() if random_from_flag else None,
+            analysis_id=analysis['analysis_id'] if analysis is not None else None)
+    except Exception as e:
+        log.error('outbox enqueue failed', extra={'error': str(e)})
+        return jsonify({'success': False, 'error': 'Could not queue the email (internal error)'}), 500
+    return jsonify({
+        'success': True,
+        'message': 'Email queued',
+        'message_id': message_id,
+        'status': outbox.QUEUED,
+        'status_url': url_for('outbox_status', message_id=message_id),
+    }), 202
+
+
+@app.route('/dispatch', methods=['POST'])
+def dispatch_reports():
+    """Send many analyses' reports at once, as one digest email per doctor (dispatch.py).
+
+    JSON body: {"analysis_ids": [...]} (each to its patient's doctor) or
+    {"doctor_email": ..., "since": <ISO date>, "limit": n} (that doctor's
+    patients' finished analyses, newest first; a since with a UTC offset is
+    converted to UTC like the stored times). With "wait": <seconds> (max 60)
+    the response waits for delivery; otherwise it is 202 right after queueing.
+    Provider API: requires PROFILE_API_TOKEN like /profiles.
+    """
+    denied = _check_api_token()
+    if denied:
+        return denied
+    body = request.get_json(silent=True) or {}
+    analysis_ids = body.get('analysis_ids')
+    doctor_email = body.get('doctor_email')
+    if analysis_ids is not None:
+        if not isinstance(analysis_ids, list) or not all(isinstance(a, str) for a in analysis_ids):
+            return jsonify({'success': False, 'error': 'analysis_ids must be a list of strings'}), 400
+        if len(analysis_ids) > dispatch.DISPATCH_MAX_ITEMS:
+            return jsonify({'success': False, 'error': f'At most {dispatch.DISPATCH_MAX_ITEMS} analyses per batch'}), 400
+    elif not doctor_email:
+        return jsonify({'success': False, 'error': 'Pass analysis_ids or doctor_email'}), 400
+    try:
+        limit = int(body.get('limit', dispatch.DISPATCH_MAX_ITEMS))
+        wait = min(float(body.get('wait', 0)), 60.0)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'limit and wait must be numbers'}), 400
+    # NaN compares false with everything, so "not >= 0" catches it too
+    if not wait >= 0:
+        return jsonify({'success': False, 'error': 'wait must be a non-negative number'}), 400
+    since = body.get('since')
+    if since is not None:
+        # Compared as text with created_at (naive UTC ISO), so normalize it to that form
+        try:
+            parsed = datetime.fromisoformat(since)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'since must be an ISO date or date-time'}), 400
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        since = parsed.isoformat()
+
+    try:
+        batch_id, items = dispatch.dispatch(analysis_ids, doctor_email, since, limit)
+    except Exception as e:
+        log.error('dispatch failed', extra={'error': str(e)})
+        return jsonify({'success': False, 'error': 'Could not queue the reports (internal error)'}), 500
+    log.info('dispatch queued', extra={'batch_id': batch_id, 'analyses': len(items)})
+    status_url = url_for('dispatch_status', batch_id=batch_id)
+    if not items:
+        return jsonify({'success': True, 'batch_id': batch_id, 'items': [], 'status_url': None})
+    if wait > 0:
+        report = dispatch.wait(batch_id, wait)
+        return jsonify(dict(report, success=True, status_url=status_url)), 200 if report['done'] else 202
+    return jsonify({'success': True, 'batch_id': batch_id, 'items': items, 'status_url': status_url}), 202
+
+
+@app.route('/dispatch/<batch_id>')
+def dispatch_status(batch_id):
+    """Per-analysis outcomes of a dispatch batch, with its delivery rate in messages/sec."""
+    denied = _check_api_token()
+    if denied:
+        return denied
+    report = dispatch.status(batch_id)
+    if report is None:
+        return jsonify({'success': False, 'error': 'unknown batch_id'}), 404
+    return jsonify(dict(report, success=True))
+
+
+@app.route('/outbox/<message_id>')
+def outbox_status(message_id):
+    """Delivery status of a message queued by /send-to-doctor."""
+    status = outbox.get_outbox().status(message_id)
+    if status is None:
+        return jsonify({'error': 'unknown message_id'}), 404
+    return jsonify(status)
+
+
+if __name__ == '__main__':
+    # Helpful startup checks
+    if INFERENCE_MODE == 'subprocess' and not VENV_PY.exists():
+        log.warning(f"venv python not found at {VENV_PY}. Create venv311 and install deps first.")
+    log.info('Starting server on http://127.0.0.1:5000')
     app.run(host='127.0.0.1', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,225 @@
+"""Local email spool: messages kept when SMTP isn't configured, each attachment stored once.
+
+The outbox used to save such a message as a JSON file and copy every
+attachment into a new <file>_attachments directory. Each send, resend and
+digest (dispatch.py) of the same analysis copied the same images again, and
+nothing listed the directory. The spool (outgoing_emails/, EMAIL_SPOOL_DIR)
+keeps:
+
+- attachments once per content, as blobs/<sha256[:2]>/<sha256>. A blob is a
+  hard link to the upload or artifact it came from, so it takes no extra
+  space while that file exists and keeps the content if it is deleted. It
+  is a copy where a hard link isn't possible (another filesystem).
+- an index, index.db (SQLite, schema in SPOOL_MIGRATIONS), with one row per
+  message: its headers and body, its attachments as (sha256, name, size),
+  and whether it has been replayed.
+
+tools/replay_spool.py lists the spool and sends the pending messages to a
+real SMTP server once one is configured. It can also import email_*.json
+files saved in the old format and prune what was sent.
+"""
+import json
+import os
+import shutil
+import threading
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import attachment_cache
+import db
+
+APP_ROOT = Path(__file__).parent.resolve()
+SPOOL_DIR = Path(os.environ.get('EMAIL_SPOOL_DIR', APP_ROOT / 'outgoing_emails'))
+
+PENDING = 'pending'
+SENT = 'sent'
+FAILED = 'failed'
+
+SPOOL_MIGRATIONS = [
+    (1, 'spooled messages', [
+        # attachments: JSON [[sha256, file name, size], ...], each under blobs/;
+        # bytes: their total size, as sent without the spool's deduplication
+        """
+        CREATE TABLE messages (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id TEXT NOT NULL UNIQUE,
+            sender TEXT,
+            recipient TEXT NOT NULL,
+            reply_to TEXT,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            attachments TEXT NOT NULL,
+            bytes INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TEXT NOT NULL,
+            replayed_at TEXT
+        )
+        """,
+        # The replayer's scan, in spool order; sent rows drop out of it
+        "CREATE INDEX messages_pending ON messages (seq) WHERE status = 'pending'",
+    ]),
+]
+
+COLUMNS = ('seq', 'message_id', 'sender', 'recipient', 'reply_to', 'subject', 'body', 'attachments', 'bytes',
+           'status', 'attempts', 'last_error', 'created_at', 'replayed_at')
+_INSERT = """
+    INSERT INTO messages (message_id, sender, recipient, reply_to, subject, body, attachments, bytes, created_at)
+    VALUES (?,?,?,?,?,?,?,?,?) ON CONFLICT (message_id) DO NOTHING RETURNING seq
+"""
+_PENDING = f"SELECT {', '.join(COLUMNS)} FROM messages WHERE status = 'pending' AND seq > ? ORDER BY seq LIMIT ?"
+_LIST = f"SELECT {', '.join(COLUMNS)} FROM messages ORDER BY seq DESC LIMIT ?"
+_COUNTS = "SELECT status, COUNT(*), COALESCE(SUM(bytes), 0) FROM messages GROUP BY status"
+_SENT = "UPDATE messages SET status = 'sent', attempts = attempts + 1, last_error = NULL, replayed_at = ? WHERE seq = ?"
+_NOT_SENT = "UPDATE messages SET status = ?, attempts = attempts + 1, last_error = ? WHERE seq = ?"
+
+
+def _now():
+    return datetime.utcnow().isoformat()
+
+
+class Spool:
+    def __init__(self, root=SPOOL_DIR):
+        self.root = Path(root)
+        self.index_path = self.root / 'index.db'
+        self._lock = threading.Lock()
+        self._db = None
+
+    def database(self) -> db.Database:
+        """The index (created and migrated on first use)."""
+        with self._lock:
+            if self._db is None:
+                self.root.mkdir(parents=True, exist_ok=True)
+                db.migrate(self.index_path, SPOOL_MIGRATIONS)
+                self._db = db.Database(self.index_path, pool_size=2)
+            return self._db
+
+    def blob_path(self, digest) -> Path:
+        return self.root / 'blobs' / digest[:2] / digest
+
+    def _store_blob(self, src: Path, digest: str) -> Path:
+        blob = self.blob_path(digest)
+        if blob.exists():
+            return blob
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        tmp = blob.parent / f'.{uuid.uuid4().hex}.tmp'
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+        # Another worker may have just stored the same content: either will do
+        os.replace(tmp, blob)
+        return blob
+
+    def put(self, item, files) -> bool:
+        """Spool a message (an outbox row) with files, (path, name) pairs; missing files are left out.
+
+        Returns False if the message_id was spooled already.
+        """
+        hashes = attachment_cache.get_cache()
+        stored = []
+        for src, name in files:
+            try:
+                digest = hashes.content_hash(src)
+                self._store_blob(src, digest)
+                stored.append((src, [digest, name, src.stat().st_size]))
+            except OSError:
+                continue
+        attachments = [entry for _, entry in stored]
+        added = self.database().write(_INSERT, (
+            item['message_id'], item['sender'], item['recipient'], item['reply_to'], item['subject'], item['body'],
+            json.dumps(attachments), sum(size for _, _, size in attachments), _now()))
+        # prune() may have removed a blob between storing it and the row referencing it
+        for src, (digest, _, _) in stored:
+            if not self.blob_path(digest).exists():
+                try:
+                    self._store_blob(src, digest)
+                except OSError:
+                    pass
+        return added is not None
+
+    def pending(self, after=0, limit=500) -> list[dict]:
+        """Messages not replayed yet with a seq above after, in spool order."""
+        return [dict(zip(COLUMNS, r)) for r in self.database().query(_PENDING, (after, limit))]
+
+    def latest(self, limit=20) -> list[dict]:
+        return [dict(zip(COLUMNS, r)) for r in self.database().query(_LIST, (limit,))]
+
+    def outbox_item(self, row) -> dict:
+        """The row as outbox.compose() takes it, attachments read from their blobs."""
+        attachments = [[str(self.blob_path(digest)), name] for digest, name, _ in json.loads(row['attachments'])]
+        return {**row, 'attachments': json.dumps(attachments)}
+
+    def mark_sent(self, seq):
+        """Record the replay of a message; returns the write's future (see db.Database.submit)."""
+        return self.database().submit(_SENT, (_now(), seq))
+
+    def mark_failed(self, seq, error, permanent=False):
+        """Record a failed replay; temporary failures stay pending for the next run."""
+        return self.database().submit(_NOT_SENT, (FAILED if permanent else PENDING, error, seq))
+
+    def prune(self) -> tuple[int, int]:
+        """Drop sent messages and the blobs nothing else refers to. Returns (messages, blobs) removed."""
+        self.database()
+        conn = db.connect(self.index_path)
+        try:
+            # Holds off put() from adding a row until the unreferenced blobs are gone
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                removed = conn.execute("DELETE FROM messages WHERE status = 'sent'").rowcount
+                keep = set()
+                for (attachments,) in conn.execute('SELECT attachments FROM messages'):
+                    keep.update(digest for digest, _, _ in json.loads(attachments))
+                blobs = 0
+                for blob in (self.root / 'blobs').glob('*/*'):
+                    if blob.name not in keep and not blob.name.startswith('.'):
+                        blob.unlink(missing_ok=True)
+                        blobs += 1
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+        return removed, blobs
+
+    def stats(self) -> dict:
+        """Messages and attachment bytes per status, and the blobs those share."""
+        counts = {status: {'messages': n, 'attachment_bytes': size}
+                  for status, n, size in self.database().query(_COUNTS)}
+        blobs = [p for p in (self.root / 'blobs').glob('*/*') if not p.name.startswith('.')]
+        return {'messages': counts, 'blobs': len(blobs), 'blob_bytes': sum(p.stat().st_size for p in blobs)}
+
+    def import_legacy(self) -> int:
+        """Spool the email_*.json files (and <file>_attachments) saved in the old format, then delete them.
+
+        Returns how many were imported.
+        """
+        imported = 0
+        for path in sorted(self.root.glob('email_*.json')):
+            payload = json.loads(path.read_text(encoding='utf-8'))
+            attach_dir = self.root / (path.name + '_attachments')
+            files = [(attach_dir / name, name) for name in payload.get('attachments', [])]
+            self.put({'message_id': payload.get('message_id') or path.stem, 'sender': payload.get('from'),
+                      'recipient': payload['to'], 'reply_to': payload.get('reply_to'),
+                      'subject': payload.get('subject') or '', 'body': payload.get('body') or ''}, files)
+            # The content is in blobs/ now
+            shutil.rmtree(attach_dir, ignore_errors=True)
+            path.unlink()
+            imported += 1
+        return imported
+
+
+_spool = None
+_spool_lock = threading.Lock()
+
+
+def get_spool() -> Spool:
+    """The process-wide spool (created on first use)."""
+    global _spool
+    with _spool_lock:
+        if _spool is None:
+            _spool = Spool()
+        return _spool
@@ -0,0 +1,96 @@
+"""Measure email composition time and size with the attachment cache.
+
+Usage (from the project root):
+    python tools/bench_attachments.py uploads/capture.jpg artifacts/<id>/annotated.jpg --emails 50
+    python tools/bench_attachments.py photos/*.jpg --max-edge 1600
+
+Composes --emails messages carrying the given files, as if sending the same
+analysis to that many doctors (or resending it), three ways:
+
+- legacy:  read, type-guess and base64-encode every file for every email,
+           and flatten it with the stock generator, as send_email_smtp() did
+- cached:  outbox.compose() with attachment_cache.py, originals
+- resized: the same with the images downsized to --max-edge pixels
+
+and reports milliseconds per email to compose and to flatten (the bytes
+smtplib sends), and the size of each message as sent over SMTP.
+"""
+import argparse
+import json
+import mimetypes
+import sys
+import tempfile
+import time
+from email.generator import BytesGenerator
+from email.message import EmailMessage
+from io import BytesIO
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import attachment_cache  # noqa: E402
+import outbox  # noqa: E402
+
+
+def legacy_compose(paths):
+    msg = EmailMessage()
+    msg['From'] = 'bench@example.com'
+    msg['To'] = 'doctor@example.com'
+    msg['Subject'] = 'Dental images from Open Wide'
+    msg.set_content('Dear Provider,')
+    for path in paths:
+        ctype, _ = mimetypes.guess_type(str(path))
+        maintype, subtype = (ctype or 'application/octet-stream').split('/', 1)
+        with open(path, 'rb') as fh:
+            msg.add_attachment(fh.read(), maintype=maintype, subtype=subtype, filename=path.name)
+    return msg
+
+
+def legacy_flatten(msg):
+    buf = BytesIO()
+    BytesGenerator(buf).flatten(msg, linesep='\r\n')
+    return buf.getvalue()
+
+
+def run(label, compose, flatten, emails):
+    """Compose and flatten (what smtplib sends) emails messages; prints ms per email for each and the size."""
+    composing = flattening = 0.0
+    for _ in range(emails):
+        t0 = time.perf_counter()
+        msg = compose()
+        t1 = time.perf_counter()
+        data = flatten(msg)
+        composing += t1 - t0
+        flattening += time.perf_counter() - t1
+    print(f'{label:<8} {composing / emails * 1000:>10.2f}ms {flattening / emails * 1000:>10.2f}ms '
+          f'{len(data) / 1024:>10.0f} KB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='+', type=Path)
+    parser.add_argument('--emails', type=int, default=50)
+    parser.add_argument('--max-edge', type=int, default=1600, help='longest image edge for the resized run')
+    args = parser.parse_args()
+
+    item = {'message_id': 'bench', 'sender': 'bench@example.com', 'reply_to': None, 'recipient': 'doctor@example.com',
+            'subject': 'Dental images from Open Wide', 'body': 'Dear Provider,',
+            'attachments': json.dumps([str(p) for p in args.files])}
+    total = sum(p.stat().st_size for p in args.files)
+    print(f'{len(args.files)} files, {total / 1024:.0f} KB, {args.emails} emails')
+    print(f'{"":<8} {"compose":>12} {"flatten":>12} {"message":>13}')
+    run('legacy', lambda: legacy_compose(args.files), legacy_flatten, args.emails)
+
+    tmp = Path(tempfile.mkdtemp(prefix='bench_attachments_'))
+    attachment_cache._cache = attachment_cache.AttachmentCache(root=tmp)
+    run('cached', lambda: outbox.compose(item), attachment_cache.to_bytes, args.emails)
+
+    attachment_cache.EMAIL_ATTACHMENT_MAX_EDGE = args.max_edge
+    attachment_cache._cache = attachment_cache.AttachmentCache(root=tmp)
+    run('resized', lambda: outbox.compose(item), attachment_cache.to_bytes, args.emails)
+    print(f'cache: {attachment_cache._cache.stats()}')
+
+
+if __name__ == '__main__':
+    main()
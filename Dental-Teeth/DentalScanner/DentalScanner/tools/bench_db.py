@@ -0,0 +1,114 @@
+"""Write-throughput benchmark for the profile inserts (db.py).
+
+Usage (from the project root):
+    python tools/bench_db.py --threads 16 --inserts 200
+
+Each of --threads threads inserts --inserts profile rows as fast as it can,
+like concurrent /save-profile requests, against a fresh database in a temp
+directory, two ways:
+
+- legacy: what save_profile() used to do, a new connection per insert on
+          the default rollback journal, committing each insert
+- db.py:  Database.write() with pooled WAL connections and group commit
+
+and reports inserts/s, per-insert latency percentiles and how many inserts
+failed (e.g. "database is locked" once busy waits exceed the timeout).
+"""
+import argparse
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import db  # noqa: E402
+
+INSERT = ("INSERT INTO profiles (first_name, last_name, provider, dob, patient_email, doctor_email, created_at) "
+          "VALUES (?,?,?,?,?,?,?)")
+
+
+def row(i):
+    return ('Bench', f'User{i}', 'Open Wide Dental', '1990-01-01', f'patient{i}@example.com',
+            'doctor@example.com', datetime.utcnow().isoformat())
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def legacy_insert(path, timeout):
+    def insert(i):
+        conn = sqlite3.connect(path, timeout=timeout)
+        try:
+            conn.execute(INSERT, row(i))
+            conn.commit()
+        finally:
+            conn.close()
+    return insert
+
+
+def run(label, insert, threads, inserts):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    start = threading.Barrier(threads + 1)
+
+    def worker(offset):
+        local, failed = [], []
+        start.wait()
+        for i in range(inserts):
+            t0 = time.perf_counter()
+            try:
+                insert(offset + i)
+                local.append(time.perf_counter() - t0)
+            except sqlite3.Error as e:
+                failed.append(str(e))
+        with lock:
+            latencies.extend(local)
+            errors.extend(failed)
+
+    pool = [threading.Thread(target=worker, args=(n * inserts,)) for n in range(threads)]
+    for t in pool:
+        t.start()
+    start.wait()
+    t0 = time.perf_counter()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    print(f'{label:<8} {len(latencies) / elapsed:>10.0f}/s {percentile(latencies, 0.5) * 1000:>8.2f}ms '
+          f'{percentile(latencies, 0.99) * 1000:>8.2f}ms {max(latencies, default=0) * 1000:>8.2f}ms {len(errors):>7}'
+          + (f'  ({errors[0]})' if errors else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--inserts', type=int, default=200, help='inserts per thread')
+    parser.add_argument('--timeout', type=float, default=5.0, help='legacy busy timeout in seconds')
+    args = parser.parse_args()
+
+    tmp = Path(tempfile.mkdtemp(prefix='bench_db_'))
+    print(f'{args.threads} threads x {args.inserts} inserts, synchronous={db.DB_SYNCHRONOUS}')
+    print(f'{"":<8} {"inserts":>12} {"p50":>10} {"p99":>10} {"max":>10} {"errors":>7}')
+
+    legacy_path = str(tmp / 'legacy.db')
+    conn = sqlite3.connect(legacy_path)
+    conn.execute(db.MIGRATIONS[0][2][0])
+    conn.close()
+    run('legacy', legacy_insert(legacy_path, args.timeout), args.threads, args.inserts)
+
+    path = tmp / 'pooled.db'
+    db.migrate(path)
+    database = db.Database(path)
+    run('db.py', lambda i: database.write(INSERT, row(i)), args.threads, args.inserts)
+    database.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Bytes served and time to make each image size and format (derivatives.py).
+
+Usage (from the project root):
+    python tools/bench_derivatives.py uploads/capture.jpg artifacts/<id>/annotated.jpg
+    python tools/bench_derivatives.py photos/*.jpg --runs 3
+
+For every size and every format this Pillow build can write, makes the
+copies of the given images in a temp directory --runs times and reports the
+milliseconds to make one (what the first request waits for; later ones are
+served from disk) and the bytes sent, against the originals.
+"""
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import derivatives  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='+', type=Path)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+    if not derivatives.available():
+        sys.exit('Pillow is not installed')
+
+    original = sum(p.stat().st_size for p in args.files)
+    print(f'{len(args.files)} files, {original / 1024:.0f} KB')
+    print(f'{"size":<8} {"format":<6} {"make":>10} {"bytes":>10} {"of original":>12}')
+    for size in derivatives.SIZES:
+        for fmt in derivatives.FORMATS:
+            if not derivatives.can_write(fmt):
+                print(f'{size:<8} {fmt:<6} {"(not supported by this Pillow)":>34}')
+                continue
+            elapsed, total = 0.0, 0
+            for _ in range(args.runs):
+                # A fresh directory each run, so every copy is made again
+                with tempfile.TemporaryDirectory(prefix='bench_derivatives_') as tmp:
+                    t0 = time.perf_counter()
+                    outs = [derivatives.derivative(p, size, fmt, tmp) for p in args.files]
+                    elapsed += time.perf_counter() - t0
+                    total = sum(p.stat().st_size for p in outs)
+            per_image = elapsed / args.runs / len(args.files) * 1000
+            print(f'{size:<8} {fmt:<6} {per_image:>8.1f}ms {total / 1024:>8.0f}KB {total / original:>11.1%}')
+
+
+if __name__ == '__main__':
+    main()
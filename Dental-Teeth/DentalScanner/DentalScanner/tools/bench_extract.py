@@ -0,0 +1,100 @@
+"""Benchmark pulling the annotated image out of workflow results.
+
+Usage (from the project root):
+    python tools/bench_extract.py --runs 20
+
+Builds synthetic workflow results with a base64 output_image of increasing
+size and a few hundred predictions, then times three ways of writing the image:
+
+- known:   main._save_and_open_image_from_result on the workflow schema
+           (direct key lookup + chunked base64 decode to the file)
+- unknown: the same data under a key the fast path doesn't know, so the
+           heuristic walk (recursive search, regex sniffing) finds it
+- legacy:  the previous behaviour, walk + regex + decoding the whole image
+           in memory before writing it
+
+Peak Python memory for each is measured with tracemalloc.
+"""
+import argparse
+import base64
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import main as workflow  # noqa: E402
+
+
+def make_result(image_bytes, predictions, known=True):
+    preds = [{
+        'width': 31.0, 'height': 35.0, 'x': 10.0 + i, 'y': 17.5, 'confidence': 0.87,
+        'class_id': 3, 'class': 'Tooth', 'detection_id': str(uuid.uuid4()), 'parent_id': 'image',
+    } for i in range(predictions)]
+    encoded = base64.b64encode(os.urandom(image_bytes)).decode('ascii')
+    output = {'predictions': {'image': {'width': 4000, 'height': 3000}, 'predictions': preds}}
+    # Unknown schema: same data under a key the fast path doesn't know, after the predictions
+    output['output_image' if known else 'visualization'] = encoded
+    return [output]
+
+
+def legacy_save(result, out_path):
+    def find_image(obj):
+        if isinstance(obj, str) and len(obj) > 200 and re.fullmatch(r"[A-Za-z0-9+/=\n\r]+", obj[:1000]):
+            return obj
+        values = obj.values() if isinstance(obj, dict) else obj if isinstance(obj, list) else ()
+        for v in values:
+            found = find_image(v)
+            if found:
+                return found
+        return None
+
+    with open(out_path, 'wb') as f:
+        f.write(base64.b64decode(find_image(result)))
+
+
+def current_save(result, out_path):
+    workflow._save_and_open_image_from_result(result, out_path=out_path, open_viewer=False)
+
+
+def measure(save, result, out_path, runs):
+    timings = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        save(result, out_path)
+        timings.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    save(result, out_path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(timings), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='40000,400000,4000000', help='decoded image sizes in bytes')
+    parser.add_argument('--predictions', type=int, default=300)
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    out_path = Path(tempfile.mkdtemp(prefix='bench_extract_')) / 'output.jpg'
+    print(f'{"image":>10} {"schema":<8} {"p50":>10} {"peak mem":>12}')
+    for size in (int(s) for s in args.sizes.split(',')):
+        known = make_result(size, args.predictions, known=True)
+        cases = (('known', current_save, known),
+                 ('unknown', current_save, make_result(size, args.predictions, known=False)),
+                 ('legacy', legacy_save, known))
+        for label, save, result in cases:
+            t, peak = measure(save, result, out_path, args.runs)
+            print(f'{size / 1024:>8.0f}KB {label:<8} {t * 1000:>8.2f}ms {peak / 1024:>10.0f}KB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Compare per-request latency of the in-process engine vs. the main.py subprocess.
+
+Usage (from the project root, with ROBOFLOW_API_KEY set or in .env):
+    python tools/bench_inference.py uploads/capture.jpg --runs 10
+
+Both modes call the real workflow, so the difference between them is the
+per-request start-up cost (interpreter, SDK import, client/TLS setup).
+"""
+import argparse
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+load_dotenv(dotenv_path=ROOT / '.env')
+
+import inference_engine  # noqa: E402
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+def bench(label, fn, runs):
+    timings = []
+    for i in range(runs):
+        t0 = time.perf_counter()
+        try:
+            fn()
+        except inference_engine.InferenceError as e:
+            print(f'{label} run {i + 1} failed: {e}')
+            continue
+        timings.append(time.perf_counter() - t0)
+    if not timings:
+        print(f'{label:<11} no successful runs')
+        return
+    print(f'{label:<11} n={len(timings):<3} mean={statistics.mean(timings):.3f}s '
+          f'p50={percentile(timings, 50):.3f}s p95={percentile(timings, 95):.3f}s '
+          f'first={timings[0]:.3f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('image', help='image to run through the workflow')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--python', default=sys.executable, help='interpreter for the subprocess mode')
+    args = parser.parse_args()
+
+    image = Path(args.image).resolve()
+    workdir = Path(tempfile.mkdtemp(prefix='bench_inference_'))
+    engine = inference_engine.InferenceEngine()
+
+    bench('inprocess', lambda: engine.analyze(image, workdir / 'output.jpg', workdir / 'output_result.json'), args.runs)
+    bench('subprocess', lambda: inference_engine.run_subprocess(image, workdir / 'output.jpg', workdir / 'output_result.json', args.python), args.runs)
+
+
+if __name__ == '__main__':
+    main()
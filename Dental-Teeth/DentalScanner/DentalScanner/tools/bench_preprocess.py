@@ -0,0 +1,90 @@
+"""Measure bytes sent and latency with and without image normalization.
+
+Usage (from the project root):
+    python tools/bench_preprocess.py uploads/capture.jpg photos/*.jpg
+    python tools/bench_preprocess.py uploads/capture.jpg --live --runs 5
+
+For each image this reports the size of the workflow request body (the image
+is sent base64-encoded in JSON) for the original and the normalized copy, and
+the time normalize_image() takes. With --live (needs ROBOFLOW_API_KEY) it also
+runs the real workflow on both and reports end-to-end latency.
+"""
+import argparse
+import base64
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+load_dotenv(dotenv_path=ROOT / '.env')
+
+import inference_engine  # noqa: E402
+import preprocess  # noqa: E402
+
+
+def payload_bytes(path):
+    # Roughly what WorkflowClient.run_workflow puts on the wire
+    return len(base64.b64encode(Path(path).read_bytes()))
+
+
+def timed(fn, runs):
+    timings = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - t0)
+    return timings
+
+
+def fmt_kb(n):
+    return f'{n / 1024:,.0f} KB'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('images', nargs='+', help='images to normalize')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-edge', type=int, default=preprocess.PREPROCESS_MAX_EDGE)
+    parser.add_argument('--quality', type=int, default=preprocess.PREPROCESS_JPEG_QUALITY)
+    parser.add_argument('--live', action='store_true', help='also time the real workflow on original vs normalized')
+    args = parser.parse_args()
+
+    if not preprocess.available():
+        sys.exit('Pillow is not installed; normalization is a no-op.')
+
+    workdir = Path(tempfile.mkdtemp(prefix='bench_preprocess_'))
+    engine = inference_engine.InferenceEngine() if args.live else None
+    total_before = total_after = 0
+
+    for i, image in enumerate(args.images):
+        image = Path(image).resolve()
+        dest = workdir / f'normalized-{i}.jpg'
+        timings = timed(lambda: preprocess.normalize_image(image, dest, args.max_edge, args.quality), args.runs)
+        sent = preprocess.normalize_image(image, dest, args.max_edge, args.quality)
+        before, after = payload_bytes(image), payload_bytes(sent)
+        total_before += before
+        total_after += after
+        print(f'{image.name}: {fmt_kb(before)} -> {fmt_kb(after)} ({after / before:.0%}), '
+              f'normalize p50={statistics.median(timings) * 1000:.1f}ms'
+              + ('' if sent != image else ' (already normalized, sent as-is)'))
+
+        if engine is not None:
+            for label, path in (('original', image), ('normalized', sent)):
+                try:
+                    runs = timed(lambda: engine.analyze(path, workdir / 'annotated.jpg', workdir / 'detections.json'), args.runs)
+                except inference_engine.InferenceError as e:
+                    print(f'  {label:<10} failed: {e}')
+                    continue
+                print(f'  {label:<10} workflow mean={statistics.mean(runs):.3f}s p50={statistics.median(runs):.3f}s')
+
+    if len(args.images) > 1:
+        print(f'total: {fmt_kb(total_before)} -> {fmt_kb(total_after)} ({total_after / total_before:.0%})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""Benchmark profile lookups and upserts on a large profiles table.
+
+Usage (from the project root):
+    python tools/bench_profiles.py --rows 1000000
+
+Fills a fresh database in a temp directory with --rows synthetic profiles
+(--doctors distinct doctor emails, --providers distinct providers) at schema
+version 1, times the lookups in profiles.py as full table scans, then runs
+the remaining migrations (timed: de-duplication plus index builds) and
+times them again:
+
+- find by patient email, by name + dob
+- first page of a doctor's / provider's patients
+- walking every page of one provider's patients: keyset (id > after)
+  against LIMIT/OFFSET
+- upserts of returning patients (update) and new ones (insert)
+
+The query plan of each lookup is printed, to show which index it uses.
+"""
+import argparse
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import db  # noqa: E402
+import profiles  # noqa: E402
+
+FIRST = ['Ana', 'Ben', 'Chloe', 'Dev', 'Emma', 'Felix', 'Grace', 'Hugo', 'Iris', 'Jon', 'Kira', 'Liam',
+         'Maya', 'Noah', 'Olga', 'Pablo', 'Quinn', 'Rosa', 'Sam', 'Tara', 'Uma', 'Victor', 'Wen', 'Yusuf']
+
+
+def last_name(i):
+    return f'Surname{i % 5000}'
+
+
+def dob(rng):
+    return f'{rng.randint(1940, 2015)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}'
+
+
+def fill(path, rows, doctors, providers, seed):
+    rng = random.Random(seed)
+    conn = db.connect(path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    for sql in db.MIGRATIONS[0][2]:
+        conn.execute(sql)
+    conn.execute(f'PRAGMA user_version = {db.MIGRATIONS[0][0]:d}')
+    conn.execute('BEGIN')
+    conn.executemany(
+        'INSERT INTO profiles (first_name, last_name, provider, dob, patient_email, doctor_email, created_at) '
+        'VALUES (?,?,?,?,?,?,?)',
+        ((FIRST[i % len(FIRST)], last_name(i), f'Provider {rng.randrange(providers)}', dob(rng),
+          f'patient{i}@example.com', f'doctor{rng.randrange(doctors)}@example.com', '2025-01-01T00:00:00')
+         for i in range(rows)))
+    conn.execute('COMMIT')
+    return conn
+
+
+def time_it(fn, runs):
+    timings = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - t0)
+    return statistics.median(timings)
+
+
+def plan(conn, sql, params):
+    return '; '.join(row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params))
+
+
+def lookups(conn, args, rng):
+    """(label, sql, params) for each lookup, with keys that exist in the table."""
+    i = rng.randrange(args.rows)
+    row = conn.execute('SELECT first_name, last_name, dob, doctor_email, provider FROM profiles WHERE id = ?',
+                       (i + 1,)).fetchone()
+    return [
+        ('by patient email', profiles._BY_EMAIL, (f'PATIENT{i}@example.com', 0, profiles.PAGE_SIZE + 1)),
+        ('by name + dob', profiles._BY_NAME, (row[1], row[0], row[2], 0, profiles.PAGE_SIZE + 1)),
+        ('doctor, first page', profiles._BY_DOCTOR, (row[3], 0, profiles.PAGE_SIZE + 1)),
+        ('provider, first page', profiles._BY_PROVIDER, (row[4], 0, profiles.PAGE_SIZE + 1)),
+    ]
+
+
+def run_lookups(conn, cases, runs, show_plan):
+    for label, sql, params in cases:
+        t = time_it(lambda: conn.execute(sql, params).fetchall(), runs)
+        print(f'  {label:<22} {t * 1000:>10.3f}ms' + (f'   {plan(conn, sql, params)}' if show_plan else ''))
+
+
+def walk_provider(conn, provider, page):
+    """(pages, keyset seconds, offset seconds) for reading all of provider's rows."""
+    t0 = time.perf_counter()
+    after, pages = 0, 0
+    while True:
+        rows = conn.execute(profiles._BY_PROVIDER, (provider, after, page)).fetchall()
+        pages += 1
+        if len(rows) < page:
+            break
+        after = rows[-1][0]
+    keyset = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    offset = 0
+    while True:
+        rows = conn.execute('SELECT * FROM profiles WHERE provider = ? COLLATE NOCASE ORDER BY id LIMIT ? OFFSET ?',
+                            (provider, page, offset)).fetchall()
+        offset += page
+        if len(rows) < page:
+            break
+    return pages, keyset, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--doctors', type=int, default=2000)
+    parser.add_argument('--providers', type=int, default=300)
+    parser.add_argument('--runs', type=int, default=20, help='runs per indexed lookup (scans get a fifth)')
+    parser.add_argument('--upserts', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    path = Path(tempfile.mkdtemp(prefix='bench_profiles_')) / 'profiles.db'
+    rng = random.Random(args.seed)
+    t0 = time.perf_counter()
+    conn = fill(path, args.rows, args.doctors, args.providers, args.seed)
+    print(f'{args.rows} rows written in {time.perf_counter() - t0:.1f}s ({path.stat().st_size / 2**20:.0f} MB)')
+    cases = lookups(conn, args, rng)
+
+    print('without indexes:')
+    # The version 1 table has no updated_at column yet
+    scans = [(label, sql.replace(', updated_at', ''), params) for label, sql, params in cases]
+    run_lookups(conn, scans, max(1, args.runs // 5), show_plan=False)
+
+    t0 = time.perf_counter()
+    version = db.migrate(path)
+    print(f'migrated to version {version} in {time.perf_counter() - t0:.1f}s')
+    conn.close()
+    conn = db.connect(path)
+    conn.execute('ANALYZE')
+    print('with indexes:')
+    run_lookups(conn, cases, args.runs, show_plan=True)
+
+    provider = cases[3][2][0]
+    pages, keyset, offset = walk_provider(conn, provider, profiles.PAGE_SIZE)
+    print(f'  all of one provider    {pages} pages: keyset {keyset * 1000:.1f}ms, OFFSET {offset * 1000:.1f}ms')
+
+    database = db.Database(path)
+    existing = [conn.execute('SELECT first_name, last_name, dob, patient_email FROM profiles WHERE id = ?',
+                             (rng.randrange(args.rows) + 1,)).fetchone() for _ in range(args.upserts)]
+    t0 = time.perf_counter()
+    for first, last, birth, email in existing:
+        profiles.upsert(first, last, 'Provider 1', birth, email, 'doctor1@example.com', database=database)
+    updates = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for n in range(args.upserts):
+        profiles.upsert('New', f'Patient{n}', 'Provider 1', '1990-01-01', f'new{n}@example.com',
+                        'doctor1@example.com', database=database)
+    inserts = time.perf_counter() - t0
+    print(f'upserts (one thread): {args.upserts / updates:.0f}/s returning patients, {args.upserts / inserts:.0f}/s new')
+    rows = conn.execute('SELECT COUNT(*) FROM profiles').fetchone()[0]
+    print(f'rows afterwards: {rows} ({rows - args.rows} new, returning patients updated in place)')
+    database.close()
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
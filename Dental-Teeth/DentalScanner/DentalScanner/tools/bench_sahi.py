@@ -0,0 +1,171 @@
+"""Microbenchmark for the SAHI tiling + merge path (sahi.py).
+
+Usage (from the project root):
+    python tools/bench_sahi.py --teeth 300 --runs 20
+
+Builds a synthetic image crowded with small "Tooth" boxes like the ones in
+output_result.json. Each tooth is seen by every overlapping slice (plus the
+full-image pass) with a little jitter, so the merge has the same duplicate
+structure as real SAHI output. The model is replaced by a stub that returns
+those candidates in YOLOv8 output layout, so only our own code is timed:
+
+- slice window generation + tile gather
+- batched decode + remap + NMS (sliced_predict end to end)
+- NMS alone, against a straightforward per-box Python loop for reference
+  (the kept sets are checked to be identical)
+- NMS on a chain of --chain boxes, each overlapping only the next one with
+  a lower score: the worst case for the matrix-vector passes
+"""
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import sahi  # noqa: E402
+
+ANCHORS = 8400  # YOLOv8 at 640x640
+CLASSES = ['Tooth', 'Caries', 'Calculus', 'Gingivitis']
+
+
+def make_teeth(rng, width, height, count):
+    """(count, 4) xyxy boxes, 25-40 px, roughly like the workflow's teeth."""
+    wh = rng.uniform(25, 40, size=(count, 2))
+    c = rng.uniform([20, 20], [width - 20, height - 20], size=(count, 2))
+    return np.concatenate([c - wh / 2, c + wh / 2], axis=1)
+
+
+def stub_model(teeth, windows, ratio, input_size, rng, full_scale):
+    """Callable returning raw outputs in which each tile sees the teeth inside it."""
+    # Precompute per-tile outputs in the order sliced_predict sends tiles
+    outputs = []
+    tiles = [(w[0] / ratio, w[1] / ratio, ratio) for w in windows] + [(0.0, 0.0, full_scale)]
+    for ox, oy, scale in tiles:
+        local = (teeth - [ox, oy, ox, oy]) * scale
+        inside = (local[:, 0] >= 0) & (local[:, 1] >= 0) & (local[:, 2] <= input_size) & (local[:, 3] <= input_size)
+        local = local[inside] + rng.normal(0, 1.0, size=(inside.sum(), 4))
+        raw = np.zeros((4 + len(CLASSES), ANCHORS), dtype=np.float32)
+        # Background anchors get low scores
+        raw[4:] = rng.uniform(0, 0.2, size=(len(CLASSES), ANCHORS))
+        k = min(len(local), ANCHORS)
+        raw[0, :k] = (local[:k, 0] + local[:k, 2]) / 2
+        raw[1, :k] = (local[:k, 1] + local[:k, 3]) / 2
+        raw[2, :k] = local[:k, 2] - local[:k, 0]
+        raw[3, :k] = local[:k, 3] - local[:k, 1]
+        raw[4, :k] = rng.uniform(0.5, 0.95, size=k)
+        outputs.append(raw)
+    outputs = np.stack(outputs)
+    cursor = [0]
+
+    def run(blob):
+        start = cursor[0]
+        cursor[0] = (start + len(blob)) % len(outputs)
+        return outputs[start:start + len(blob)]
+    return run
+
+
+def make_chain(count):
+    """count 30 px boxes in a row, 5 px apart, scores falling along the row."""
+    x0 = np.arange(count, dtype=np.float64) * 5
+    boxes = np.stack([x0, np.zeros(count), x0 + 30, np.full(count, 30.0)], axis=1)
+    return boxes, np.linspace(0.95, 0.5, count), np.zeros(count, dtype=np.int64)
+
+
+def nms_reference(boxes, scores, class_ids, iou_threshold):
+    """Per-box greedy NMS in plain Python, for comparison."""
+    order = sorted(range(len(boxes)), key=lambda i: -scores[i])
+    keep = []
+    for i in order:
+        bi = boxes[i]
+        suppressed = False
+        for j in keep:
+            if class_ids[j] != class_ids[i]:
+                continue
+            bj = boxes[j]
+            iw = min(bi[2], bj[2]) - max(bi[0], bj[0])
+            ih = min(bi[3], bj[3]) - max(bi[1], bj[1])
+            inter = max(iw, 0) * max(ih, 0)
+            union = (bi[2] - bi[0]) * (bi[3] - bi[1]) + (bj[2] - bj[0]) * (bj[3] - bj[1]) - inter
+            if inter / max(union, 1e-9) > iou_threshold:
+                suppressed = True
+                break
+        if not suppressed:
+            keep.append(i)
+    return keep
+
+
+def timed(fn, runs):
+    timings = []
+    result = None
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - t0)
+    return result, timings
+
+
+def report(label, timings):
+    print(f'{label:<28} p50={statistics.median(timings) * 1000:8.2f}ms  min={min(timings) * 1000:8.2f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--width', type=int, default=2048)
+    parser.add_argument('--height', type=int, default=1536)
+    parser.add_argument('--teeth', type=int, default=300)
+    parser.add_argument('--slice', type=int, default=640)
+    parser.add_argument('--overlap', type=float, default=0.2)
+    parser.add_argument('--batch', type=int, default=16)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--chain', type=int, default=3000, help='boxes in the chain-shaped NMS case')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 255, size=(args.height, args.width, 3), dtype=np.uint8)
+    teeth = make_teeth(rng, args.width, args.height, args.teeth)
+    input_size = args.slice
+    windows = sahi.slice_windows(args.width, args.height, input_size, args.overlap)
+    full_scale = min(input_size / args.width, input_size / args.height, 1.0)
+    run_model = stub_model(teeth, windows, 1.0, input_size, rng, full_scale)
+    print(f'{args.width}x{args.height}, {args.teeth} teeth, {len(windows)} slices + full image')
+
+    _, t = timed(lambda: sahi.gather_tiles(image, sahi.slice_windows(args.width, args.height, input_size, args.overlap), input_size), args.runs)
+    report('slice + gather tiles', t)
+
+    (boxes, scores, class_ids), t = timed(lambda: sahi.sliced_predict(
+        image, run_model, input_size, args.slice, args.overlap, 0.4, 0.5, batch_size=args.batch), args.runs)
+    report('sliced_predict (stub model)', t)
+    print(f'{"":<28} {len(boxes)} boxes kept')
+
+    # NMS on the raw candidates the stub produces for one image
+    raw = run_model(np.zeros((len(windows) + 1, 3, 1, 1), dtype=np.float32))
+    tile_idx, cand, cand_scores, cand_classes = sahi.decode(raw, 0.4)
+    offsets = np.concatenate([windows[:, :2], [[0, 0]]]).astype(np.float32)
+    scales = np.append(np.ones(len(windows), dtype=np.float32), np.float32(full_scale))
+    cand = cand / scales[tile_idx, None] + np.tile(offsets[tile_idx], 2)
+    print(f'{"":<28} {len(cand)} candidates into NMS')
+
+    keep, t = timed(lambda: sahi.nms(cand, cand_scores, cand_classes, 0.5), args.runs)
+    report('nms (vectorized)', t)
+    ref, t = timed(lambda: nms_reference(cand.tolist(), cand_scores.tolist(), cand_classes.tolist(), 0.5), max(1, args.runs // 5))
+    report('nms (per-box loop)', t)
+    print('kept sets match' if sorted(keep.tolist()) == sorted(ref) else 'KEPT SETS DIFFER')
+
+    chain, chain_scores, chain_classes = make_chain(args.chain)
+    keep, t = timed(lambda: sahi.nms(chain, chain_scores, chain_classes, 0.5), args.runs)
+    report(f'nms chain of {args.chain}', t)
+    ref, t = timed(lambda: nms_reference(chain.tolist(), chain_scores.tolist(), chain_classes.tolist(), 0.5), 1)
+    report('nms chain (per-box loop)', t)
+    print('kept sets match' if sorted(keep.tolist()) == sorted(ref) else 'KEPT SETS DIFFER')
+
+    _, t = timed(lambda: sahi.to_predictions(boxes, scores, class_ids, dict(enumerate(CLASSES))), args.runs)
+    report('to_predictions', t)
+
+
+if __name__ == '__main__':
+    main()
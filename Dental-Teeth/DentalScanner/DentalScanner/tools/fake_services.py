@@ -0,0 +1,335 @@
+"""Local stand-ins for the Roboflow workflow, OpenAI chat completions and SMTP.
+
+Used by tools/loadtest.py so the server can be benchmarked offline, and
+runnable on its own to point a dev server at them:
+
+    python tools/fake_services.py --latency-ms 800 --error-rate 0.05
+
+prints the environment variables to set before starting server.py.
+
+- Workflow: POST /<workspace>/workflows/<id> answers in the serverless API
+  shape, {"outputs": [{"output_image": {"type": "base64", "value": ...},
+  "predictions": {...}}]}, with the image and predictions taken from
+  output_result.json (a small generated image if that file is missing).
+- Chat completions: POST /v1/chat/completions, plain JSON or, with
+  "stream": true, chunked server-sent events like the real API.
+- SMTP: a minimal ESMTP server (EHLO, AUTH PLAIN/LOGIN, MAIL, RCPT, DATA,
+  RSET, NOOP, QUIT; no STARTTLS, so run the server with SMTP_USE_TLS=false).
+
+Each service has its own latency (fixed + uniform jitter) and error
+injection (a fraction of requests answered with an error status / SMTP
+451), and counts what it served.
+"""
+import argparse
+import base64
+import json
+import random
+import socketserver
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+SAMPLE_RESULT = ROOT / 'output_result.json'
+
+SUMMARY_TEXT = ('Summary: Several teeth detected; no clear signs of decay in the visible areas.\n'
+                'Risk: low - detections are consistent with healthy teeth.\n'
+                'Actions: Keep regular brushing and flossing, and schedule a routine check-up.')
+
+
+class Behaviour:
+    """Latency and error injection for one fake service."""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, error_status=503):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def delay(self):
+        time.sleep(max(0.0, self.latency_ms + random.uniform(0, self.jitter_ms)) / 1000.0)
+
+    def should_fail(self):
+        """Count a request; True if it should get the injected error."""
+        fail = random.random() < self.error_rate
+        with self._lock:
+            self.requests += 1
+            self.errors += fail
+        return fail
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self.requests, 'errors_injected': self.errors}
+
+
+def _sample_outputs():
+    """(base64 image, predictions dict) for workflow responses."""
+    try:
+        with open(SAMPLE_RESULT, 'r', encoding='utf-8') as fh:
+            sample = json.load(fh)[0]
+        if isinstance(sample.get('output_image'), str) and isinstance(sample.get('predictions'), dict):
+            return sample['output_image'], sample['predictions']
+    except (OSError, ValueError, LookupError, AttributeError):
+        pass
+    from io import BytesIO
+    from PIL import Image
+    buf = BytesIO()
+    Image.new('RGB', (400, 205), (200, 190, 180)).save(buf, 'JPEG')
+    predictions = {'image': {'width': 400, 'height': 205}, 'predictions': [
+        {'x': 40.0 + 30 * i, 'y': 100.0, 'width': 28.0, 'height': 34.0, 'confidence': 0.85,
+         'class': 'Tooth', 'class_id': 3, 'detection_id': f'fake-{i}', 'parent_id': 'image'}
+        for i in range(10)]}
+    return base64.b64encode(buf.getvalue()).decode('ascii'), predictions
+
+
+class _HttpHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real APIs
+    services = None  # FakeServices, set per server
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, obj):
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0) or 0))
+        try:
+            return json.loads(body or b'{}')
+        except ValueError:
+            return {}
+
+    def do_HEAD(self):
+        # WorkflowClient.warm_up() opens its connection with a HEAD
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        req = self._read_json()
+        if self.path.startswith('/v1/chat/completions'):
+            return self._chat(req)
+        if '/workflows/' in self.path:
+            return self._workflow(req)
+        self._send_json(404, {'error': 'not found'})
+
+    def _workflow(self, req):
+        b = self.services.workflow
+        b.delay()
+        if b.should_fail():
+            return self._send_json(b.error_status, {'message': 'injected workflow error'})
+        image, predictions = self.services.sample
+        self._send_json(200, {'outputs': [{
+            'output_image': {'type': 'base64', 'value': image},
+            'predictions': predictions,
+        }]})
+
+    def _chat(self, req):
+        b = self.services.openai
+        if b.should_fail():
+            b.delay()
+            return self._send_json(b.error_status, {'error': {'message': 'injected OpenAI error'}})
+        if not req.get('stream'):
+            b.delay()
+            return self._send_json(200, {'choices': [{'message': {'role': 'assistant', 'content': SUMMARY_TEXT}}]})
+        # Streamed: latency is time to first token, then the words trickle in
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def chunk(data):
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+
+        b.delay()
+        for word in SUMMARY_TEXT.split(' '):
+            event = {'choices': [{'delta': {'content': word + ' '}}]}
+            chunk(b'data: ' + json.dumps(event).encode() + b'\n\n')
+            time.sleep(self.services.token_interval)
+        chunk(b'data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    services = None
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        b = self.services.smtp
+        self.services.record_connection()
+        self.reply('220 fake-smtp ESMTP ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.decode('utf-8', 'replace').strip()
+            verb = cmd.split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                self.wfile.write(b'250-fake-smtp\r\n250-AUTH PLAIN LOGIN\r\n250 SIZE 52428800\r\n')
+            elif verb == 'HELO':
+                self.reply('250 fake-smtp')
+            elif verb == 'AUTH':
+                if cmd.upper().startswith('AUTH LOGIN'):
+                    # Username and password prompts, unless the username came inline
+                    if len(cmd.split()) < 3:
+                        self.reply('334 VXNlcm5hbWU6')
+                        self.rfile.readline()
+                    self.reply('334 UGFzc3dvcmQ6')
+                    self.rfile.readline()
+                self.reply('235 2.7.0 Authentication successful')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                size = 0
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data in (b'.\r\n', b'.\n'):
+                        break
+                    size += len(data)
+                b.delay()
+                if b.should_fail():
+                    self.reply('451 4.3.0 Injected temporary failure')
+                else:
+                    self.services.record_email(size)
+                    self.reply('250 2.0.0 Queued')
+            elif verb == 'QUIT':
+                self.reply('221 2.0.0 Bye')
+                return
+            elif verb in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 2.0.0 OK')
+            else:
+                self.reply('502 5.5.2 Command not recognized')
+
+
+class _QuietErrors:
+    def handle_error(self, request, client_address):
+        # Clients dropping pooled keep-alive connections is normal under load
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _HttpServer(_QuietErrors, ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class _ThreadingTCPServer(_QuietErrors, socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeServices:
+    """HTTP (workflow + OpenAI) and SMTP fakes on free local ports."""
+
+    def __init__(self, workflow=None, openai=None, smtp=None, token_interval=0.02, host='127.0.0.1'):
+        self.workflow = workflow or Behaviour()
+        self.openai = openai or Behaviour()
+        self.smtp = smtp or Behaviour()
+        self.token_interval = token_interval
+        self.host = host
+        self.sample = _sample_outputs()
+        self._lock = threading.Lock()
+        self.emails = 0
+        self.email_bytes = 0
+        self.smtp_connections = 0
+        self._servers = []
+
+    def record_connection(self):
+        with self._lock:
+            self.smtp_connections += 1
+
+    def record_email(self, size):
+        with self._lock:
+            self.emails += 1
+            self.email_bytes += size
+
+    def start(self):
+        http_handler = type('HttpHandler', (_HttpHandler,), {'services': self})
+        smtp_handler = type('SmtpHandler', (_SmtpHandler,), {'services': self})
+        self.http = _HttpServer((self.host, 0), http_handler)
+        self.smtp_server = _ThreadingTCPServer((self.host, 0), smtp_handler)
+        for srv in (self.http, self.smtp_server):
+            threading.Thread(target=srv.serve_forever, daemon=True).start()
+            self._servers.append(srv)
+        return self
+
+    def stop(self):
+        for srv in self._servers:
+            srv.shutdown()
+            srv.server_close()
+        self._servers = []
+
+    @property
+    def http_url(self):
+        return f'http://{self.host}:{self.http.server_address[1]}'
+
+    def server_env(self):
+        """Environment for server.py to use these fakes."""
+        return {
+            'ROBOFLOW_API_URL': self.http_url,
+            'ROBOFLOW_API_KEY': 'fake-roboflow-key',
+            'DETECTOR_BACKEND': 'roboflow',
+            'OPENAI_API_BASE': self.http_url + '/v1',
+            'OPENAI_API_KEY': 'fake-openai-key',
+            'SMTP_SERVER': self.host,
+            'SMTP_PORT': str(self.smtp_server.server_address[1]),
+            'SMTP_USER': 'loadtest',
+            'SMTP_PASSWORD': 'loadtest',
+            'SMTP_FROM': 'loadtest@example.com',
+            'SMTP_USE_TLS': 'false',
+        }
+
+    def stats(self):
+        with self._lock:
+            smtp = dict(self.smtp.stats(), delivered=self.emails, bytes=self.email_bytes,
+                        connections=self.smtp_connections)
+        return {'workflow': self.workflow.stats(), 'openai': self.openai.stats(), 'smtp': smtp}
+
+
+def add_arguments(parser):
+    """Latency/error options shared with loadtest.py."""
+    g = parser.add_argument_group('fake services')
+    for name, latency in (('workflow', 1500), ('openai', 800), ('smtp', 100)):
+        g.add_argument(f'--{name}-latency-ms', type=float, default=latency, help=f'{name} response latency')
+        g.add_argument(f'--{name}-jitter-ms', type=float, default=latency * 0.2, help=f'extra uniform random {name} latency')
+        g.add_argument(f'--{name}-error-rate', type=float, default=0.0, help=f'fraction of {name} requests that fail')
+    g.add_argument('--token-interval-ms', type=float, default=20, help='delay between streamed OpenAI tokens')
+
+
+def from_arguments(args) -> FakeServices:
+    def behaviour(name):
+        return Behaviour(getattr(args, f'{name}_latency_ms'), getattr(args, f'{name}_jitter_ms'),
+                         getattr(args, f'{name}_error_rate'))
+    return FakeServices(behaviour('workflow'), behaviour('openai'), behaviour('smtp'),
+                        token_interval=args.token_interval_ms / 1000.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    args = parser.parse_args()
+    services = from_arguments(args).start()
+    for key, value in services.server_env().items():
+        print(f'{key}={value}')
+    print('Serving; Ctrl+C to stop.', file=sys.stderr)
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(services.stats()), file=sys.stderr)
+    except KeyboardInterrupt:
+        services.stop()
+
+
+if __name__ == '__main__':
+    main()
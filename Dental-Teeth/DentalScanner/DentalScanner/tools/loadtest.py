@@ -0,0 +1,428 @@
+"""Load test the web server offline against local fake services.
+
+Usage (from the project root):
+    python tools/loadtest.py --concurrency 16 --duration 60
+    python tools/loadtest.py --concurrency 32 --requests 500 --mix upload=6,send=3,profile=1 \\
+        --workflow-latency-ms 3000 --openai-error-rate 0.1 --json results.json
+
+Starts tools/fake_services.py (Roboflow workflow, OpenAI chat completions,
+SMTP) and a copy of server.py in a scratch directory pointed at them, so
+runs start from an empty database, upload folder and result cache and never
+touch real APIs or real inboxes. Pass --server-url to drive a server you
+started yourself (e.g. under gunicorn) instead.
+
+Each virtual user keeps its own session (cookie jar), saves a profile, then
+loops over operations picked by --mix until --duration or --requests runs out:
+
+- upload:  POST /upload as the browser does, long-poll /jobs/<id>, fetch the
+           result; "upload" is time to the accepted response, "upload_total"
+           time until the annotated result is available. A --summary
+           fraction of uploads also streams the AI summary ("summary_ttft"
+           to the first token, "summary" to the end).
+- send:    POST /send-to-doctor for the user's latest analysis; "send" is
+           time to the accepted response, "send_delivered" from then until
+           /outbox/<message_id> reports it sent.
+- profile: POST /save-profile.
+
+Uploads are unique JPEGs (so the workflow runs) except a --cache-hit
+fraction that repeats one shared image. At the end it prints throughput,
+error counts and latency percentiles per operation, then the server's own
+per-stage quantiles from /metrics.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+import requests
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import fake_services  # noqa: E402
+
+PROFILE = {
+    'firstName': 'Load', 'lastName': 'Test', 'provider': 'Open Wide Dental',
+    'dob': '1990-01-01', 'patientEmail': 'patient@example.com',
+    'doctorEmail': 'doctor@example.com', 'terms_accepted': 'true',
+}
+XHR = {'X-Requested-With': 'XMLHttpRequest', 'Accept': 'application/json'}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Recorder:
+    """Latencies and failures per operation, shared by all virtual users."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def ok(self, op, seconds):
+        with self._lock:
+            self.latencies.setdefault(op, []).append(seconds)
+
+    def fail(self, op, reason):
+        with self._lock:
+            self.errors.setdefault(op, Counter())[reason] += 1
+
+    def completed(self, ops=('upload', 'send', 'profile')):
+        """Finished (ok or failed) top-level operations."""
+        with self._lock:
+            return sum(len(self.latencies.get(op, ())) + sum(self.errors.get(op, Counter()).values()) for op in ops)
+
+    def summary(self, elapsed):
+        with self._lock:
+            ops = sorted(set(self.latencies) | set(self.errors))
+            rows = {}
+            for op in ops:
+                lat = self.latencies.get(op, [])
+                errors = self.errors.get(op, Counter())
+                rows[op] = {
+                    'ok': len(lat),
+                    'errors': sum(errors.values()),
+                    'error_reasons': dict(errors.most_common(5)),
+                    'throughput_rps': len(lat) / elapsed if elapsed else 0.0,
+                    'p50_ms': percentile(lat, 0.5) * 1000,
+                    'p95_ms': percentile(lat, 0.95) * 1000,
+                    'p99_ms': percentile(lat, 0.99) * 1000,
+                    'max_ms': max(lat, default=0.0) * 1000,
+                }
+            return rows
+
+
+def make_jpeg(width, height, seed=0):
+    """A photo-sized JPEG with enough texture to compress like a real one."""
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 255, size=(height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8)
+    img = Image.fromarray(small).resize((width, height), Image.BILINEAR)
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=90)
+    return buf.getvalue()
+
+
+class VirtualUser(threading.Thread):
+    def __init__(self, index, base_url, args, mix, recorder, image, stop):
+        super().__init__(daemon=True, name=f'vu-{index}')
+        self.base_url = base_url
+        self.args = args
+        self.mix = mix
+        self.recorder = recorder
+        self.image = image
+        self.stop = stop
+        self.rng = random.Random(index)
+        self.session = requests.Session()
+        self.latest = None  # (analysis_id, uploaded_filename) of the last finished upload
+        self.status_url = None  # outbox status of the last message sent
+
+    def timed(self, op, fn):
+        """Run fn() -> error reason or None, recording its latency under op."""
+        t0 = time.perf_counter()
+        try:
+            reason = fn()
+        except requests.RequestException as e:
+            reason = type(e).__name__
+        if reason:
+            self.recorder.fail(op, reason)
+            return False
+        self.recorder.ok(op, time.perf_counter() - t0)
+        return True
+
+    def run(self):
+        self.timed('profile', self.save_profile)
+        ops, weights = zip(*self.mix.items())
+        while not self.stop():
+            op = self.rng.choices(ops, weights)[0]
+            if op == 'send' and self.latest is None:
+                op = 'upload'
+            if op == 'upload':
+                self.upload()
+            elif op == 'send':
+                if self.timed('send', self.send) and self.status_url:
+                    self.wait_for_delivery(self.status_url, time.perf_counter())
+            else:
+                self.timed('profile', self.save_profile)
+            if self.args.think_ms:
+                time.sleep(self.rng.uniform(0, 2 * self.args.think_ms) / 1000.0)
+
+    def save_profile(self):
+        resp = self.session.post(self.base_url + '/save-profile', data=PROFILE, allow_redirects=False,
+                                 timeout=self.args.timeout)
+        # Success redirects to the upload page, failures back to /welcome with a flash
+        if resp.status_code != 302 or '/welcome' in resp.headers.get('Location', ''):
+            return f'HTTP {resp.status_code}'
+
+    def upload(self):
+        if self.rng.random() < self.args.cache_hit:
+            image = self.image
+        else:
+            # Trailing bytes after the JPEG end marker: a new hash, the same picture
+            image = self.image + os.urandom(16)
+        t0 = time.perf_counter()
+        try:
+            resp = self.session.post(self.base_url + '/upload', headers=XHR, timeout=self.args.timeout,
+                                     files={'image': ('loadtest.jpg', image, 'image/jpeg')},
+                                     data={'concern': 'Sensitivity on the lower left side'})
+        except requests.RequestException as e:
+            self.recorder.fail('upload', type(e).__name__)
+            return
+        if resp.status_code not in (200, 202):
+            self.recorder.fail('upload', f'HTTP {resp.status_code}')
+            return
+        self.recorder.ok('upload', time.perf_counter() - t0)
+        data = resp.json()
+        if resp.status_code == 202:
+            data = self.wait_for_job(data)
+            if data is None:
+                return
+        self.recorder.ok('upload_total', time.perf_counter() - t0)
+        self.latest = (data['analysis_id'], data['uploaded_filename'])
+        if self.rng.random() < self.args.summary:
+            self.stream_summary(data['summary_stream_url'])
+
+    def wait_for_job(self, accepted):
+        try:
+            while True:
+                status = self.session.get(self.base_url + accepted['status_url'], params={'wait': 25},
+                                          timeout=self.args.timeout).json()
+                if status['status'] in ('done', 'failed'):
+                    break
+                if self.stop() and self.args.duration:
+                    return None
+            resp = self.session.get(self.base_url + accepted['job_result_url'], timeout=self.args.timeout)
+        except (requests.RequestException, ValueError) as e:
+            self.recorder.fail('upload_total', type(e).__name__)
+            return None
+        if resp.status_code != 200:
+            self.recorder.fail('upload_total', f'HTTP {resp.status_code}')
+            return None
+        return resp.json()
+
+    def stream_summary(self, url):
+        t0 = time.perf_counter()
+        first = None
+        event = None
+        try:
+            with self.session.get(self.base_url + url, stream=True, timeout=self.args.timeout) as resp:
+                if resp.status_code != 200:
+                    self.recorder.fail('summary', f'HTTP {resp.status_code}')
+                    return
+                for line in resp.iter_lines(decode_unicode=True):
+                    if line.startswith('event: '):
+                        event = line[len('event: '):]
+                        if event in ('token', 'summary') and first is None:
+                            first = time.perf_counter() - t0
+                        elif event in ('failed', 'pending'):
+                            self.recorder.fail('summary', event)
+                            return
+                        elif event == 'done':
+                            break
+        except requests.RequestException as e:
+            self.recorder.fail('summary', type(e).__name__)
+            return
+        if first is None:
+            self.recorder.fail('summary', 'no tokens')
+            return
+        self.recorder.ok('summary_ttft', first)
+        self.recorder.ok('summary', time.perf_counter() - t0)
+
+    def send(self):
+        analysis_id, uploaded_filename = self.latest
+        resp = self.session.post(self.base_url + '/send-to-doctor', timeout=self.args.timeout, json={
+            'analysis_id': analysis_id, 'uploaded_filename': uploaded_filename,
+            'concern': 'Sensitivity on the lower left side',
+        })
+        if resp.status_code not in (200, 202):
+            return f'HTTP {resp.status_code}'
+        self.status_url = resp.json().get('status_url')
+
+    def wait_for_delivery(self, status_url, t0):
+        """Poll the outbox until the message is sent ("send_delivered": accepted to delivered)."""
+        try:
+            while True:
+                status = self.session.get(self.base_url + status_url, timeout=self.args.timeout).json()
+                if status['status'] == 'sent':
+                    break
+                if status['status'] == 'failed':
+                    self.recorder.fail('send_delivered', status.get('last_error') or 'failed')
+                    return
+                if self.stop() and self.args.duration:
+                    return
+                time.sleep(0.05)
+        except (requests.RequestException, ValueError) as e:
+            self.recorder.fail('send_delivered', type(e).__name__)
+            return
+        self.recorder.ok('send_delivered', time.perf_counter() - t0)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(workdir, env, port, log_path):
+    """Copy the app into workdir and run it there with flask's threaded server."""
+    for path in ROOT.glob('*.py'):
+        shutil.copy2(path, workdir)
+    for name in ('templates', 'static'):
+        shutil.copytree(ROOT / name, Path(workdir) / name)
+    log = open(log_path, 'wb')
+    cmd = [sys.executable, '-m', 'flask', '--app', 'server', 'run', '--host', '127.0.0.1',
+           '--port', str(port), '--no-reload', '--no-debugger', '--with-threads']
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            break
+        try:
+            if requests.get(base_url + '/metrics', timeout=1).status_code == 200:
+                return proc, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    proc.kill()
+    log.close()
+    sys.exit(f'Server did not start; see {log_path}:\n' + Path(log_path).read_text(errors='replace')[-3000:])
+
+
+def stage_quantiles(base_url):
+    """{stage: {quantile: seconds}} from the server's /metrics summary."""
+    try:
+        text = requests.get(base_url + '/metrics', timeout=10).text
+    except requests.RequestException:
+        return {}
+    stages = {}
+    for line in text.splitlines():
+        if not line.startswith('dental_stage_latency_seconds{'):
+            continue
+        labels, value = line[len('dental_stage_latency_seconds{'):].split('} ')
+        fields = dict(part.split('=', 1) for part in labels.split(','))
+        stages.setdefault(fields['stage'].strip('"'), {})[fields['quantile'].strip('"')] = float(value)
+    return stages
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        op, _, weight = part.partition('=')
+        if op.strip() not in ('upload', 'send', 'profile'):
+            raise argparse.ArgumentTypeError(f'unknown operation {op!r} (upload, send, profile)')
+        mix[op.strip()] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=8, help='virtual users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run (ignored with --requests)')
+    parser.add_argument('--requests', type=int, default=0, help='stop after this many operations')
+    parser.add_argument('--ramp-up', type=float, default=2, help='seconds over which users start')
+    parser.add_argument('--mix', type=parse_mix, default='upload=6,send=2,profile=2', help='operation weights')
+    parser.add_argument('--cache-hit', type=float, default=0.0, help='fraction of uploads repeating a known image')
+    parser.add_argument('--summary', type=float, default=1.0, help='fraction of uploads that stream the summary')
+    parser.add_argument('--think-ms', type=float, default=0, help='mean pause between a user\'s operations')
+    parser.add_argument('--image-size', default='1600x1200', help='WxH of the uploaded JPEG')
+    parser.add_argument('--timeout', type=float, default=120, help='per-request timeout in seconds')
+    parser.add_argument('--server-url', help='drive this running server instead of starting one')
+    parser.add_argument('--server-env', action='append', default=[], metavar='KEY=VALUE',
+                        help='extra environment for the started server (e.g. JOB_WORKERS=8)')
+    parser.add_argument('--keep-workdir', action='store_true', help='keep the scratch copy and server.log')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--seed', type=int, default=0)
+    fake_services.add_arguments(parser)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    services = proc = workdir = None
+    if args.server_url:
+        base_url = args.server_url.rstrip('/')
+    else:
+        services = fake_services.from_arguments(args).start()
+        workdir = tempfile.mkdtemp(prefix='dental_loadtest_')
+        env = dict(os.environ, LOG_LEVEL='WARNING', FLASK_SECRET='loadtest', INFERENCE_MODE='inprocess')
+        env.update(services.server_env())
+        env.update(item.split('=', 1) for item in args.server_env)
+        proc, base_url = start_server(workdir, env, free_port(), os.path.join(workdir, 'server.log'))
+        print(f'server {base_url} (workdir {workdir}), fakes {services.http_url}')
+
+    width, height = (int(v) for v in args.image_size.lower().split('x'))
+    image = make_jpeg(width, height, args.seed)
+    recorder = Recorder()
+    started = time.monotonic()
+    if args.requests:
+        def stop():
+            return recorder.completed() >= args.requests
+    else:
+        def stop():
+            return time.monotonic() - started >= args.duration
+    users = [VirtualUser(i, base_url, args, args.mix, recorder, image, stop) for i in range(args.concurrency)]
+    print(f'{args.concurrency} users, mix {args.mix}, '
+          + (f'{args.requests} operations' if args.requests else f'{args.duration:.0f}s'))
+    try:
+        for i, user in enumerate(users):
+            user.start()
+            time.sleep(args.ramp_up / max(1, len(users)))
+        for user in users:
+            user.join()
+    except KeyboardInterrupt:
+        print('interrupted; reporting what finished')
+    elapsed = time.monotonic() - started
+
+    results = recorder.summary(elapsed)
+    print(f'\n{"operation":<14} {"ok":>6} {"err":>5} {"req/s":>7} {"p50":>9} {"p95":>9} {"p99":>9} {"max":>9}')
+    for op, r in results.items():
+        print(f'{op:<14} {r["ok"]:>6} {r["errors"]:>5} {r["throughput_rps"]:>7.2f} '
+              f'{r["p50_ms"]:>7.0f}ms {r["p95_ms"]:>7.0f}ms {r["p99_ms"]:>7.0f}ms {r["max_ms"]:>7.0f}ms')
+        if r['error_reasons']:
+            print(f'{"":<14} errors: {r["error_reasons"]}')
+    print(f'elapsed {elapsed:.1f}s')
+
+    stages = stage_quantiles(base_url)
+    if stages:
+        print(f'\n{"server stage":<24} {"p50":>9} {"p95":>9} {"p99":>9}')
+        for stage, q in sorted(stages.items()):
+            print(f'{stage:<24} ' + ' '.join(f'{q.get(k, 0) * 1000:>7.1f}ms' for k in ('0.5', '0.95', '0.99')))
+    fakes = services.stats() if services else None
+    if fakes:
+        print(f'\nfakes: {json.dumps(fakes)}')
+
+    if args.json:
+        config = {k: v for k, v in vars(args).items() if k != 'json'}
+        with open(args.json, 'w', encoding='utf-8') as fh:
+            json.dump({'config': config, 'elapsed_s': elapsed, 'operations': results,
+                       'server_stages': stages, 'fakes': fakes}, fh, indent=2)
+
+    if proc is not None:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    if services is not None:
+        services.stop()
+    if workdir and not args.keep_workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
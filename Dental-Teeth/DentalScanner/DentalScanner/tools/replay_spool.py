@@ -0,0 +1,167 @@
+"""Send the messages in the local email spool (spool.py) to a real SMTP server.
+
+Usage (from the project root, with SMTP_SERVER/SMTP_USER/SMTP_PASSWORD set or in .env):
+    python tools/replay_spool.py --list
+    python tools/replay_spool.py --connections 8
+    python tools/replay_spool.py --import-legacy --prune
+
+Pending messages are read from the spool index in the order they were saved
+and sent by --connections threads. Each thread keeps one authenticated SMTP
+connection open for all its messages (outbox.SmtpSession), and each
+attachment is encoded once for the whole run (attachment_cache.py).
+Temporary failures are retried --retries times with backoff and then left
+pending for the next run; 5xx replies mark the message failed. Outcomes are
+recorded in the index as messages go, so an interrupted run resumes where it
+stopped. A rejected login stops the run.
+
+--import-legacy first moves email_*.json files saved in the old format into
+the spool; --prune afterwards drops sent messages and the attachments only
+they used.
+"""
+import argparse
+import queue
+import smtplib
+import sys
+import threading
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+load_dotenv(dotenv_path=ROOT / '.env')
+
+import attachment_cache  # noqa: E402
+import outbox  # noqa: E402
+import spool  # noqa: E402
+from circuit_breaker import backoff_delay  # noqa: E402
+
+
+def list_spool(box, limit):
+    stats = box.stats()
+    for status, counts in sorted(stats['messages'].items()):
+        print(f"{status:<8} {counts['messages']:>7} messages, {counts['attachment_bytes'] / 1e6:.1f} MB of attachments")
+    print(f"blobs    {stats['blobs']:>7} files, {stats['blob_bytes'] / 1e6:.1f} MB")
+    for row in box.latest(limit):
+        print(f"{row['seq']:>6} {row['created_at'][:19]} {row['status']:<7} {row['recipient']:<30} "
+              f"{row['subject'][:50]}" + (f"  [{row['last_error']}]" if row['last_error'] else ''))
+
+
+def deliver(session, box, row, retries):
+    """Send one spooled message; returns its outcome and the future recording it."""
+    msg = outbox.compose(box.outbox_item(row))
+    for attempt in range(retries + 1):
+        try:
+            session.send(msg)
+            return spool.SENT, box.mark_sent(row['seq'])
+        except smtplib.SMTPAuthenticationError:
+            raise
+        except Exception as e:
+            if not isinstance(e, smtplib.SMTPResponseException):
+                # Timeout or dropped connection: its state is unknown
+                session.close()
+            permanent = outbox.is_permanent(e)
+            if permanent or attempt == retries:
+                return (spool.FAILED if permanent else spool.PENDING), box.mark_failed(row['seq'], str(e), permanent)
+            time.sleep(backoff_delay(attempt + 1, base=2, cap=30))
+
+
+def replay(box, settings, connections, retries, limit):
+    work = queue.Queue(maxsize=connections * 4)
+    stop = threading.Event()
+    lock = threading.Lock()
+    outcomes = {spool.SENT: 0, spool.FAILED: 0, spool.PENDING: 0}
+    sent_bytes = [0]
+    futures = []
+    errors = []
+
+    def sender():
+        session = outbox.SmtpSession(settings)
+        try:
+            while True:
+                row = work.get()
+                if row is None:
+                    return
+                if stop.is_set():
+                    continue
+                try:
+                    outcome, future = deliver(session, box, row, retries)
+                except smtplib.SMTPAuthenticationError as e:
+                    errors.append(f'login rejected: {e}')
+                    stop.set()
+                    continue
+                with lock:
+                    outcomes[outcome] += 1
+                    futures.append(future)
+                    if outcome == spool.SENT:
+                        sent_bytes[0] += row['bytes']
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=sender, name=f'replay-{i}', daemon=True) for i in range(connections)]
+    for t in threads:
+        t.start()
+    started = time.perf_counter()
+    after, queued = 0, 0
+    while not stop.is_set() and queued < limit:
+        page = box.pending(after, min(500, limit - queued))
+        if not page:
+            break
+        for row in page:
+            work.put(row)
+        after = page[-1]['seq']
+        queued += len(page)
+    for _ in threads:
+        work.put(None)
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    for future in futures:
+        future.result()
+    for error in errors[:1]:
+        print(error, file=sys.stderr)
+    sent = outcomes[spool.SENT]
+    print(f'sent {sent}, failed {outcomes[spool.FAILED]}, left pending {outcomes[spool.PENDING]} '
+          f'in {elapsed:.2f}s over {connections} connections: {sent / elapsed:.1f} messages/s, '
+          f'{sent_bytes[0] / 1e6 / elapsed:.1f} MB/s of attachments')
+    print(f'attachment cache: {attachment_cache.get_cache().stats()}')
+    return not errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--spool', type=Path, default=spool.SPOOL_DIR, help='spool directory (EMAIL_SPOOL_DIR)')
+    parser.add_argument('--list', type=int, nargs='?', const=20, metavar='N',
+                        help='show counts and the latest N messages, and send nothing')
+    parser.add_argument('--connections', type=int, default=4, help='SMTP connections (threads) sending in parallel')
+    parser.add_argument('--retries', type=int, default=2, help='retries per message for temporary failures')
+    parser.add_argument('--limit', type=int, default=sys.maxsize, help='send at most this many messages')
+    parser.add_argument('--import-legacy', action='store_true',
+                        help='first import (and delete) email_*.json files saved in the old format')
+    parser.add_argument('--prune', action='store_true', help='afterwards drop sent messages and unused blobs')
+    args = parser.parse_args()
+
+    box = spool.Spool(args.spool)
+    if args.import_legacy:
+        print(f'imported {box.import_legacy()} legacy messages')
+    if args.list is not None:
+        list_spool(box, args.list)
+        return
+    ok = True
+    if box.pending(limit=1):
+        settings = outbox.smtp_settings()
+        if settings is None:
+            sys.exit('SMTP_SERVER, SMTP_USER and SMTP_PASSWORD must be set to replay the spool')
+        ok = replay(box, settings, max(1, args.connections), max(0, args.retries), args.limit)
+    else:
+        print('nothing pending')
+    if args.prune:
+        messages, blobs = box.prune()
+        print(f'pruned {messages} sent messages and {blobs} blobs')
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Check that same-named uploads never share a resized copy (derivatives.py).
+
+Usage (from the project root):
+    python tools/test_derivatives.py
+
+uploads/x.jpg, uploads/x.png and uploads/sub/x.jpg are three different
+images (here three colours). Each must come back from /uploads/<path>?size=
+as a copy of itself, not of whichever of them was resized first. Runs
+against a scratch uploads directory, database and cache in a temp directory.
+"""
+import os
+import sys
+import tempfile
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+SCRATCH = Path(tempfile.mkdtemp(prefix='test_derivatives_'))
+# Before importing server.py, which opens these at import time
+os.environ['DB_PATH'] = str(SCRATCH / 'data.db')
+os.environ['ARTIFACT_DIR'] = str(SCRATCH / 'artifacts')
+os.environ['RESULT_CACHE_DIR'] = str(SCRATCH / 'cache')
+
+import derivatives  # noqa: E402
+import server  # noqa: E402
+
+SOURCES = {'x.jpg': (255, 0, 0), 'x.png': (0, 0, 255), 'sub/x.jpg': (0, 255, 0)}
+
+
+def _colour(data):
+    with Image.open(BytesIO(data)) as im:
+        return im.convert('RGB').resize((1, 1)).getpixel((0, 0))
+
+
+def _close(a, b, tolerance=40):
+    return all(abs(x - y) <= tolerance for x, y in zip(a, b))
+
+
+def test_same_stem_uploads_get_their_own_copies():
+    uploads = SCRATCH / 'uploads'
+    for name, colour in SOURCES.items():
+        (uploads / name).parent.mkdir(parents=True, exist_ok=True)
+        Image.new('RGB', (800, 600), colour).save(uploads / name)
+    server.UPLOAD_DIR = uploads
+    client = server.app.test_client()
+    for accept in ('image/jpeg', 'image/webp'):
+        if accept == 'image/webp' and not derivatives.can_write('webp'):
+            continue
+        for size in derivatives.SIZES:
+            # Twice: the second round is served from the copies on disk
+            for _ in range(2):
+                for name, colour in SOURCES.items():
+                    resp = client.get(f'/uploads/{name}?size={size}', headers={'Accept': accept})
+                    assert resp.status_code == 200, (name, resp.status_code)
+                    got = _colour(resp.data)
+                    assert _close(got, colour), f'{name} ?size={size} ({accept}) came back as {got}, not {colour}'
+
+
+if __name__ == '__main__':
+    test_same_stem_uploads_get_their_own_copies()
+    print('ok')